@@ -1,31 +1,573 @@
-import os, requests
+import os, re, time, hashlib, logging, threading
+import click
+import requests
 import keys
-
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
-from requests.api import get
-from sqlalchemy.exc import IntegrityError
-from flask_bcrypt import Bcrypt
-
-from models import db, connect_db, User, User_Favorites
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import cached_property, lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from urllib.parse import urlsplit
+
+from flask import Flask, Blueprint, current_app, has_app_context, render_template, request, flash, redirect, session, g, jsonify, abort, url_for, make_response
+from flask import before_render_template, template_rendered, stream_with_context, get_flashed_messages
+from flask.ctx import _AppCtxGlobals
+from markupsafe import Markup
+from werkzeug.security import safe_join
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError, IntegrityError, ProgrammingError, SQLAlchemyError
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, connect_db, passwords, User, User_Favorites, Census_Cache, Weather_Cache, Comparison, City_Stats, upgrade_db
 from forms import LoginForm, UserEditForm
+from cache import LRUCache, TieredCache, MISSING
+from upstream import Upstream, UpstreamClient, BadPayload
+import metrics
+import gazetteer
+import warm
 
 CURR_USER_KEY = 'curr_user'
 
-app = Flask(__name__)
+# Every route, hook and flask command; create_app registers them on each app
+views = Blueprint('views', __name__, cli_group=None)
+
+# the same logger as Flask's app.logger, which is named after this module
+log = logging.getLogger(__name__)
+
+# Settings that differ by APP_PROFILE; see create_app
+PROFILES = {
+    # local development; the debug toolbar shows when FLASK_ENV=development
+    'dev': {'QUERY_BUDGET_STRICT': False},
+    # the unittest suite: no CSRF tokens, errors raised into the test, and
+    # a route over its query budget fails
+    'test': {'QUERY_BUDGET_STRICT': True, 'WTF_CSRF_ENABLED': False, 'PROPAGATE_EXCEPTIONS': True},
+    # gunicorn (see gunicorn.conf.py): nothing serving doesn't need
+    'prod': {'QUERY_BUDGET_STRICT': False},
+}
+
+def create_app(profile=None):
+    """ A new app for a profile in PROFILES, by default $APP_PROFILE or
+        'dev', with the views blueprint and extensions. Environment
+        variables override the profile's settings. gunicorn runs
+        'app:create_app()', and the flask command finds it with
+        FLASK_APP=app.
+    """
+
+    profile = profile or os.environ.get('APP_PROFILE', 'dev')
+    if profile not in PROFILES:
+        raise ValueError(f'APP_PROFILE must be one of {", ".join(PROFILES)}, not {profile!r}')
+
+    app = Flask(__name__)
+    app.config['PROFILE'] = profile
+    app.config.update(PROFILES[profile])
+
+    # Get DB_URI from environ variable.
+    # If not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgresql:///relocation_asst').replace("postgres://", "postgresql://", 1)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '12345')
+    # bcrypt cost factor; existing hashes are upgraded as their users log in
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # processes per web worker for hashing, 0 to hash in the request thread
+    app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2))
+    # send the comparison page as its parts become ready, rather than all at once
+    app.config['STREAM_PAGES'] = os.environ.get('STREAM_PAGES', '1') == '1'
+    # most SQL statements a request may run before it's logged (routes can
+    # set their own with @query_budget), and how many runs of one statement
+    # look like an N+1; strict raises instead, for tests
+    app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 10))
+    app.config['QUERY_REPEAT_LIMIT'] = int(os.environ.get('QUERY_REPEAT_LIMIT', 3))
+    if 'QUERY_BUDGET_STRICT' in os.environ:
+        app.config['QUERY_BUDGET_STRICT'] = os.environ['QUERY_BUDGET_STRICT'] == '1'
+    # seconds between background cache warming passes, 0 to only warm with flask warm-cache
+    app.config['CACHE_WARM_INTERVAL'] = float(os.environ.get('CACHE_WARM_INTERVAL', 0))
+    # most upstream calls a second a warming pass makes
+    app.config['CACHE_WARM_RATE'] = float(os.environ.get('CACHE_WARM_RATE', 2))
+    # city_stats file every worker maps read-only, written by flask ingest-acs
+    # or flask build-stats-store, or from the table on first use
+    # (None for statstore.STATS_PATH)
+    app.config['CITY_STATS_PATH'] = os.environ.get('CITY_STATS_PATH')
+
+    # only development imports the toolbar or pays for its hooks
+    if profile == 'dev':
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.app_ctx_globals_class = AppGlobals
+    app.register_blueprint(views)
+
+    connect_db(app)
+    passwords.init_app(app)
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'connect', remember_pid)
+    event.listen(engine, 'checkout', check_pid)
+    event.listen(engine, 'before_cursor_execute', start_query)
+    event.listen(engine, 'after_cursor_execute', finish_query)
+
+    return app
+
+# Recently used user rows, per worker. Other workers may see an edit
+# up to USER_CACHE_TTL seconds late.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+user_cache = LRUCache(maxsize=int(os.environ.get('USER_CACHE_SIZE', 1024)))
+
+# Census place codes, loaded on first use in each worker
+places = None
+
+def get_places():
+    """ This worker's gazetteer """
+
+    global places
+    if places is None:
+        places = gazetteer.Gazetteer.load()
+    return places
+
+CENSUS_VINTAGE = '2019'
+CENSUS_VARS = {
+        'pop':'DP05_0001E', 
+        'age':'DP05_0018E', 
+        'inc':'DP03_0062E', 
+        'home':'DP04_0089E'
+        }
+NO_DATA = "no data available"
+# when the census published CENSUS_VINTAGE's ACS 5-year data
+CENSUS_RELEASED = datetime(2020, 12, 10, tzinfo=timezone.utc)
+
+class AppContextPool(ThreadPoolExecutor):
+    """ ThreadPoolExecutor whose tasks run in the app context they were
+        submitted from, so work that outlives a request can still read
+        its app's config
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        if not has_app_context():
+            return super().submit(fn, *args, **kwargs)
+
+        app = current_app._get_current_object()
+        def run():
+            with app.app_context():
+                return fn(*args, **kwargs)
+        return super().submit(run)
+
+# Expired entries are still served for each cache's stale_ttl while this
+# pool fetches a fresh copy, so a slow or failing API doesn't hold up pages
+cache_refresh_pool = AppContextPool(max_workers=2, thread_name_prefix='cache-refresh')
+
+# ACS 5-year data only changes with the vintage, which is part of the key
+census_cache = TieredCache(
+    LRUCache(maxsize=int(os.environ.get('CENSUS_CACHE_SIZE', 2048))),
+    store=Census_Cache,
+    ttl=int(os.environ.get('CENSUS_CACHE_TTL', 30 * 24 * 3600)),
+    negative_ttl=int(os.environ.get('CENSUS_CACHE_NEGATIVE_TTL', 24 * 3600)),
+    is_negative=lambda data: NO_DATA in data.values(),
+    stale_ttl=int(os.environ.get('CENSUS_CACHE_STALE_TTL', 365 * 24 * 3600)),
+    refresh_pool=cache_refresh_pool
+)
+
+NO_WEATHER = {'icon':'01n', 'temp':None}
+
+# Weather is only kept a few minutes. Concurrent misses for a city
+# share one OpenWeather call, within and across workers.
+weather_cache = TieredCache(
+    LRUCache(maxsize=int(os.environ.get('WEATHER_CACHE_SIZE', 512))),
+    store=Weather_Cache,
+    ttl=int(os.environ.get('WEATHER_CACHE_TTL', 300)),
+    negative_ttl=int(os.environ.get('WEATHER_CACHE_TTL', 300)),
+    is_negative=lambda data: data['temp'] is None,
+    stale_ttl=int(os.environ.get('WEATHER_CACHE_STALE_TTL', 3600)),
+    refresh_pool=cache_refresh_pool
+)
+
+# Comparisons are built from census data only, so they keep about as well;
+# weather is looked up fresh (through weather_cache) each time one is shown
+comparison_cache = TieredCache(
+    LRUCache(maxsize=int(os.environ.get('COMPARISON_CACHE_SIZE', 2048))),
+    store=Comparison,
+    ttl=int(os.environ.get('COMPARISON_CACHE_TTL', 24 * 3600)),
+    negative_ttl=int(os.environ.get('COMPARISON_CACHE_NEGATIVE_TTL', 3600)),
+    stale_ttl=int(os.environ.get('COMPARISON_CACHE_STALE_TTL', 7 * 24 * 3600)),
+    refresh_pool=cache_refresh_pool
+)
+
+# Census codes and names for places the gazetteer doesn't list. They
+# change only with the census' place list, so old ones are served
+# through an outage; None records a city the census doesn't have.
+places_cache = TieredCache(
+    LRUCache(maxsize=int(os.environ.get('PLACES_CACHE_SIZE', 2048))),
+    ttl=int(os.environ.get('PLACES_CACHE_TTL', 30 * 24 * 3600)),
+    negative_ttl=int(os.environ.get('PLACES_CACHE_NEGATIVE_TTL', 24 * 3600)),
+    stale_ttl=int(os.environ.get('PLACES_CACHE_STALE_TTL', 365 * 24 * 3600)),
+    refresh_pool=cache_refresh_pool
+)
+
+# A place in a comparison URL: '<state code>-<place code>', e.g. '12-71000'
+PLACE_ID = re.compile(r'(\d{2})-(\d{5})')
+
+# Most destinations /cities/compare-many compares at once
+MAX_DESTINATIONS = 10
+
+# Upstream API calls for a page run side by side on this pool. Calls still
+# running UPSTREAM_TIMEOUT seconds after the page started are abandoned.
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', 10))
+UPSTREAM_WORKERS = int(os.environ.get('UPSTREAM_WORKERS', 8))
+upstream_pool = metrics.ContextThreadPoolExecutor(max_workers=UPSTREAM_WORKERS,
+                                                  thread_name_prefix='upstream')
+
+# Point these at benchmarks/standin.py to run without the real APIs
+CENSUS_API = os.environ.get('CENSUS_API', 'https://api.census.gov')
+WEATHER_API = os.environ.get('WEATHER_API', 'https://api.openweathermap.org')
+
+# Every external API call goes through this one client, which keeps
+# connections alive between calls. Timeouts are (connect, read) seconds.
+# After UPSTREAM_FAILURE_THRESHOLD failures in a row a host's circuit opens,
+# and calls to it fail at once (pages fall back on stale cached data) until a
+# trial call UPSTREAM_RESET_TIMEOUT seconds later succeeds.
+breaker = dict(failure_threshold=int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', 5)),
+               reset_timeout=float(os.environ.get('UPSTREAM_RESET_TIMEOUT', 30)))
+api_client = UpstreamClient([
+    Upstream(urlsplit(CENSUS_API).netloc, name='census',
+             timeout=(3.05, float(os.environ.get('CENSUS_TIMEOUT', 10))),
+             retries=int(os.environ.get('CENSUS_RETRIES', 2)), **breaker),
+    Upstream(urlsplit(WEATHER_API).netloc, name='weather',
+             timeout=(3.05, float(os.environ.get('WEATHER_TIMEOUT', 5))),
+             retries=int(os.environ.get('WEATHER_RETRIES', 1)), **breaker),
+], pool_size=UPSTREAM_WORKERS)
+
+##############################################################################
+# Instrumentation
+#
+# Each response's Server-Timing header says where its time went: per upstream
+# API (census, weather, with the host in desc), db, render and bcrypt.
+# /metrics has the same, aggregated for this worker. A streamed page's
+# header is sent before its body renders, so it leaves out that render
+# and any lookups made during it; /metrics counts them.
+
+metrics_registry = metrics.Registry()
+request_seconds = metrics_registry.add(metrics.Histogram(
+    'reloc_request_seconds', 'Time to handle a request.', labels=('endpoint', 'method')))
+request_count = metrics_registry.add(metrics.Counter(
+    'reloc_requests_total', 'Requests handled.', labels=('endpoint', 'status')))
+upstream_seconds = metrics_registry.add(metrics.Histogram(
+    'reloc_upstream_seconds', 'External API calls, including retries.', labels=('host',)))
+query_seconds = metrics_registry.add(metrics.Histogram(
+    'reloc_db_query_seconds', 'SQL statements.'))
+request_queries = metrics_registry.add(metrics.Histogram(
+    'reloc_db_queries_per_request', 'SQL statements per request.', labels=('endpoint',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50)))
+render_seconds = metrics_registry.add(metrics.Histogram(
+    'reloc_template_render_seconds', 'Template rendering.', labels=('template',)))
+query_budget_exceeded = metrics_registry.add(metrics.Counter(
+    'reloc_query_budget_exceeded_total', 'Requests over their SQL query budget or repeating a query.',
+    labels=('endpoint',)))
+password_seconds = metrics_registry.add(metrics.Histogram(
+    'reloc_password_seconds', 'bcrypt hashes and checks.', labels=('operation',),
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5)))
+
+caches = {'census': census_cache, 'weather': weather_cache, 'comparison': comparison_cache,
+          'places': places_cache}
+metrics_registry.add(metrics.Collected(
+    'reloc_cache_events_total', 'Cache lookups by outcome, including stale values served.',
+    lambda: {(name, event): count for name, cache in caches.items()
+             for event, count in cache.counts.items()},
+    labels=('cache', 'event'), type='counter'))
+metrics_registry.add(metrics.Collected(
+    'reloc_upstream_circuit_open', '1 while calls to a host are failing fast.',
+    lambda: {(upstream.host,): int(upstream.circuit() != 'closed')
+             for upstream in api_client.upstreams.values()},
+    labels=('host',)))
+metrics_registry.add(metrics.Collected(
+    'reloc_upstream_rejected_total', 'Calls not made because the circuit was open.',
+    lambda: {(upstream.host,): upstream.rejected for upstream in api_client.upstreams.values()},
+    labels=('host',), type='counter'))
+
+def observe_upstream(upstream, seconds):
+    upstream_seconds.observe(seconds, upstream.host)
+    metrics.record(upstream.name, seconds, upstream.host if upstream.host != upstream.name else None)
+
+def observe_password(operation, seconds):
+    password_seconds.observe(seconds, operation)
+    metrics.record('bcrypt', seconds)
+
+api_client.observer = observe_upstream
+passwords.observer = observe_password
+
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    """ Don't use a pooled connection opened before a fork (gunicorn
+        --preload) in the child: leave the socket to the parent and make
+        the pool connect again
+    """
+
+    pid = connection_record.info['pid']
+    if pid != os.getpid():
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise DisconnectionError(f'Connection opened by process {pid}, not {os.getpid()}')
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context.query_start
+    query_seconds.observe(seconds)
+    metrics.record('db', seconds)
+    # a cache fill locks its key, so a cold page takes one lock per key
+    # it fills; that's not a query in a loop
+    if 'advisory_xact_lock' not in statement:
+        metrics.record_query(statement)
+
+# start times of the templates being rendered on each thread
+rendering = threading.local()
+
+@before_render_template.connect
+def start_render(sender, template, context, **extra):
+    rendering.__dict__.setdefault('starts', []).append(time.perf_counter())
+
+@template_rendered.connect
+def finish_render(sender, template, context, **extra):
+    seconds = time.perf_counter() - rendering.starts.pop()
+    render_seconds.observe(seconds, template.name)
+    metrics.record('render', seconds)
+
+@views.before_app_request
+def start_timing():
+    rendering.starts = []
+    g.timings_token = metrics.current.set(metrics.RequestTimings())
+
+@views.after_app_request
+def finish_timing(response):
+    """ Registered before the other after_request hooks, so it runs last.
+        A streamed body is rendered as it's sent, after the Server-Timing
+        header has gone out, so its request is measured and checked
+        against its query budget once it's done.
+    """
+
+    timings = metrics.current.get()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        finish = partial(record_request, timings, request.endpoint or 'none', request.method,
+                         request.path, response.status_code, query_limits(),
+                         current_app.config['QUERY_BUDGET_STRICT'])
+        if response.is_streamed:
+            response.response = after_stream(response.response, finish)
+        else:
+            finish()
+    return response
+
+def after_stream(chunks, finish):
+    try:
+        yield from chunks
+    finally:
+        finish()
+
+def record_request(timings, endpoint, method, path, status, limits, strict):
+    request_seconds.observe(timings.elapsed(), endpoint, method)
+    request_count.inc(endpoint, status)
+    request_queries.observe(timings.count('db'), endpoint)
+    check_query_budget(timings, endpoint, f'{method} {path}', limits, strict)
+
+class QueryBudgetExceeded(AssertionError):
+    """ Raised under QUERY_BUDGET_STRICT when a request runs more SQL than allowed """
+
+def query_budget(queries, repeats=None):
+    """ Route decorator: most SQL statements one request should run, and
+        how often the same statement may run before it looks like an N+1,
+        in place of QUERY_BUDGET and QUERY_REPEAT_LIMIT
+    """
+
+    def decorate(view):
+        view.query_budget = (queries, repeats)
+        return view
+    return decorate
+
+def query_limits():
+    """ (budget, repeats) for this request's view """
+
+    budget, repeats = getattr(current_app.view_functions.get(request.endpoint), 'query_budget', (None, None))
+    budget = current_app.config['QUERY_BUDGET'] if budget is None else budget
+    repeats = current_app.config['QUERY_REPEAT_LIMIT'] if repeats is None else repeats
+    return budget, repeats
+
+def check_query_budget(timings, endpoint, label, limits, strict):
+    """ Log (or if strict, raise) when a request went over its query
+        budget or ran one statement over and over
+    """
+
+    budget, repeats = limits
+    problems = []
+    count = timings.count('db')
+    if count > budget:
+        problems.append(f'{count} queries (budget {budget})')
+    for statement, times in timings.repeated(repeats):
+        problems.append(f'{times}x {" ".join(statement.split())[:120]}')
+
+    if not problems:
+        return
+
+    query_budget_exceeded.inc(endpoint)
+    message = f'{label}: ' + '; '.join(problems)
+    if strict:
+        raise QueryBudgetExceeded(message)
+    log.warning('Query budget exceeded: %s', message)
+
+@views.teardown_app_request
+def stop_timing(exc):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        metrics.current.reset(token)
+
+@views.cli.command('build-gazetteer')
+def build_gazetteer():
+    """ Rebuild data/places.tsv.gz from the FIPS geocode spreadsheet """
+
+    count = gazetteer.build()
+    print(f'Wrote {count} places to {gazetteer.GAZETTEER_PATH}')
+
+@views.cli.command('upgrade-db')
+def upgrade_db_command():
+    """ Add columns and indexes introduced since the tables were created """
+
+    upgrade_db()
+    print('Done')
+
+@views.cli.command('backfill-cities')
+def backfill_cities():
+    """ Fill in stored city names and stats for users and favorites
+        saved before they were recorded
+    """
+
+    upgrade_db()
+
+    users = db.session.query(User.id, User.user_city, User.user_state) \
+                .filter(User.city_name == None).all()
+    favs = db.session.query(User_Favorites.id, User_Favorites.city_id, User_Favorites.state_id) \
+                .filter(User_Favorites.city_name == None).all()
+
+    codes = sorted({(row[1], row[2]) for row in users + favs})
+    print(f'{len(users)} users and {len(favs)} favorites to fill, {len(codes)} distinct cities')
+
+    details = {}
+    for start in range(0, len(codes), 50):
+        details.update(get_city_details(codes[start:start + 50]))
+        print(f'  fetched {len(details)}/{len(codes)}')
+
+    db.session.bulk_update_mappings(User,
+        [dict(details[(city, state)], id=id) for id, city, state in users])
+    db.session.bulk_update_mappings(User_Favorites,
+        [dict(details[(city, state)], id=id) for id, city, state in favs])
+    db.session.commit()
+
+    print('Done')
+
+@views.cli.command('ingest-acs')
+@click.option('--workers', default=8, help='States downloaded at once')
+def ingest_acs(workers):
+    """ Load ACS data for every census place into the city_stats table """
 
-# Get DB_URI from environ variable.
-# If not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgresql:///relocation_asst').replace("postgres://", "postgresql://", 1)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '12345')
-toolbar = DebugToolbarExtension(app)
+    import ingest, statstore
 
-connect_db(app)
+    upgrade_db()
+    start = time.monotonic()
+    try:
+        count = ingest.ingest(api_client, CENSUS_VINTAGE, CENSUS_VARS, workers=workers, api=CENSUS_API)
+    except ingest.IngestError as err:
+        raise click.ClickException(str(err))
+    print(f'Loaded {count} places for {CENSUS_VINTAGE} in {time.monotonic() - start:.1f}s')
+
+    count = statstore.build(stats_path(), CENSUS_VINTAGE)
+    print(f'Wrote {count} places to {stats_path()}; restart the workers to map it')
+
+@views.cli.command('build-stats-store')
+def build_stats_store():
+    """ Write the city_stats table to the file the workers map """
+
+    import statstore
+
+    upgrade_db()
+    path = stats_path()
+    count = statstore.build(path, CENSUS_VINTAGE)
+    if not count:
+        raise click.ClickException('city_stats is empty; run flask ingest-acs')
+    print(f'Wrote {count} places to {path}; restart the workers to map it')
+
+@views.cli.command('warm-cache')
+@click.option('--rate', default=2.0, help='Most upstream calls a second')
+@click.option('--limit', type=int, help='Only the most saved places')
+def warm_cache_command(rate, limit):
+    """ Prefetch census data and weather for users' cities and favorites """
+
+    report = warm_caches(rate, limit)
+    print(', '.join(f'{name} {value}' for name, value in report.items()))
+
+def warm_caches(rate=2.0, limit=None, echo=print):
+    """ One cache warming pass over every saved place """
+
+    saved = warm.saved_places(limit)
+    echo(f'Warming {len(saved)} places at up to {rate:g} upstream calls/s')
+    return warm.warm(saved, warm_census, warm_weather, rate=rate, echo=echo)
+
+def warm_census(codes, throttle):
+    """ Cache census data for places in one state; returns how many were fetched.
+        Expired entries are fetched here too, rather than served stale and
+        refreshed in the background, so every upstream call is throttled
+        and a failed one raises instead of counting as fetched.
+    """
+
+    # places in city_stats never go upstream
+    codes = set(codes) - local_census_data_many(codes).keys()
+    missing = defaultdict(list)
+    for place, state in codes:
+        if census_cache.get(census_key(place, state)) is MISSING:
+            missing[state].append(place)
+
+    for state, place_codes in missing.items():
+        throttle()
+        fetched = fetch_census_data_many(place_codes, state)
+        census_cache.set_many({census_key(place, state): fetched.get(place) for place in place_codes})
+
+    return sum(len(place_codes) for place_codes in missing.values())
+
+def warm_weather(place, state, city, abbr, throttle):
+    """ Cache a place's weather; returns 1 if it was fetched """
+
+    if not city or not abbr:
+        name = get_places().name(place, state)
+        if not name:
+            return 0
+        city, abbr = name['city'], name['abbr']
+
+    key = weather_key(city, abbr)
+    if weather_cache.get(key) is not MISSING:
+        return 0
+
+    # fetched here, like warm_census, even if a stale copy could be served
+    throttle()
+    weather_cache.set(key, fetch_weather(city, abbr))
+    return 1
+
+def warm_in_background(app):
+    """ Scheduled warming pass, logged instead of printed """
+
+    with app.app_context():
+        try:
+            report = warm_caches(current_app.config['CACHE_WARM_RATE'], echo=log.debug)
+            log.info('Cache warming: %s', report)
+        except Exception:
+            log.exception('Cache warming failed')
+
+@views.before_app_first_request
+def start_cache_warmer():
+    """ Warm the caches every CACHE_WARM_INTERVAL seconds in each worker,
+        if set. Workers after the first mostly find the shared store filled.
+    """
 
-bcrypt = Bcrypt()
+    interval = current_app.config['CACHE_WARM_INTERVAL']
+    if interval > 0:
+        app = current_app._get_current_object()
+        warm.Scheduler(lambda: warm_in_background(app), interval).start()
 
 def analyze(curr, dest):
     """ Compare income and home value data from both cities """
@@ -96,39 +638,169 @@ def analyze(curr, dest):
   
     return ({'inc':income, 'inc_perc':inc_percent, 'home':home, 'msg':msg }) 
 
+# city_stats as NumPy arrays: the shared mapped file once it exists, else
+# this worker's own copy (restart workers after flask ingest-acs). NumPy
+# is imported on first use.
+stats_matrix = None
+
+def stats_path():
+    import statstore
+
+    return current_app.config['CITY_STATS_PATH'] or statstore.STATS_PATH
+
+def get_stats_store():
+    """ The mapped city_stats file, or None if it hasn't been written """
+
+    from statstore import StatsStore
+
+    global stats_matrix
+    if not isinstance(stats_matrix, StatsStore):
+        try:
+            stats_matrix = StatsStore.open(stats_path(), CENSUS_VINTAGE)
+        except (OSError, ValueError):
+            return None
+    return stats_matrix
+
+def get_stats_matrix():
+    """ The city_stats matrix, writing the mapped file from the table
+        first if it's missing. Falls back to loading the table into this
+        worker if the file can't be written.
+    """
+
+    import statstore
+    from recommend import StatsMatrix
+
+    global stats_matrix
+    store = get_stats_store()
+    if store is not None:
+        return store
+
+    if stats_matrix is None or not len(stats_matrix):
+        try:
+            count = statstore.build(stats_path(), CENSUS_VINTAGE)
+        except OSError:
+            log.warning('Could not write the city stats file', exc_info=True)
+            stats_matrix = StatsMatrix.load(CENSUS_VINTAGE)
+        else:
+            stats_matrix = (count and get_stats_store()) or StatsMatrix([])
+    return stats_matrix
+
+# gazetteer names ranked by city_stats population, built on first use
+# (like stats_matrix, restart workers after flask ingest-acs). Until
+# city_stats is loaded the index is unranked, and rebuilt this often
+# in case it has been since.
+place_index = None
+place_index_ranked = False
+place_index_built = 0
+UNRANKED_INDEX_TTL = 60
+
+def get_place_index():
+    """ This worker's prefix index of place names for /api/places/suggest """
+
+    global place_index, place_index_ranked, place_index_built
+    if place_index is not None and \
+       (place_index_ranked or time.monotonic() - place_index_built < UNRANKED_INDEX_TTL):
+        return place_index
+
+    try:
+        matrix = get_stats_matrix()
+    except SQLAlchemyError:
+        log.warning('city_stats is unavailable, place suggestions are unranked', exc_info=True)
+        matrix = []
+
+    # NaN (no census count) isn't > 0, so those places rank with the unknowns
+    population = {(place.decode(), state.decode()): int(pop) for place, state, pop
+                  in zip(matrix.place, matrix.state, matrix.pop) if pop > 0} if len(matrix) else {}
+    place_index = gazetteer.PrefixIndex(get_places(), population)
+    place_index_ranked = bool(population)
+    place_index_built = time.monotonic()
+    return place_index
+
 ##############################################################################
 # API Calls
 def get_weather(city, state):
-    """ Access OpenWeather API for current weather """
+    """ Current weather for a city, through the weather cache.
+        state is the geocoder's 'US-XX' short code.
+    """
     state_abbr = state[3:]
+    return weather_cache.get_or_fetch(weather_key(city, state_abbr),
+                                      lambda: fetch_weather(city, state_abbr))
 
-    res = requests.get(
-        f'https://api.openweathermap.org/data/2.5/weather?q={city},{state_abbr},US&units=imperial&appid={keys.weather_key}'
+def weather_key(city, state_abbr):
+    # 'austin' and 'Austin ' share an entry
+    return (gazetteer.normalize(city), state_abbr.upper())
+
+def fetch_weather(city, state_abbr):
+    """ Access OpenWeather API for current weather """
+
+    res = api_client.get(
+        f'{WEATHER_API}/data/2.5/weather?q={city},{state_abbr},US&units=imperial&appid={keys.weather_key}'
         )
-    data = res.json()
 
-    if data['cod'] == '404':
-        return{'icon':'01n', 'temp':None}
-    else:
-        icon_code = data['weather'][0]['icon']
-        temp = data['main']['temp']
-        return {'icon':icon_code, 'temp':temp}
+    # unknown city
+    if res.status_code == 404:
+        return NO_WEATHER
+    res.raise_for_status()
+
+    try:
+        data = res.json()
+        return {'icon':data['weather'][0]['icon'], 'temp':data['main']['temp']}
+    except (ValueError, KeyError, IndexError, TypeError):
+        raise BadPayload('OpenWeather response is missing the current weather')
+
+def census_rows(res):
+    """ A census API table, header row first, or [] for the empty 204
+        the census answers unknown places with. Raises for error statuses
+        and for bodies that aren't a table.
+    """
+
+    if res.status_code == 204:
+        return []
+    res.raise_for_status()
+
+    try:
+        rows = res.json()
+    except ValueError:
+        raise BadPayload('Census response is not JSON')
+
+    if not isinstance(rows, list) or not rows or \
+       not all(isinstance(row, list) and len(row) == len(rows[0]) for row in rows):
+        raise BadPayload('Census response is not a table')
+
+    return rows
 
 def get_census_codes(city, state):
-    """ Get state and place codes for census api """
+    """ Get state and place codes for census api.
+        Looks in the local gazetteer first; places it doesn't list
+        (mostly census-designated places) fall back to the live API.
+    """
+
+    codes = get_places().lookup(city, state)
+    if codes:
+        return codes
+
+    codes = places_cache.get_or_fetch(('codes', city, state),
+                                      lambda: fetch_census_codes(city, state) or None)
+    return codes or False
 
-    all_states = requests.get(
-        'https://api.census.gov/data/2019/acs/acs5/subject?get=NAME&for=state:*').json()
+def fetch_census_codes(city, state):
+    """ Search the full census place list for a state for a city's codes """
+
+    all_states = census_rows(api_client.get(
+        f'{CENSUS_API}/data/2019/acs/acs5/subject?get=NAME&for=state:*'))[1:]
  
-    state_code = [item[1] for item in all_states if item[0] == state][0]
+    state_codes = [item[1] for item in all_states if item[0] == state]
+    if not state_codes:
+        return False
+    state_code = state_codes[0]
 
     # Bug in the geocoder lists New York as New York City. Grr.
     if city == 'New York City':
         city = 'New York'
  
-    cities = requests.get(
-        f'https://api.census.gov/data/2019/acs/acs5/subject?get=NAME&for=place:*&in=state:{state_code}'
-    ).json()
+    cities = census_rows(api_client.get(
+        f'{CENSUS_API}/data/2019/acs/acs5/subject?get=NAME&for=place:*&in=state:{state_code}'
+    ))[1:]
 
     for item in cities:
         census_city_name = item[0].rsplit(',',1)[0].rsplit(' ',1)[0]
@@ -140,34 +812,531 @@ def get_census_codes(city, state):
     return False
 
 def get_census_data(city, state):
-    """ Access U.S. Census American Community Survey """
+    """ Access U.S. Census American Community Survey data, from the
+        city_stats table if it's been loaded, else the cached live API.
+        Returns False if the census has no data for the place.
+    """
+
+    # places read from the table are kept in memory too, so a repeat
+    # lookup makes no query whichever source it came from
+    key = census_key(city, state)
+    city_data = census_cache.memory.get(key)
+    if city_data is not MISSING:
+        return False if city_data is None else dict(city_data)
+
+    city_data = local_census_data(city, state)
+    if city_data:
+        return city_data
+
+    city_data = census_cache.get_or_fetch(key, lambda: fetch_census_data(city, state))
+
+    if city_data is None:
+        return False
+
+    # copy, so callers can't change what's cached
+    return dict(city_data)
+
+def get_census_data_many(codes):
+    """ get_census_data for several (place, state) pairs, as a dict keyed
+        by the pair. Places not cached are fetched with one census request
+        per state. Pairs whose state's request failed are left out.
+    """
+
+    codes = set(codes)
+    results = local_census_data_many(codes)
+
+    keys = {pair: census_key(*pair) for pair in codes - results.keys()}
+    cached = census_cache.get_many(keys.values())
+
+    missing = defaultdict(list)
+    for (place, state), key in keys.items():
+        city_data = cached.get(key, MISSING)
+        if city_data is MISSING:
+            city_data = census_cache.get_stale(key)
+            if city_data is not MISSING:
+                census_cache.refresh(key, lambda place=place, state=state: fetch_census_data(place, state))
+        if city_data is MISSING:
+            missing[state].append(place)
+        else:
+            results[(place, state)] = dict(city_data) if city_data else False
+
+    fetches = {state: upstream_pool.submit(fetch_census_data_many, place_codes, state)
+               for state, place_codes in missing.items()}
+    deadline = time.monotonic() + UPSTREAM_TIMEOUT
+
+    for state, future in fetches.items():
+        fetched = wait_for(future, None, deadline)
+        if fetched is None:
+            continue
+        census_cache.set_many({census_key(place, state): fetched.get(place) for place in missing[state]})
+        for place in missing[state]:
+            city_data = fetched.get(place)
+            results[(place, state)] = dict(city_data) if city_data else False
+
+    return results
+
+def census_key(city, state):
+    return (CENSUS_VINTAGE, ','.join(CENSUS_VARS.values()), city, state)
+
+# Whether the city_stats table has CENSUS_VINTAGE, checked once per
+# worker (like stats_matrix, restart workers after flask ingest-acs), so
+# a missing or empty table costs one query rather than one per lookup
+city_stats_loaded = None
+
+def has_city_stats():
+    global city_stats_loaded
+    if city_stats_loaded is None:
+        try:
+            city_stats_loaded = City_Stats.has_vintage(CENSUS_VINTAGE)
+        except ProgrammingError as err:
+            # no table: run flask upgrade-db and flask ingest-acs
+            log.warning('city_stats is unavailable, using the census API: %s', err.orig)
+            city_stats_loaded = False
+        except SQLAlchemyError:
+            log.warning('city_stats check failed', exc_info=True)
+            return False
+        if not city_stats_loaded:
+            log.info('city_stats has no %s places, using the census API', CENSUS_VINTAGE)
+    return city_stats_loaded
+
+def local_census_data(city, state):
+    """ Census data for a place from the mapped city_stats file, or the
+        table if it hasn't been written, in the same form as
+        fetch_census_data, or None if it isn't there
+    """
+
+    store = get_stats_store()
+    if store is not None:
+        row = store.lookup(city, state)
+        return stats_data(row, city, state) if row else None
+
+    if not has_city_stats():
+        return None
+
+    try:
+        row = City_Stats.lookup(CENSUS_VINTAGE, city, state)
+    except SQLAlchemyError:
+        log.warning('city_stats lookup failed', exc_info=True)
+        return None
+
+    if row is None:
+        return None
+
+    city_data = stats_data(row._mapping, city, state)
+    census_cache.memory.set(census_key(city, state), city_data, census_cache.ttl)
+    return city_data
+
+def local_census_data_many(codes):
+    """ local_census_data for several (place, state) pairs, in one query
+        if the file hasn't been written, as a dict keyed by the pair,
+        leaving out places not in city_stats
+    """
+
+    store = get_stats_store()
+    if store is not None:
+        rows = {pair: store.lookup(*pair) for pair in codes}
+        return {pair: stats_data(row, *pair) for pair, row in rows.items() if row}
+
+    if not has_city_stats():
+        return {}
+
+    try:
+        rows = City_Stats.lookup_many(CENSUS_VINTAGE, codes)
+    except SQLAlchemyError:
+        log.warning('city_stats lookup failed', exc_info=True)
+        return {}
+
+    return {pair: stats_data(row._mapping, *pair) for pair, row in rows.items()}
+
+def stats_data(row, city, state):
+    city_data = {key:NO_DATA if row[key] is None else str(row[key]) for key in CENSUS_VARS}
+    return dict(city_data, state=state, place=city)
 
-    base_url = 'https://api.census.gov/data/2019/acs/acs5/profile?get=NAME,'
-    vars = {
-            'pop':'DP05_0001E', 
-            'age':'DP05_0018E', 
-            'inc':'DP03_0062E', 
-            'home':'DP04_0089E'
-            }
+def fetch_census_data(city, state):
+    """ Get ACS data for a place from api.census.gov.
+        Returns None if the census doesn't know the place.
+    """
+
+    return fetch_census_data_many([city], state).get(city)
+
+def fetch_census_data_many(cities, state):
+    """ ACS data for several places in one state, in one request, as a
+        dict keyed by place code. Places the census doesn't know are left out.
+    """
+
+    base_url = f'{CENSUS_API}/data/{CENSUS_VINTAGE}/acs/acs5/profile?get=NAME,'
+    vars = CENSUS_VARS
 
     query_url = base_url + \
-             (f'{vars["pop"]},{vars["age"]},{vars["inc"]},{vars["home"]}&for=place:{city}&in=state:{state}')
+             (f'{vars["pop"]},{vars["age"]},{vars["inc"]},{vars["home"]}&for=place:{",".join(sorted(cities))}&in=state:{state}')
     
-    response = requests.get(query_url).json()
+    rows = census_rows(api_client.get(query_url))
+    if not rows:
+        return {}
+
+    header, *rows = rows
+    index = {name: header.index(name) for name in header}
+    if not {'state', 'place', *vars.values()} <= index.keys():
+        raise BadPayload(f'Census response is missing columns: {header}')
+
+    places = {}
+    for row in rows:
+        city_data = {key:row[index[var]] for key, var in vars.items()}
+        city_data['state'] = row[index['state']]
+        city_data['place'] = row[index['place']]
+
+        # if census has no data for a particular variable for the specified city
+        for item in city_data:
+            if city_data[item] == '-888888888':
+                city_data[item] = NO_DATA
+
+        places[city_data['place']] = city_data
+
+    return places
+
+def get_place_names(codes):
+    """ City name, state name and state abbreviation for (place, state)
+        code pairs, as a dict keyed by the pair. Names come from the gazetteer where possible;
+        the rest from places_cache, then one census request per state.
+        Places whose request fails are left out.
+    """
+
+    names = {}
+    unlisted = []
+
+    for place, state in codes:
+        name = get_places().name(place, state)
+        if name:
+            names[(place, state)] = name
+        else:
+            unlisted.append(('names', place, state))
+
+    missing = defaultdict(set)
+    cached = places_cache.get_many(unlisted)
+    for key in unlisted:
+        _, place, state = key
+        name = cached.get(key, MISSING)
+        if name is MISSING:
+            name = places_cache.get_stale(key)
+            if name is not MISSING:
+                places_cache.refresh(key, lambda place=place, state=state:
+                                     fetch_place_names({place}, state).get((place, state)))
+        if name is MISSING:
+            missing[state].add(place)
+        elif name:
+            names[(place, state)] = name
+
+    for state, place_codes in missing.items():
+        try:
+            fetched = fetch_place_names(place_codes, state)
+        except requests.RequestException as err:
+            log.warning('Place names for state %s failed: %r', state, err)
+            continue
+        places_cache.set_many({('names', place, state): fetched.get((place, state))
+                               for place in place_codes})
+        names.update(fetched)
+
+    return names
+
+def fetch_place_names(place_codes, state):
+    """ Names for several places in one state, in a single census request """
+
+    rows = census_rows(api_client.get(
+        f'{CENSUS_API}/data/2019/acs/acs5/subject?get=NAME&for=place:{",".join(sorted(place_codes))}&in=state:{state}'
+    ))
+
+    names = {}
+    for item in rows[1:]:
+        city_name = item[0].rsplit(',',1)[0].rsplit(' ',1)[0]
+        state_name = item[0].rsplit(', ')[1]
+        abbr = gazetteer.STATES.get(state_name, (None, None))[1]
+        names[(item[2], item[1])] = {'city':city_name, 'state':state_name, 'abbr':abbr}
+
+    return names
+
+def get_city_details(codes):
+    """ Display names and a snapshot of the headline census stats for
+        (place, state) pairs, in the form stored on User and User_Favorites.
+        A place whose stats can't be fetched gets city_stats None.
+    """
 
-    city_data = {"pop":response[1][1], 
-                 "age":response[1][2],
-                 "inc":response[1][3], 
-                 "home":response[1][4],
-                 "state":state,
-                 "place":city}
+    codes = set(codes)
+    names = get_place_names(codes)
+    stats = {pair: upstream_pool.submit(get_census_data, *pair) for pair in codes}
+    deadline = time.monotonic() + UPSTREAM_TIMEOUT
 
-    # if census has no data for a particular variable for the specified city
-    for item in city_data:
-        if city_data[item] == '-888888888':
-            city_data[item] = "no data available"
+    details = {}
+    for pair in codes:
+        name = names.get(pair, {})
+        data = wait_for(stats[pair], False, deadline)
+        details[pair] = {'city_name':name.get('city'),
+                         'state_name':name.get('state'),
+                         'abbr':name.get('abbr'),
+                         'city_stats':{key:data[key] for key in CENSUS_VARS} if data else None}
 
-    return city_data
+    return details
+
+def city_details(place, state):
+    """ get_city_details for a single place """
+
+    return get_city_details([(place, state)])[(place, state)]
+
+def wait_for(future, default, deadline):
+    """ Result of an upstream call, or default if it failed or is still
+        running at the deadline (a time.monotonic() value), so one bad
+        upstream can't take the whole page down
+    """
+
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except Exception as err:
+        log.warning('Upstream call failed: %r', err)
+        return default
+
+def place_id(codes):
+    """ The '<state>-<place>' form of census codes used in comparison URLs """
+
+    return f"{codes['state']}-{codes['place']}"
+
+def get_comparison(curr, dest):
+    """ Names and census data for two places, keyed 'curr' and 'dest',
+        through the comparison cache. curr and dest are place ids.
+        Returns None if a place is malformed, unknown, or has no census
+        data; raises if the census couldn't be reached.
+    """
+
+    curr_match = PLACE_ID.fullmatch(curr)
+    dest_match = PLACE_ID.fullmatch(dest)
+    if not curr_match or not dest_match:
+        return None
+
+    key = curr_match.groups() + dest_match.groups()
+    return comparison_cache.get_or_fetch(key, lambda: fetch_comparison(key))
+
+def fetch_comparison(key):
+    """ Build the comparison for a (curr_state, curr_place, dest_state,
+        dest_place) key, looking up both places at once. Runs under the
+        comparison's fill lock, so the census cache is read and written
+        on its connection.
+    """
+
+    curr = (key[1], key[0])
+    dest = (key[3], key[2])
+
+    census = get_census_data_many({curr, dest})
+    names = get_place_names({curr, dest})
+
+    comparison = {}
+    for side, pair in (('curr', curr), ('dest', dest)):
+        if pair not in census:
+            # failed or timed out; raise, so it isn't cached
+            raise requests.RequestException(f'No census response for place {pair[0]} in state {pair[1]}')
+        census_data = census[pair]
+        name = names.get(pair)
+        if not name or not census_data:
+            return None
+
+        comparison[side] = {'name':name['city'], 'abbr':name['abbr'], 'census':census_data}
+
+    return comparison
+
+def completed(futures, default, deadline):
+    """ (key, result) for a dict of futures, in the order they finish.
+        Ones that fail, or are still running at the deadline, give default.
+    """
+
+    pending = {future: key for key, future in futures.items()}
+    try:
+        for future in as_completed(list(pending), timeout=max(0, deadline - time.monotonic())):
+            yield pending.pop(future), wait_for(future, default, deadline)
+    except FuturesTimeout:
+        log.warning('Upstream calls still running at the deadline: %s', list(pending.values()))
+
+    for key in pending.values():
+        yield key, default
+
+def resolve_place(text):
+    """ (place, state) codes for a place id or a 'City, State' name,
+        or None if there's no such place
+    """
+
+    match = PLACE_ID.fullmatch(text)
+    if match:
+        return (match.group(2), match.group(1))
+
+    city, _, state = text.rpartition(',')
+    if not city:
+        return None
+
+    codes = get_census_codes(city.strip(), state.strip())
+    return (codes['place'], codes['state']) if codes else None
+
+def has_buying_power_data(census_data):
+    """ Whether analyze() can use a place's census data """
+
+    return NO_DATA not in (census_data['inc'], census_data['home'])
+
+def load_comparison(curr, dest):
+    """ get_comparison for a page, flashing why if there's nothing to show """
+
+    try:
+        comparison = get_comparison(curr, dest)
+    except Exception as err:
+        log.warning('Comparison lookup failed: %r', err)
+        flash('The US Census service is not responding right now. Please try again in a moment.','danger')
+        return None
+
+    if comparison is None:
+        flash('No census data is available for one of these cities. Please try a different city.','danger')
+
+    return comparison
+
+##############################################################################
+# HTTP caching
+
+# Set per deploy, so page validators change when templates do
+APP_VERSION = os.environ.get('APP_VERSION', '')
+
+def code_modified():
+    """ When the app's code or templates last changed, to the second (as
+        HTTP dates are). A deploy writes them, so this is the deploy
+        time, and the same in every worker.
+    """
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [entry.path for folder in (root, os.path.join(root, 'templates'))
+             for entry in os.scandir(folder) if entry.name.endswith(('.py', '.html'))]
+    return datetime.fromtimestamp(int(max(os.stat(path).st_mtime for path in paths)), timezone.utc)
+
+CODE_MODIFIED = code_modified()
+
+# Static URLs carry a hash of the file, so they can be kept this long
+STATIC_MAX_AGE = 365 * 24 * 3600
+# A ?v= that isn't the file's current hash (a page rendered before a
+# deploy, or a made up one) gets the current file for only this long
+STATIC_STALE_MAX_AGE = 300
+
+@lru_cache(maxsize=256)
+def file_hash(path, mtime):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+def static_hash(filename):
+    """ file_hash for a file in the static folder, or None if it can't be read """
+
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        return file_hash(path, os.stat(path).st_mtime)
+    except (OSError, TypeError):
+        return None
+
+@views.app_url_defaults
+def version_static_urls(endpoint, values):
+    """ url_for('static', ...) adds ?v=<content hash> """
+
+    if endpoint == 'static' and 'v' not in values:
+        version = static_hash(values['filename'])
+        if version:
+            values['v'] = version
+
+def cache_for(seconds):
+    """ Route decorator: shared caches may keep the page this long.
+        Anything shown to a logged in user is still private.
+    """
+
+    def decorate(view):
+        view.cache_max_age = seconds
+        return view
+    return decorate
+
+def page_etag(*parts):
+    """ ETag for a page built from parts """
+
+    return hashlib.sha1(repr((APP_VERSION,) + parts).encode()).hexdigest()
+
+def conditional(etag, render, last_modified=None):
+    """ 304 Not Modified if the client already has this version of the
+        page, otherwise the response from render(). last_modified is
+        when the page's data changed; the page also changes with the
+        code, so Last-Modified is never before CODE_MODIFIED.
+    """
+
+    if last_modified:
+        last_modified = max(last_modified, CODE_MODIFIED)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(last_modified and request.if_modified_since
+                     and request.if_modified_since >= last_modified)
+
+    response = current_app.response_class(status=304) if fresh else make_response(render())
+    if response.status_code in (200, 304):
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+    return response
+
+@views.after_app_request
+def set_cache_headers(response):
+    """ Cache-Control for every response.
+        Static files requested by their current hash are immutable; pages
+        are public only if their route says so (cache_for) and nobody is
+        logged in.
+    """
+
+    cache = response.cache_control
+
+    if request.endpoint == 'static':
+        if 'v' in request.args and response.status_code in (200, 304):
+            cache.no_cache = None
+            cache.public = True
+            if request.args['v'] == static_hash(request.view_args['filename']):
+                cache.max_age = STATIC_MAX_AGE
+                cache.immutable = True
+            else:
+                cache.max_age = STATIC_STALE_MAX_AGE
+        return response
+
+    max_age = getattr(current_app.view_functions.get(request.endpoint), 'cache_max_age', None)
+
+    if CURR_USER_KEY in session:
+        cache.private = True
+        cache.no_cache = True
+    elif max_age is not None and response.status_code in (200, 304) and not session.modified:
+        cache.public = True
+        cache.max_age = max_age
+    else:
+        cache.no_cache = True
+
+    return response
+
+# Where a streamed template ends a chunk; see stream_template()
+FLUSH = Markup('<!--flush-->')
+
+def stream_template(name, **context):
+    """ Render a template as a stream of chunks, sending everything up to
+        each {{ flush }} in the template as soon as it's rendered.
+        Anything the template iterates over can be a generator that
+        blocks until its next part is ready.
+    """
+
+    def generate():
+        current_app.update_template_context(context)
+        template = current_app.jinja_env.get_template(name)
+
+        buffer = []
+        for piece in template.generate(context, flush=FLUSH):
+            if piece == FLUSH:
+                yield ''.join(buffer)
+                buffer = []
+            else:
+                buffer.append(piece)
+        yield ''.join(buffer)
+
+    # the session can't change once streaming starts, so messages are taken now
+    get_flashed_messages()
+    return current_app.response_class(stream_with_context(generate()), mimetype='text/html')
 
 ##############################################################################
 # Register/login/logout
@@ -181,25 +1350,64 @@ def logout():
     if CURR_USER_KEY in session:
         session.pop(CURR_USER_KEY)
 
-@app.before_request
-def add_user_to_g():
-    """ If a user is logged in, add curr user to Flask global """
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-    else:
-        g.user = None
+def load_user(user_id):
+    """ Get a user by id, from this worker's identity cache if it was
+        loaded in the last USER_CACHE_TTL seconds, else from the db.
+        The password hash is never cached; a cached user loads it from
+        the db if something reads it.
+    """
+
+    values = user_cache.get(user_id)
+
+    if values is MISSING:
+        user = User.query.get(user_id)
+        if user:
+            user_cache.set(user_id,
+                           {column.key:getattr(user, column.key) for column in User.__table__.columns
+                            if column.key != 'password'},
+                           USER_CACHE_TTL)
+        return user
+
+    # attach a copy of the cached row to this request's session without
+    # querying; attributes left out of the copy load on first access
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def forget_user(user_id):
+    """ Drop a changed or deleted user from the identity cache """
+    user_cache.delete(user_id)
+
+class AppGlobals(_AppCtxGlobals):
+    """ Flask's g, with g.user loaded the first time something uses it
+        instead of on every request. Static files, health checks and
+        pages that never look at the user make no db query for it.
+    """
+
+    @cached_property
+    def user(self):
+        if CURR_USER_KEY in session:
+            return load_user(session[CURR_USER_KEY])
+        return None
 
-@app.route('/register')
+
+@views.route('/register')
 def show_registration_form():
  
     return render_template('register.html')
 
-@app.route('/register', methods=['POST'])
+@views.route('/register', methods=['POST'])
 def create_account():
     """ Create new user, add to DB, log user in. 
         If username is already in db, flash message and re-render form.
     """
-    codes = get_census_codes(request.form['user-city'], request.form['user-state'])
+    try:
+        codes = get_census_codes(request.form['user-city'], request.form['user-state'])
+    except requests.RequestException as err:
+        log.warning('Place lookup failed: %r', err)
+        flash('The US Census service is not responding right now. Please try again in a moment.','danger')
+        return render_template('register.html')
+
     if not codes:
         flash(f"{request.form['user-city']} was not found in the US Census data. Please try a different city.",'danger')
         return redirect('/')
@@ -214,6 +1422,8 @@ def create_account():
                              city,
                              state
         )
+        for key, value in city_details(city, state).items():
+            setattr(user, key, value)
         db.session.commit()
 
     except IntegrityError:
@@ -223,7 +1433,7 @@ def create_account():
     login(user)
     return redirect('/')
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def handle_login():
     """ Handle user login """
 
@@ -234,6 +1444,9 @@ def handle_login():
                                  form.password.data)
 
         if user:
+            # saves a rehashed password
+            db.session.commit()
+            forget_user(user.id)
             login(user)
             flash(f"Welcome, {user.username}!", 'success')
             return redirect('/')
@@ -242,7 +1455,7 @@ def handle_login():
 
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@views.route('/logout')
 def handle_logout():
     """ Handle logout of user """
 
@@ -253,7 +1466,7 @@ def handle_logout():
 # ##############################################################################
 # Homepage
 
-@app.route('/')
+@views.route('/')
 def show_homepage():
 
     return render_template('home.html')
@@ -261,7 +1474,9 @@ def show_homepage():
 ##############################################################################
 # User routes:
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
+# the logged in user, the user shown and their favorites
+@query_budget(3)
 def show_user_info(user_id):
     """ Show user profile information and favorite cities """
 
@@ -271,30 +1486,33 @@ def show_user_info(user_id):
 
     else:
         user = User.query.get(user_id)
-        user_city_data = requests.get(
-                f'https://api.census.gov/data/2019/acs/acs5/subject?get=NAME&for=place:{user.user_city}&in=state:{user.user_state}'
-            ).json()
+        favs = User_Favorites.query.filter(User_Favorites.user_id==user.id).all()
 
-        user_city = user_city_data[1][0].rsplit(',',1)[0].rsplit(' ',1)[0]
-        user_state = user_city_data[1][0].rsplit(', ')[1]
+        # names are stored with the user and favorites; anything saved
+        # before that is resolved in one batch, not one request each
+        missing = [(item.city_id, item.state_id) for item in favs if not item.city_name]
+        if not user.city_name:
+            missing.append((user.user_city, user.user_state))
+        names = get_place_names(missing) if missing else {}
+        unknown = {'city':'Unknown city', 'state':''}
+
+        home = names.get((user.user_city, user.user_state), unknown)
+        user_city = user.city_name or home['city']
+        user_state = user.state_name or home['state']
 
-        favs = User_Favorites.query.filter(User_Favorites.user_id==user.id).all()
         favorites = []
 
         for item in favs:
-            item_data = requests.get(
-                f'https://api.census.gov/data/2019/acs/acs5/subject?get=NAME&for=place:{item.city_id}&in=state:{item.state_id}'
-            ).json()
-
-            city_name = item_data[1][0].rsplit(',',1)[0].rsplit(' ',1)[0]
-            state_name = item_data[1][0].rsplit(', ')[1]
-
-            favorites.append({'id':item.id, 'city':city_name, 'state':state_name})
+            name = names.get((item.city_id, item.state_id), unknown)
+            favorites.append({'id':item.id,
+                              'city':item.city_name or name['city'],
+                              'state':item.state_name or name['state'],
+                              'stats':item.city_stats})
   
         return render_template('user_info.html', 
                                 favorites=favorites, user=user, user_city=user_city, user_state=user_state)
 
-@app.route('/users/<int:user_id>/edit', methods=['GET', 'POST'])
+@views.route('/users/<int:user_id>/edit', methods=['GET', 'POST'])
 def edit_user(user_id):
     """ Edit user profile information """
 
@@ -307,26 +1525,39 @@ def edit_user(user_id):
         form = UserEditForm()
 
         if form.validate_on_submit():
-            authorized = User.authenticate(g.user.username, form.old_pw.data)
+            # g.user may be a copy from the identity cache; check the
+            # password and edit against the current rows
+            db.session.refresh(g.user)
+            if user is not g.user:
+                db.session.refresh(user)
+            authorized = g.user.check_password(form.old_pw.data)
 
             if authorized:
                 user.username = g.user.username
                 if form.new_pw.data:
-                    new_hashed_pw = bcrypt.generate_password_hash(form.new_pw.data).decode('UTF-8')
-                    user.password = new_hashed_pw
+                    user.set_password(form.new_pw.data)
                 if form.email.data:
                     user.email = form.email.data
-                if request.form['user-city']:
-                    codes = get_census_codes(request.form['user-city'], request.form['user-state'])
+                if request.form.get('user-city'):
+                    try:
+                        codes = get_census_codes(request.form['user-city'], request.form['user-state'])
+                    except requests.RequestException as err:
+                        log.warning('Place lookup failed: %r', err)
+                        flash('The US Census service is not responding right now. Please try again in a moment.','danger')
+                        return render_template('user_edit.html', user=user, form=form)
+
                     if not codes:
                         flash(f"{request.form['user-city']} was not found in the US Census data. Please try a different city.",'danger')
                         return redirect('/')
 
                     user.user_city = codes['place']
                     user.user_state = codes['state']
+                    for key, value in city_details(codes['place'], codes['state']).items():
+                        setattr(user, key, value)
 
                 db.session.add(user)
                 db.session.commit()
+                forget_user(user.id)
 
                 return redirect(f'/users/{user.id}')
 
@@ -336,7 +1567,7 @@ def edit_user(user_id):
 
         return render_template('user_edit.html', user=user, form=form)
 
-@app.route('/users/favs/add/<city>/<state>', methods=['POST'])
+@views.route('/users/favs/add/<city>/<state>', methods=['POST'])
 def toggle_fav_city(city, state):
     """ Add or remove city from favorites table """
 
@@ -347,26 +1578,15 @@ def toggle_fav_city(city, state):
     else:
         user = g.user
 
-        fav = User_Favorites.query.filter(User_Favorites.city_id==city,
-                                          User_Favorites.state_id==state,
-                                          User_Favorites.user_id==user.id).one_or_none()
-
-        # if city is already favorited, unfavorite
-        if fav:
-            db.session.delete(fav)
-        # if city not favorited already, create a new favorite
-        else:
-            new_favorite = User_Favorites(user_id=user.id,
-                                          city_id=city,
-                                          state_id=state
-                                          )
-            db.session.add(new_favorite)
-
+        # one statement: unfavorites the city if it was a favorite, favorites it if not.
+        # Only a new favorite needs its names and stats looked up.
+        if User_Favorites.toggle(user.id, city, state):
+            User_Favorites.set_details(user.id, city, state, **city_details(city, state))
         db.session.commit()
 
         return redirect('', 204)
 
-@app.route('/users/favs/delete/<int:id>', methods=['DELETE'])
+@views.route('/users/favs/delete/<int:id>', methods=['DELETE'])
 def delete_favorite(id):
     """ Delete user favorite when user_info page trash button clicked """
 
@@ -377,7 +1597,7 @@ def delete_favorite(id):
 
     return jsonify(message='deleted')
 
-@app.route('/users/<int:user_id>/delete')
+@views.route('/users/<int:user_id>/delete')
 def delete_user(user_id):
     """ Delete user from db """
 
@@ -386,97 +1606,272 @@ def delete_user(user_id):
         return redirect('/login')
 
     else:
+        user_id = g.user.id
         logout()
         db.session.delete(g.user)
         db.session.commit()
+        forget_user(user_id)
 
         return redirect("/")
 
 ##############################################################################
 # City routes:
  
-@app.route('/cities/compare', methods=['POST'])
+@views.route('/cities/compare', methods=['POST'])
 def compare_cities():
-    """ Show data for two cities""" 
+    """ Find two cities' census codes and redirect to their comparison """ 
 
     curr_city = request.form['curr-city']
     curr_state = request.form['curr-state']
-    curr_abbr = request.form['curr-abbr']
     dest_city = request.form['dest-city']
     dest_state = request.form['dest-state']
-    dest_abbr = request.form['dest-abbr']
 
     if not curr_city or not curr_state or not dest_city or not dest_state:
         flash('Uh oh. Looks like some input data was missing. Please try again.', 'danger')
         return redirect('/')
 
-    curr_codes = get_census_codes(curr_city, curr_state)
-    if not curr_codes:
-        flash(f'{curr_city} was not found in the US Census data. Please try a different city.','danger')
-        return redirect('/')
-    dest_codes = get_census_codes(dest_city, dest_state)
-    if not dest_codes:
-        flash(f'{dest_city} was not found in the US Census data. Please try a different city.','danger')
-        return redirect('/')
+    curr_lookup = upstream_pool.submit(get_census_codes, curr_city, curr_state)
+    dest_lookup = upstream_pool.submit(get_census_codes, dest_city, dest_state)
 
-    curr_census_data = get_census_data(curr_codes['place'], curr_codes['state'])
-    dest_census_data = get_census_data(dest_codes['place'], dest_codes['state'])
+    deadline = time.monotonic() + UPSTREAM_TIMEOUT
+    curr_codes = wait_for(curr_lookup, None, deadline)
+    dest_codes = wait_for(dest_lookup, None, deadline)
 
-    if curr_census_data['state'] != '00':
-        curr_weather = get_weather(curr_city, curr_abbr)
-    else:
-        curr_weather = {'icon':'01n', 'temp':None}
+    for name, codes in ((curr_city, curr_codes), (dest_city, dest_codes)):
+        if codes is None:
+            flash('The US Census service is not responding right now. Please try again in a moment.','danger')
+            return redirect('/')
+        if not codes:
+            flash(f'{name} was not found in the US Census data. Please try a different city.','danger')
+            return redirect('/')
 
-    if dest_census_data['state'] != '00':
-        dest_weather = get_weather(dest_city, dest_abbr)
-    else:
-        dest_weather = {'icon':'01n', 'temp':None}
-        
-    curr_data = {"name":curr_city,
-                 "abbr": curr_abbr[3:],
-                 "census":curr_census_data, 
-                 "weather":curr_weather}
-    dest_data = {"name":dest_city,
-                 "abbr": dest_abbr[3:],
-                 "census":dest_census_data,
-                 "weather":dest_weather}
+    return redirect(url_for('views.show_comparison', curr=place_id(curr_codes), dest=place_id(dest_codes)), code=303)
+
+@views.route('/cities/compare/<curr>/<dest>')
+@cache_for(60)
+# a cold page reads, locks and writes the comparison (with both cities'
+# census data) and each city's weather, plus the one city_stats check
+@query_budget(12)
+def show_comparison(curr, dest):
+    """ Show data for two cities, given as '<state>-<place>' census codes """
+
+    if not PLACE_ID.fullmatch(curr) or not PLACE_ID.fullmatch(dest):
+        abort(404)
+
+    comparison = load_comparison(curr, dest)
+    if not comparison:
+        return redirect('/')
+
+    curr_data = dict(comparison['curr'])
+    dest_data = dict(comparison['dest'])
 
     if g.user:
-        favorites = [city.id for city in g.user.favorites]
+        is_favorite = User_Favorites.is_favorite(g.user.id, dest_data['census']['place'], dest_data['census']['state'])
     else:
-        favorites = []
+        is_favorite = False
+
+    # The weather shown is at most one weather cache ttl old, so the page
+    # is versioned by which ttl-long window it's in. That's known before
+    # any weather is fetched: revalidations skip the fetch, and first views
+    # are streamed with the same ETag.
+    weather_window = int(time.time() // weather_cache.ttl)
+    etag = page_etag(CENSUS_VINTAGE, curr, dest, weather_window, g.user and g.user.id, is_favorite)
+
+    def render():
+        # weather isn't part of the stored comparison; both cities' run at once
+        curr_weather = upstream_pool.submit(get_weather, curr_data['name'], f"US-{curr_data['abbr']}")
+        dest_weather = upstream_pool.submit(get_weather, dest_data['name'], f"US-{dest_data['abbr']}")
+        deadline = time.monotonic() + UPSTREAM_TIMEOUT
+
+        # census cards first, then the weather and favorite button, each
+        # filled into its place as it's ready
+        if current_app.config['STREAM_PAGES']:
+            def slots():
+                if g.user:
+                    yield 'city-fav-form', is_favorite
+                yield from completed({'curr-weather': curr_weather, 'dest-weather': dest_weather},
+                                     NO_WEATHER, deadline)
+
+            return stream_template('comparison.html', curr=curr_data, dest=dest_data, streaming=True,
+                                   slots=slots(), curr_id=curr, dest_id=dest)
+
+        curr_data['weather'] = wait_for(curr_weather, NO_WEATHER, deadline)
+        dest_data['weather'] = wait_for(dest_weather, NO_WEATHER, deadline)
+        return render_template('comparison.html', curr=curr_data, dest=dest_data,
+                               is_favorite=is_favorite, curr_id=curr, dest_id=dest)
+
+    return conditional(etag, render)
+
+@views.route('/cities/advice/<curr>/<dest>')
+@cache_for(24 * 3600)
+def get_advice(curr, dest):
+    """ Show user quick analysis of two cities """
 
-    session['curr_data'] = curr_data
-    session['dest_data'] = dest_data
+    if not PLACE_ID.fullmatch(curr) or not PLACE_ID.fullmatch(dest):
+        abort(404)
 
-    return render_template('comparison.html', curr=curr_data, dest=dest_data, favorites=favorites)
+    def render():
+        comparison = load_comparison(curr, dest)
+        if not comparison:
+            return redirect('/')
 
-@app.route('/cities/advice')
-def get_advice():
-    """ Show user quick analysis of two cities """
+        results = analyze(comparison['curr'], comparison['dest'])
 
-    curr = session['curr_data']
-    dest = session['dest_data']
+        return render_template('advice.html', results=results,
+                               curr=comparison['curr'], dest=comparison['dest'])
 
-    results = analyze(curr, dest)
+    # advice only changes with the census data, so a revalidation
+    # is answered without looking anything up
+    etag = page_etag(CENSUS_VINTAGE, curr, dest, g.user and g.user.id)
+    return conditional(etag, render, last_modified=CENSUS_RELEASED)
 
-    return render_template('advice.html', results=results, curr=curr, dest=dest)
+@views.route('/cities/compare-many')
+@cache_for(24 * 3600)
+def compare_many():
+    """ Compare one origin city with up to MAX_DESTINATIONS others in one
+        table. origin and each dest are place ids ('12-71000') or
+        'City, State' names.
+    """
 
-@app.route('/map_search')
-def show_search():
-    token = keys.mapbox_token
-    return render_template('map_search.html', token=token)
+    origin = request.args.get('origin', '').strip()
+    dests = [dest.strip() for dest in request.args.getlist('dest') if dest.strip()]
 
+    if not origin:
+        return render_template('compare_many.html', rows=None, max_destinations=MAX_DESTINATIONS)
 
-# ##############################################################################
-# # Turn off all caching in Flask
+    if not dests or len(dests) > MAX_DESTINATIONS:
+        flash(f'Please enter between 1 and {MAX_DESTINATIONS} destinations.', 'danger')
+        return redirect(url_for('views.compare_many'))
+
+    try:
+        origin_codes = resolve_place(origin)
+        dest_codes = [resolve_place(dest) for dest in dests]
+    except Exception as err:
+        log.warning('Place lookup failed: %r', err)
+        flash('The US Census service is not responding right now. Please try again in a moment.','danger')
+        return redirect(url_for('views.compare_many'))
+
+    unknown = [text for text, codes in zip([origin] + dests, [origin_codes] + dest_codes) if not codes]
+    if unknown:
+        flash(f'{", ".join(unknown)} not found in the US Census data. Please try a different city.','danger')
+        return redirect(url_for('views.compare_many'))
+
+    def render():
+        codes = [origin_codes] + dest_codes
+        names = get_place_names(set(codes))
+        census = get_census_data_many(codes)
+
+        origin_data = census.get(origin_codes)
+        if not origin_data or not has_buying_power_data(origin_data):
+            flash(f'No income and home value data is available for {origin}. Please try a different city.','danger')
+            return redirect(url_for('views.compare_many'))
+
+        rows = []
+        for codes in dest_codes:
+            data = census.get(codes)
+            advice = None
+            if data and has_buying_power_data(data):
+                advice = analyze({'census':origin_data}, {'census':data})
+
+            rows.append({'id':place_id({'place':codes[0], 'state':codes[1]}),
+                         'name':names.get(codes),
+                         'census':data,
+                         'advice':advice})
+
+        return render_template('compare_many.html', rows=rows,
+                               origin={'id':place_id(origin_data), 'name':names.get(origin_codes),
+                                       'census':origin_data})
+
+    # like advice, this only changes with the census data
+    etag = page_etag(CENSUS_VINTAGE, origin_codes, tuple(dest_codes), g.user and g.user.id)
+    return conditional(etag, render, last_modified=CENSUS_RELEASED)
+
+@views.route('/cities/recommend')
+@cache_for(3600)
+def recommend_cities():
+    """ Best destinations nationwide for an origin city, by buying-power
+        gain, as JSON. Takes city and state names, plus optional limit
+        and min_pop.
+    """
+
+    city = request.args.get('city', '')
+    state = request.args.get('state', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    min_pop = request.args.get('min_pop', 5000, type=int)
+
+    try:
+        codes = get_census_codes(city, state)
+        origin = codes and get_census_data(codes['place'], codes['state'])
+    except requests.RequestException as err:
+        log.warning('Origin lookup failed: %r', err)
+        return jsonify(message='The US Census service is not responding right now.'), 503
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+    if not codes:
+        return jsonify(message=f'{city} was not found in the US Census data.'), 404
+
+    if not origin or not has_buying_power_data(origin):
+        return jsonify(message=f'No income and home value data is available for {city}.'), 404
+
+    matrix = get_stats_matrix()
+    if not len(matrix):
+        return jsonify(message='City statistics have not been loaded yet.'), 503
+
+    destinations = matrix.rank(int(origin['inc']), int(origin['home']),
+                               limit=limit, min_pop=min_pop,
+                               exclude=(codes['place'], codes['state']))
+
+    # the ranking is vectorized; the wording comes from analyze() for just the winners
+    curr = {'census':origin}
+    for dest in destinations:
+        dest['advice'] = analyze(curr, {'census':dest})
+
+    return jsonify(origin={'city':city, 'state':state, 'census':origin},
+                   destinations=destinations)
+
+@views.route('/api/places/suggest')
+@cache_for(24 * 3600)
+def suggest_places():
+    """ City names starting with q, most populous first, as JSON. Every
+        suggestion is a name the comparison forms can look up.
+    """
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    query = request.args.get('q', '')[:100]
+    limit = request.args.get('limit', 10, type=int)
+
+    suggestions = get_place_index().suggest(query, limit)
+    for place in suggestions:
+        place['id'] = place_id({'place':place.pop('place'), 'state':place.pop('state_code')})
+
+    return jsonify(places=suggestions)
+
+@views.route('/cache/stats')
+def show_cache_stats():
+    """ Hit/miss/eviction counters for this worker's caches """
+
+    return jsonify(census=census_cache.stats(), weather=weather_cache.stats(),
+                   comparison=comparison_cache.stats(), places=places_cache.stats())
+
+@views.route('/upstream/stats')
+def show_upstream_stats():
+    """ Request, retry and latency counters for this worker's API calls """
+
+    return jsonify(api_client.stats())
+
+@views.route('/metrics')
+def show_metrics():
+    """ This worker's request, upstream, db, render and bcrypt timings,
+        for Prometheus
+    """
+
+    return current_app.response_class(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@views.route('/health')
+def health_check():
+    """ For the load balancer; touches nothing """
+
+    return 'ok'
+
+@views.route('/map_search')
+def show_search():
+    token = keys.mapbox_token
+    return render_template('map_search.html', token=token)
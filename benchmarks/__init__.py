@@ -0,0 +1,3 @@
+""" Performance benchmarks. Run from the repo root, e.g.
+    python -m benchmarks.login
+"""
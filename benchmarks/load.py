@@ -0,0 +1,180 @@
+""" Drive a running app at a target request rate and report throughput and
+    p50/p95/p99 latency per route.
+
+    python -m benchmarks.load --url http://127.0.0.1:5000 --rps 20 --duration 30
+
+    Requests are sent on a fixed schedule whether or not earlier ones have
+    finished, and latency is measured from when each was due, so a
+    backed-up server shows up as latency rather than as a lower send rate.
+    A throwaway account is registered at the start for the user and
+    login routes. Run the app against benchmarks/standin.py for
+    repeatable upstream behavior.
+"""
+
+import argparse
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PASSWORD = 'load-test-password'
+
+# city pairs with recorded census profiles in benchmarks/fixtures
+PAIRS = [(('Tampa', 'Florida'), ('Miami', 'Florida')),
+         (('Miami', 'Florida'), ('Tampa', 'Florida'))]
+
+
+class LoadTest:
+    def __init__(self, url, concurrency):
+        self.url = url.rstrip('/')
+        self.results = defaultdict(list)
+        # operations that raised something other than a RequestException
+        self.unexpected = Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.username = f'load-{uuid.uuid4().hex[:12]}'
+        self.user_id = None
+
+    def record(self, route, due, ok):
+        with self.lock:
+            self.results[route].append((time.perf_counter() - due, ok))
+
+    def setup(self):
+        """ Register the test account and find its id """
+
+        session = requests.Session()
+        res = session.post(f'{self.url}/register', data={'username': self.username,
+                                                         'password': PASSWORD,
+                                                         'email': f'{self.username}@example.com',
+                                                         'user-city': 'Tampa',
+                                                         'user-state': 'Florida'})
+        match = re.search(r'/users/(\d+)', res.text)
+        if not match:
+            raise SystemExit(f'Could not register {self.username}: HTTP {res.status_code}')
+        self.user_id = int(match.group(1))
+
+    def login(self, session):
+        page = session.get(f'{self.url}/login')
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page.text)
+        res = session.post(f'{self.url}/login',
+                           data={'username': self.username, 'password': PASSWORD,
+                                 'csrf_token': token.group(1) if token else ''})
+        return res.ok and 'Log out' in res.text
+
+    def logged_in_session(self):
+        """ This thread's logged in session """
+
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.login(self.local.session)
+        return self.local.session
+
+    # Each action is one scheduled user operation, timed from when it was due
+
+    def compare(self, due):
+        session = requests.Session()
+        (curr_city, curr_state), (dest_city, dest_state) = random.choice(PAIRS)
+        res = session.post(f'{self.url}/cities/compare', allow_redirects=False,
+                           data={'curr-city': curr_city, 'curr-state': curr_state,
+                                 'dest-city': dest_city, 'dest-state': dest_state})
+        self.record('POST /cities/compare', due, res.status_code == 303)
+
+        if res.status_code == 303:
+            self.safely('GET /cities/compare/<curr>/<dest>',
+                        lambda start: self.show_comparison(session, res.headers['Location'], start),
+                        time.perf_counter())
+
+    def show_comparison(self, session, url, due):
+        page = session.get(url, allow_redirects=False)
+        self.record('GET /cities/compare/<curr>/<dest>', due, page.status_code == 200)
+
+    def user_page(self, due):
+        res = self.logged_in_session().get(f'{self.url}/users/{self.user_id}', allow_redirects=False)
+        self.record('GET /users/<id>', due, res.status_code == 200)
+
+    def login_action(self, due):
+        self.record('login', due, self.login(requests.Session()))
+
+    def run(self, rps, duration, mix):
+        # each operation with the route its first request is recorded under
+        actions = {'compare': ('POST /cities/compare', self.compare),
+                   'user': ('GET /users/<id>', self.user_page),
+                   'login': ('login', self.login_action)}
+        names = list(mix)
+        weights = [mix[name] for name in names]
+
+        start = time.perf_counter()
+        total = int(rps * duration)
+        futures = []
+        for i in range(total):
+            due = start + i / rps
+            time.sleep(max(0, due - time.perf_counter()))
+            route, action = actions[random.choices(names, weights)[0]]
+            futures.append(self.pool.submit(self.safely, route, action, due))
+
+        self.pool.shutdown(wait=True)
+        for future in futures:
+            if future.exception() is not None:
+                self.unexpected[repr(future.exception())] += 1
+        return time.perf_counter() - start
+
+    def safely(self, route, action, due):
+        """ Run action, recording a failed request under route. Anything
+            else it raises is left on the future for run() to collect.
+        """
+
+        try:
+            action(due)
+        except requests.RequestException:
+            self.record(route, due, False)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(results, elapsed, unexpected):
+    print(f'{"route":<36}{"count":>7}{"errors":>8}{"req/s":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}')
+    for route, samples in sorted(results.items()):
+        latencies = sorted(1000 * seconds for seconds, ok in samples)
+        errors = sum(not ok for seconds, ok in samples)
+        print(f'{route:<36}{len(samples):>7}{errors:>8}{len(samples) / elapsed:>8.1f}'
+              f'{statistics.median(latencies):>9.1f}{percentile(latencies, 0.95):>9.1f}'
+              f'{percentile(latencies, 0.99):>9.1f}')
+
+    if unexpected:
+        print(f'\n{sum(unexpected.values())} operations failed with unexpected errors:')
+        for error, count in unexpected.most_common():
+            print(f'{count:>7}  {error}')
+
+def parse_mix(text):
+    """ 'compare=3,user=1' -> {'compare': 3.0, 'user': 1.0} """
+
+    return {name: float(weight) for name, weight in (part.split('=') for part in text.split(','))}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--rps', type=float, default=10, help='operations started per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=32, help='most operations in flight')
+    parser.add_argument('--mix', type=parse_mix, default='compare=3,user=1,login=1',
+                        help='relative weight of each operation')
+    args = parser.parse_args()
+
+    test = LoadTest(args.url, args.concurrency)
+    test.setup()
+    print(f'{args.rps:g} ops/s for {args.duration:g}s against {args.url} as {test.username}')
+
+    elapsed = test.run(args.rps, args.duration, args.mix)
+    report(test.results, elapsed, test.unexpected)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+""" Login throughput with bcrypt run inline vs in the password pool,
+    and how slow a cheap request (/health) gets during the burst.
+
+    python -m benchmarks.login [--logins 40] [--concurrency 8] [--rounds 10] [--workers 2]
+"""
+
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher, hash_password
+
+
+def probe(client, stop, latencies):
+    """ Time /health requests back to back until stop is set """
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.get('/health')
+        latencies.append(time.perf_counter() - start)
+
+def run(hasher, hashed, logins, concurrency, client):
+    hasher.check(hashed, 'password')   # start the pool before timing
+
+    stop = threading.Event()
+    latencies = []
+    prober = threading.Thread(target=probe, args=(client, stop, latencies))
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as logins_pool:
+        results = list(logins_pool.map(lambda _: hasher.check(hashed, 'password'), range(logins)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    prober.join()
+    assert all(results)
+
+    latencies.sort()
+    return {'logins_per_s': logins / elapsed,
+            'health_p50_ms': 1000 * statistics.median(latencies),
+            'health_p99_ms': 1000 * latencies[int(len(latencies) * 0.99)],
+            'health_requests': len(latencies)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--logins', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8, help='simultaneous logins')
+    parser.add_argument('--rounds', type=int, default=10, help='bcrypt cost factor')
+    parser.add_argument('--workers', type=int, default=2, help='password pool processes')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app()
+    client = app.test_client()
+    hashed = hash_password('password', args.rounds)
+
+    print(f'{args.logins} logins, {args.concurrency} at a time, cost {args.rounds}')
+    for label, workers in (('inline', 0), (f'pool ({args.workers})', args.workers)):
+        hasher = PasswordHasher(rounds=args.rounds, workers=workers)
+        try:
+            result = run(hasher, hashed, args.logins, args.concurrency, client)
+        finally:
+            hasher.shutdown()
+
+        print(f'  {label:<10} {result["logins_per_s"]:7.1f} logins/s   '
+              f'/health p50 {result["health_p50_ms"]:6.2f} ms  p99 {result["health_p99_ms"]:6.2f} ms  '
+              f'({result["health_requests"]} requests)')
+
+
+if __name__ == '__main__':
+    main()
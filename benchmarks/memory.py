@@ -0,0 +1,83 @@
+""" Private memory each worker spends on city stats, loading its own
+    StatsMatrix versus mapping the shared city_stats file.
+
+    python -m benchmarks.memory                     4 workers, 30,000 places
+    python -m benchmarks.memory --workers 8 --places 100000
+
+    The rows are synthetic, so no database is needed. Each worker loads
+    the stats, ranks every place once so all the pages are touched, and
+    reports how much its private (unshared) memory grew. What the mapped
+    workers still grow by is rank()'s temporary arrays, which any ranking
+    needs. Linux only: it reads /proc/self/smaps_rollup.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+
+from recommend import StatsMatrix
+from statstore import StatsStore, write
+
+VINTAGE = '2019'
+
+
+def private_kb():
+    """ This process's private resident memory """
+
+    with open('/proc/self/smaps_rollup') as f:
+        return sum(int(line.split()[1]) for line in f if line.startswith('Private_'))
+
+
+def synthetic_rows(count):
+    rng = random.Random(0)
+    return [(VINTAGE, f'{i % 52:02d}', f'{i:05d}', f'Place {i} city, State {i % 52}',
+             rng.randint(100, 900000), round(rng.uniform(20, 60), 1),
+             rng.randint(20000, 150000), rng.randint(50000, 900000))
+            for i in range(count)]
+
+
+def worker(mode, path, rows, results):
+    before = private_kb()
+    if mode == 'matrix':
+        stats = StatsMatrix([row[1:5] + row[6:] for row in rows])
+    else:
+        stats = StatsStore.open(path, VINTAGE)
+    stats.rank(55000, 250000)
+    results.put(private_kb() - before)
+
+
+def run(mode, path, rows, workers):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(mode, path, rows, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    growth = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return growth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--places', type=int, default=30000)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.places)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'city_stats.bin')
+        write(path, VINTAGE, rows)
+        print(f'{args.places:,} places, file is {os.path.getsize(path) / 1024:,.0f} KiB')
+
+        print(f'{"stats":<10}{"per worker KiB":>16}{"all workers KiB":>18}')
+        for mode in ('matrix', 'mapped'):
+            growth = run(mode, path, rows, args.workers)
+            print(f'{mode:<10}{max(growth):>16,}{sum(growth):>18,}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+""" Micro-benchmarks for the app's hot paths, on recorded census
+    payloads from benchmarks/fixtures, so nothing goes over the network.
+
+    python -m benchmarks.micro                      run everything
+    python -m benchmarks.micro -k census            only names containing 'census'
+    python -m benchmarks.micro --save               record benchmarks/baseline.json
+    python -m benchmarks.micro --baseline           fail if slower than the baseline
+
+    The db benchmarks use DATABASE_URL (as the app does) and are skipped
+    with --no-db. Baselines are per machine; record one before changing
+    anything, then compare against it.
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+BENCHMARKS = {}
+
+def benchmark(name, db=False):
+    """ Register a generator that sets up, yields the function to time,
+        and cleans up after
+    """
+
+    def register(fn):
+        BENCHMARKS[name] = (contextmanager(fn), db)
+        return fn
+    return register
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+class FixtureResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.status_code = 200 if payload is not None else 204
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        pass
+
+
+class FixtureClient:
+    """ Answers census API URLs from fixture files, in place of api_client """
+
+    routes = [
+        (re.compile(r'for=state:\*'), 'census_states.json'),
+        (re.compile(r'for=place:\*&in=state:(\d+)'), 'census_places_{0}.json'),
+        (re.compile(r'/profile\?.*for=place:(\d+)&in=state:(\d+)'), 'census_profile_{1}_{0}.json'),
+    ]
+
+    def __init__(self):
+        self.payloads = {}
+
+    def get(self, url, **kwargs):
+        for pattern, name in self.routes:
+            match = pattern.search(url)
+            if match:
+                name = name.format(*match.groups())
+                if name not in self.payloads:
+                    self.payloads[name] = fixture(name)
+                return FixtureResponse(self.payloads[name])
+        raise LookupError(f'No fixture for {url}')
+
+
+##############################################################################
+# Benchmarks
+
+TAMPA = {'name':'Tampa', 'abbr':'FL',
+         'census':{'pop':'387916', 'age':'35.5', 'inc':'55634', 'home':'244900',
+                   'state':'12', 'place':'71000'},
+         'weather':{'icon':'01d', 'temp':81.3}}
+MIAMI = {'name':'Miami', 'abbr':'FL',
+         'census':{'pop':'454279', 'age':'40.1', 'inc':'44268', 'home':'336900',
+                   'state':'12', 'place':'45000'},
+         'weather':{'icon':'02d', 'temp':84.9}}
+
+@benchmark('analyze')
+def bench_analyze(app_module):
+    yield lambda: app_module.analyze(TAMPA, MIAMI)
+
+@benchmark('census_codes_gazetteer')
+def bench_census_codes_gazetteer(app_module):
+    yield lambda: app_module.get_census_codes('Tampa', 'Florida')
+
+@benchmark('census_codes_api')
+def bench_census_codes_api(app_module):
+    # a place the gazetteer doesn't list falls back to searching the API's place list
+    yield lambda: app_module.fetch_census_codes('Tampa', 'Florida')
+
+@benchmark('suggest_places')
+def bench_suggest_places(app_module):
+    index = app_module.gazetteer.PrefixIndex(app_module.get_places())
+    # three letters is past the precomputed prefixes, so this ranks a range
+    yield lambda: index.suggest('san')
+
+@benchmark('census_data_api')
+def bench_census_data_api(app_module):
+    yield lambda: app_module.fetch_census_data('71000', '12')
+
+@benchmark('census_data_cached')
+def bench_census_data_cached(app_module):
+    key = app_module.census_key('71000', '12')
+    app_module.census_cache.memory.set(key, dict(TAMPA['census']), 3600)
+    yield lambda: app_module.census_cache.get(key)
+
+@benchmark('census_data_store')
+def bench_census_data_store(app_module):
+    from statstore import StatsStore, write
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'city_stats.bin')
+        write(path, '2019', [('2019', '12', '71000', 'Tampa city, Florida', 387916, 35.5, 55634, 244900),
+                             ('2019', '12', '45000', 'Miami city, Florida', 454279, 40.1, 44268, 336900)])
+        store = StatsStore.open(path, '2019')
+        yield lambda: store.lookup('71000', '12')
+
+@benchmark('render_comparison')
+def bench_render_comparison(app_module):
+    with app_module.current_app.test_request_context('/cities/compare/12-71000/12-45000'):
+        app_module.g.user = None
+        yield lambda: app_module.render_template('comparison.html', curr=TAMPA, dest=MIAMI,
+                                                 is_favorite=False, curr_id='12-71000', dest_id='12-45000')
+
+@benchmark('render_user_info')
+def bench_render_user_info(app_module):
+    user = app_module.User(id=1, username='benchmark', email='bench@example.com',
+                           user_city='71000', user_state='12')
+    favorites = [{'id':i, 'city':'Miami', 'state':'Florida', 'stats':MIAMI['census']}
+                 for i in range(10)]
+
+    with app_module.current_app.test_request_context('/users/1'):
+        app_module.g.user = user
+        yield lambda: app_module.render_template('user_info.html', favorites=favorites, user=user,
+                                                 user_city='Tampa', user_state='Florida')
+
+@contextmanager
+def temporary_user(app_module):
+    """ A user row that's rolled back afterwards """
+
+    db = app_module.db
+    user = app_module.User(username='benchmark-user', password='x', email='bench@example.com',
+                           user_city='71000', user_state='12')
+    db.session.add(user)
+    db.session.flush()
+    try:
+        yield user.id
+    finally:
+        db.session.rollback()
+        app_module.user_cache.clear()
+
+@benchmark('load_user_db', db=True)
+def bench_load_user_db(app_module):
+    with temporary_user(app_module) as user_id:
+        def load():
+            app_module.user_cache.delete(user_id)
+            app_module.db.session.expunge_all()
+            return app_module.load_user(user_id)
+        yield load
+
+@benchmark('load_user_cached', db=True)
+def bench_load_user_cached(app_module):
+    with temporary_user(app_module) as user_id:
+        app_module.load_user(user_id)
+
+        def load():
+            app_module.db.session.expunge_all()
+            return app_module.load_user(user_id)
+        yield load
+
+
+##############################################################################
+# Runner
+
+def measure(fn, rounds, min_round_time):
+    """ Seconds per call for each of `rounds` rounds. Each round makes
+        enough calls to take at least min_round_time.
+    """
+
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_round_time:
+            break
+        number *= 2
+
+    times = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return times
+
+def summarize(times):
+    times = sorted(times)
+    return {'ops_per_s': round(1 / statistics.median(times), 1),
+            'p50_us': round(1e6 * statistics.median(times), 2),
+            'p99_us': round(1e6 * times[min(len(times) - 1, int(len(times) * 0.99))], 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-k', dest='pattern', default='', help='only benchmarks whose name contains this')
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--min-round-time', type=float, default=0.02, help='seconds')
+    parser.add_argument('--no-db', action='store_true', help='skip benchmarks that need the database')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help='write results as the baseline')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed ops/s drop vs the baseline before failing (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    import app as app_module
+    web = app_module.create_app()
+    app_module.api_client = FixtureClient()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f'{"benchmark":<26}{"ops/s":>12}{"p50 us":>12}{"p99 us":>12}{"vs baseline":>14}')
+
+    with web.app_context():
+        for name, (setup, needs_db) in BENCHMARKS.items():
+            if args.pattern not in name or (needs_db and args.no_db):
+                continue
+
+            with setup(app_module) as fn:
+                result = results[name] = summarize(measure(fn, args.rounds, args.min_round_time))
+
+            change = ''
+            if name in baseline:
+                ratio = result['ops_per_s'] / baseline[name]['ops_per_s']
+                change = f'{ratio - 1:+.1%}'
+                if ratio < 1 - args.tolerance:
+                    regressions.append(name)
+                    change += ' !!'
+
+            print(f'{name:<26}{result["ops_per_s"]:>12,.1f}{result["p50_us"]:>12,.2f}'
+                  f'{result["p99_us"]:>12,.2f}{change:>14}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.save}')
+
+    if regressions:
+        print(f'REGRESSION: {", ".join(regressions)} slower than the baseline '
+              f'by more than {args.tolerance:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+""" Local stand-in for api.census.gov and api.openweathermap.org, replaying
+    the payloads in benchmarks/fixtures with configurable latency, jitter
+    and injected errors.
+
+    python -m benchmarks.standin [--latency 80] [--jitter 40] [--error-rate 0.02]
+
+    then start the app with the URLs it prints:
+
+    CENSUS_API=http://127.0.0.1:8801 WEATHER_API=http://127.0.0.1:8802 flask run
+
+    Census places without a recorded profile answer 204, as the real API
+    does for unknown places. Every city gets the recorded weather, renamed.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.micro import fixture
+
+# payloads are only read, so every response can share one copy
+fixture = lru_cache(maxsize=None)(fixture)
+
+
+class Behavior:
+    """ Latency and failures added to every response """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+        # seconds
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+def census_response(path, query):
+    """ Payload for a census API request, or None for a 204 """
+
+    places_in = re.fullmatch(r'state:(\d+)', query.get('in', ''))
+    wanted = query.get('for', '')
+
+    if wanted == 'state:*':
+        return fixture('census_states.json')
+
+    if not places_in or not wanted.startswith('place:'):
+        return None
+    state = places_in.group(1)
+    codes = wanted[len('place:'):]
+
+    if path.endswith('/profile'):
+        if codes == '*':
+            return None
+        # one row per recorded place, as the API answers for place:a,b,...
+        header, rows = None, []
+        for code in codes.split(','):
+            try:
+                header, *place_rows = fixture(f'census_profile_{state}_{code}.json')
+            except FileNotFoundError:
+                continue
+            rows += place_rows
+        return [header] + rows if rows else None
+
+    try:
+        header, *rows = fixture(f'census_places_{state}.json')
+    except FileNotFoundError:
+        return None
+
+    if codes != '*':
+        rows = [row for row in rows if row[2] in codes.split(',')]
+    return [header] + rows if rows else None
+
+def weather_response(query):
+    city = query.get('q', '').split(',')[0]
+    return dict(fixture('weather.json'), name=city)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        behavior = self.server.behavior
+        time.sleep(behavior.delay())
+
+        if behavior.fails():
+            return self.send_json(behavior.error_status, {'error': 'injected failure'})
+
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/data/2.5/weather':
+            payload = weather_response(query)
+        elif url.path.startswith('/data/'):
+            payload = census_response(url.path, query)
+        else:
+            return self.send_json(404, {'error': 'unknown endpoint'})
+
+        if payload is None:
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_json(200, payload)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, behavior):
+    """ Start a stand-in server on a background thread; returns the server """
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+    server.behavior = behavior
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--census-port', type=int, default=8801)
+    parser.add_argument('--weather-port', type=int, default=8802)
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- ms of random latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    behavior = Behavior(args.latency / 1000, args.jitter / 1000,
+                        args.error_rate, args.error_status, args.seed)
+    # one port per API, so the app keeps separate timeouts and stats for each
+    census = serve(args.census_port, behavior)
+    weather = serve(args.weather_port, behavior)
+
+    print(f'CENSUS_API=http://127.0.0.1:{census.server_port} '
+          f'WEATHER_API=http://127.0.0.1:{weather.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
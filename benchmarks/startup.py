@@ -0,0 +1,61 @@
+""" Time a cold start of the app under each profile: importing app.py
+    and running create_app in a fresh interpreter, then serving its
+    first request.
+
+    python -m benchmarks.startup                    every profile, 10 runs each
+    python -m benchmarks.startup --profile prod --runs 20
+
+    Nothing connects to the database during import; the first request
+    is /health, which touches nothing either, so this measures the app's
+    own startup rather than Postgres.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+web = app.create_app()
+imported = time.perf_counter()
+web.test_client().get('/health')
+served = time.perf_counter()
+print(json.dumps({'import_ms': 1000 * (imported - start),
+                  'first_request_ms': 1000 * (served - imported),
+                  'modules': len(sys.modules)}))
+'''
+
+
+def cold_start(profile):
+    """ One fresh interpreter's timings """
+
+    output = subprocess.run([sys.executable, '-c', SCRIPT], check=True, capture_output=True,
+                            text=True, cwd=ROOT, env=dict(os.environ, APP_PROFILE=profile)).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--profile', action='append', choices=('dev', 'test', 'prod'),
+                        help='profiles to time (default: all)')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"profile":<10}{"import ms p50":>15}{"max":>10}{"1st request ms":>17}{"modules":>10}')
+    for profile in args.profile or ('dev', 'test', 'prod'):
+        runs = [cold_start(profile) for _ in range(args.runs)]
+        imports = [run['import_ms'] for run in runs]
+        print(f'{profile:<10}{statistics.median(imports):>15,.1f}{max(imports):>10,.1f}'
+              f'{statistics.median(run["first_request_ms"] for run in runs):>17,.1f}'
+              f'{runs[-1]["modules"]:>10}')
+
+
+if __name__ == '__main__':
+    main()
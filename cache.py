@@ -0,0 +1,375 @@
+""" In-memory and persistent caches for external API results """
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+log = logging.getLogger(__name__)
+
+# Returned by get() on a miss, so a cached None ("not found") is still a hit
+MISSING = object()
+
+
+class LRUCache:
+    """ Size-limited in-memory cache with a per-entry expiry time """
+
+    def __init__(self, maxsize=1024, grace=0):
+        self.maxsize = maxsize
+        # seconds expired entries are kept for get_stale()
+        self.grace = grace
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ Return the value for key, or MISSING if absent or expired """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+
+            expires, value = entry
+            if expires <= time.time():
+                if expires + self.grace <= time.time():
+                    del self.entries[key]
+                    self.expirations += 1
+                return MISSING
+
+            self.entries.move_to_end(key)
+            return value
+
+    def get_stale(self, key):
+        """ (value, expires) for key, including entries expired less than
+            grace seconds ago, or MISSING
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] + self.grace <= time.time():
+                return MISSING
+
+            expires, value = entry
+            return value, expires
+
+    def set(self, key, value, ttl):
+        """ Store value for ttl seconds, evicting the least recently used
+            entries once the cache is full
+        """
+
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SingleFlight:
+    """ Runs at most one call per key at a time. Callers arriving while
+        a call for their key is in flight wait for it and share its result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def run(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class TieredCache:
+    """ LRU memory tier in front of an optional persistent store.
+
+        The store needs load(key) -> (value, expires datetime) or None,
+        and save(key, value, expires); if it also has a locked(key)
+        context manager, misses are filled under it so only one process
+        fetches a key at a time. locked() gives whether it had to wait
+        for the lock, which is when the store is worth reading again. None values are negative entries
+        ("not found") and, like anything is_negative() flags, are kept
+        for negative_ttl instead of ttl.
+
+        With stale_ttl, get_or_fetch() answers a miss on an entry that
+        expired less than stale_ttl ago with the old value straight away,
+        and refreshes it on refresh_pool. A failed refresh leaves the old
+        value in place, so pages keep working through an upstream outage.
+    """
+
+    def __init__(self, memory, store=None, ttl=3600, negative_ttl=600, is_negative=None,
+                 stale_ttl=0, refresh_pool=None):
+        self.memory = memory
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative or (lambda value: False)
+        self.stale_ttl = stale_ttl
+        self.refresh_pool = refresh_pool
+        self.memory.grace = max(self.memory.grace, stale_ttl)
+        self.flights = SingleFlight()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'store_hits': 0, 'misses': 0,
+                       'negative_hits': 0, 'store_errors': 0,
+                       'stale_hits': 0, 'refreshes': 0, 'refresh_errors': 0}
+        self.store_error_logged = False
+
+    def count(self, name):
+        # called from request, upstream and refresh threads at once
+        with self.lock:
+            self.counts[name] += 1
+
+    def store_error(self, err):
+        """ Count a failed store call, logging the first. A store that
+            keeps failing (say its table was never created) leaves only
+            the memory tier and no cross-worker lock, so it shouldn't be
+            just a counter.
+        """
+
+        self.count('store_errors')
+        if not self.store_error_logged:
+            self.store_error_logged = True
+            table = getattr(self.store, '__tablename__', self.store)
+            log.error('Cache store %s failed, falling back to memory (if the table is missing, '
+                      'run flask upgrade-db): %s', table, err)
+
+    def get(self, key):
+        """ Look in memory, then the store. Returns MISSING on a miss. """
+
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self.count('hits')
+        else:
+            value = self.load(key)
+            if value is MISSING:
+                self.count('misses')
+                return MISSING
+            self.count('store_hits')
+
+        if value is None or self.is_negative(value):
+            self.count('negative_hits')
+        return value
+
+    def get_many(self, keys):
+        """ get() for several keys, reading the store once for all the
+            memory misses. Returns {key: value}, leaving out misses.
+        """
+
+        values = {}
+        pending = []
+        for key in keys:
+            value = self.memory.get(key)
+            if value is MISSING:
+                pending.append(key)
+            else:
+                self.count('hits')
+                values[key] = value
+
+        rows = {}
+        if pending and self.store is not None:
+            try:
+                rows = self.store.load_many(pending)
+            except SQLAlchemyError as err:
+                self.store_error(err)
+
+        for key in pending:
+            value = self.remember(key, rows.get(tuple(key)))
+            if value is MISSING:
+                self.count('misses')
+            else:
+                self.count('store_hits')
+                values[key] = value
+
+        for value in values.values():
+            if value is None or self.is_negative(value):
+                self.count('negative_hits')
+        return values
+
+    def load(self, key):
+        """ Read key from the store, copying it into memory if still fresh """
+
+        if self.store is None:
+            return MISSING
+
+        try:
+            row = self.store.load(key)
+        except SQLAlchemyError as err:
+            self.store_error(err)
+            return MISSING
+
+        return self.remember(key, row)
+
+    def remember(self, key, row):
+        """ Copy a store row into memory. Returns its value, or MISSING if
+            there's no row or it has expired; an expired row is still kept
+            for get_stale() if it's within stale_ttl.
+        """
+
+        if row is None:
+            return MISSING
+
+        value, expires = row
+        remaining = (expires - datetime.utcnow()).total_seconds()
+        if remaining <= 0:
+            if remaining + self.stale_ttl > 0:
+                self.memory.set(key, value, remaining)
+            return MISSING
+
+        self.memory.set(key, value, remaining)
+        return value
+
+    def get_stale(self, key):
+        """ The value for key if it expired less than stale_ttl ago,
+            else MISSING. Only meaningful after get() has missed, which
+            brings a stale store row into memory.
+        """
+
+        if not self.stale_ttl:
+            return MISSING
+
+        entry = self.memory.get_stale(key)
+        if entry is MISSING:
+            return MISSING
+
+        value, expires = entry
+        if expires + self.stale_ttl <= time.time():
+            return MISSING
+
+        self.count('stale_hits')
+        return value
+
+    def refresh(self, key, fetch):
+        """ Fetch and cache key on refresh_pool, unless that's already underway """
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.fill(key, fetch)
+                self.count('refreshes')
+            except Exception:
+                self.count('refresh_errors')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        if self.refresh_pool is None:
+            run()
+        else:
+            self.refresh_pool.submit(run)
+
+    def set(self, key, value):
+        """ Cache value in both tiers """
+
+        ttl = self.negative_ttl if value is None or self.is_negative(value) else self.ttl
+        self.memory.set(key, value, ttl)
+
+        if self.store is not None:
+            try:
+                self.store.save(key, value, datetime.utcnow() + timedelta(seconds=ttl))
+            except SQLAlchemyError as err:
+                self.store_error(err)
+
+    def set_many(self, values):
+        """ set() for a dict of key: value, writing the store once """
+
+        expiries = []
+        for key, value in values.items():
+            ttl = self.negative_ttl if value is None or self.is_negative(value) else self.ttl
+            self.memory.set(key, value, ttl)
+            expiries.append((key, value, datetime.utcnow() + timedelta(seconds=ttl)))
+
+        if self.store is not None and expiries:
+            try:
+                self.store.save_many(expiries)
+            except SQLAlchemyError as err:
+                self.store_error(err)
+
+    def get_or_fetch(self, key, fetch):
+        """ Return the cached value for key, calling fetch() to fill a miss.
+            Concurrent misses for the same key share one fetch() call.
+        """
+
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        value = self.get_stale(key)
+        if value is not MISSING:
+            self.refresh(key, fetch)
+            return value
+
+        return self.flights.run(key, lambda: self.fill(key, fetch))
+
+    def fill(self, key, fetch):
+        """ Fetch and cache key after a miss, unless another process
+            filled it while we waited for the lock
+        """
+
+        with ExitStack() as stack:
+            waited = False
+            if hasattr(self.store, 'locked'):
+                # without the lock we may fetch twice, which is still better than failing
+                try:
+                    waited = stack.enter_context(self.store.locked(key))
+                except SQLAlchemyError as err:
+                    self.store_error(err)
+
+            # the miss that got us here already read the store
+            value = self.load(key) if waited else MISSING
+            if value is MISSING:
+                value = fetch()
+                self.set(key, value)
+            return value
+
+    def stats(self):
+        """ Counters for sizing the cache """
+
+        return dict(self.counts,
+                    coalesced=self.flights.coalesced,
+                    size=len(self.memory),
+                    maxsize=self.memory.maxsize,
+                    evictions=self.memory.evictions,
+                    expirations=self.memory.expirations)
@@ -0,0 +1,278 @@
+""" Local index of census place codes, built from the FIPS geocode table """
+
+import bisect
+import csv
+import gzip
+import heapq
+import io
+import os
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'data', 'places.tsv.gz')
+GEOCODES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Reference-files', 'all-geocodes-v2020.xlsx')
+
+# State name -> (FIPS code, postal abbreviation), as listed by the ACS
+STATES = {
+    'Alabama': ('01', 'AL'), 'Alaska': ('02', 'AK'), 'Arizona': ('04', 'AZ'),
+    'Arkansas': ('05', 'AR'), 'California': ('06', 'CA'), 'Colorado': ('08', 'CO'),
+    'Connecticut': ('09', 'CT'), 'Delaware': ('10', 'DE'),
+    'District of Columbia': ('11', 'DC'), 'Florida': ('12', 'FL'),
+    'Georgia': ('13', 'GA'), 'Hawaii': ('15', 'HI'), 'Idaho': ('16', 'ID'),
+    'Illinois': ('17', 'IL'), 'Indiana': ('18', 'IN'), 'Iowa': ('19', 'IA'),
+    'Kansas': ('20', 'KS'), 'Kentucky': ('21', 'KY'), 'Louisiana': ('22', 'LA'),
+    'Maine': ('23', 'ME'), 'Maryland': ('24', 'MD'), 'Massachusetts': ('25', 'MA'),
+    'Michigan': ('26', 'MI'), 'Minnesota': ('27', 'MN'), 'Mississippi': ('28', 'MS'),
+    'Missouri': ('29', 'MO'), 'Montana': ('30', 'MT'), 'Nebraska': ('31', 'NE'),
+    'Nevada': ('32', 'NV'), 'New Hampshire': ('33', 'NH'), 'New Jersey': ('34', 'NJ'),
+    'New Mexico': ('35', 'NM'), 'New York': ('36', 'NY'),
+    'North Carolina': ('37', 'NC'), 'North Dakota': ('38', 'ND'), 'Ohio': ('39', 'OH'),
+    'Oklahoma': ('40', 'OK'), 'Oregon': ('41', 'OR'), 'Pennsylvania': ('42', 'PA'),
+    'Rhode Island': ('44', 'RI'), 'South Carolina': ('45', 'SC'),
+    'South Dakota': ('46', 'SD'), 'Tennessee': ('47', 'TN'), 'Texas': ('48', 'TX'),
+    'Utah': ('49', 'UT'), 'Vermont': ('50', 'VT'), 'Virginia': ('51', 'VA'),
+    'Washington': ('53', 'WA'), 'West Virginia': ('54', 'WV'),
+    'Wisconsin': ('55', 'WI'), 'Wyoming': ('56', 'WY'), 'Puerto Rico': ('72', 'PR'),
+}
+STATE_NAMES = {code: name for name, (code, abbr) in STATES.items()}
+
+# Legal/statistical area descriptions the census appends to place names,
+# longest first so 'metro government' wins over 'government'
+SUFFIXES = sorted([
+    'city', 'town', 'village', 'borough', 'township', 'municipality', 'cdp',
+    'corporation', 'city and borough', 'unified government',
+    'consolidated government', 'metropolitan government', 'metro government',
+], key=len, reverse=True)
+
+# Geocoder names that don't match the census name once the suffix is gone
+ALIASES = {
+    # Bug in the geocoder lists New York as New York City. Grr.
+    ('new york city', '36'): 'new york',
+    ('honolulu', '15'): 'urban honolulu',
+    ('nashville', '47'): 'nashville-davidson',
+    ('louisville', '21'): 'louisville/jefferson county',
+    ('athens', '13'): 'athens-clarke county',
+    ('augusta', '13'): 'augusta-richmond county',
+}
+
+
+def normalize(name):
+    """ Lowercase a place name and collapse its whitespace """
+
+    return ' '.join(name.split()).lower()
+
+
+def display_name(area_name):
+    """ Area name without its census description, as shown to users,
+        e.g. 'Indianapolis city (balance)' -> 'Indianapolis'
+    """
+
+    name = ' '.join(area_name.split())
+    if name.endswith(' (balance)'):
+        name = name[:-len(' (balance)')]
+
+    for suffix in SUFFIXES:
+        if name.lower().endswith(' ' + suffix):
+            return name[:-len(suffix) - 1]
+
+    return name
+
+
+def place_keys(area_name):
+    """ All normalized names a census area name should be found under,
+        e.g. 'El Paso de Robles (Paso Robles) city' ->
+        ['el paso de robles (paso robles)', 'el paso de robles', 'paso robles', ...]
+    """
+
+    name = normalize(display_name(area_name))
+
+    keys = [name]
+    # 'Fredonia (Biscoe)' can be searched as either name
+    if name.endswith(')') and ' (' in name:
+        main, alt = name[:-1].split(' (', 1)
+        keys += [main, alt]
+
+    # what the old rsplit lookup matched on, so existing searches keep working
+    keys.append(normalize(area_name.rsplit(' ', 1)[0]))
+
+    return keys
+
+
+class Gazetteer:
+    """ In-memory (city, state) -> census codes index """
+
+    def __init__(self, rows):
+        """ rows are (state code, place code, area name, state abbr) tuples """
+
+        self.codes = {}
+        self.names = {}
+
+        # exact names claim their key before any alternate spellings do
+        derived = []
+        for state_code, place_code, area_name, abbr in rows:
+            self.names[(place_code, state_code)] = display_name(area_name)
+            primary, *others = place_keys(area_name)
+            self.codes.setdefault((primary, state_code), place_code)
+            derived += [((key, state_code), place_code) for key in others]
+
+        for key, place_code in derived:
+            self.codes.setdefault(key, place_code)
+
+        for (alias, state_code), target in ALIASES.items():
+            if (target, state_code) in self.codes:
+                self.codes.setdefault((alias, state_code), self.codes[(target, state_code)])
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        """ Read the index from its gzipped TSV file """
+
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            return cls(tuple(row) for row in csv.reader(f, delimiter='\t',
+                                                         quoting=csv.QUOTE_NONE))
+
+    def lookup(self, city, state):
+        """ Get state and place codes for a city and state name.
+            Returns False if either isn't in the index.
+        """
+
+        if state not in STATES:
+            return False
+
+        state_code = STATES[state][0]
+        place_code = self.codes.get((normalize(city), state_code))
+
+        if place_code is None:
+            return False
+
+        return {'place': place_code, 'state': state_code}
+
+    def name(self, place, state):
+        """ City name, state name and state abbreviation for census codes,
+            or None if not indexed
+        """
+
+        if (place, state) not in self.names:
+            return None
+
+        state_name = STATE_NAMES[state]
+        return {'city': self.names[(place, state)], 'state': state_name,
+                'abbr': STATES[state_name][1]}
+
+
+class PrefixIndex:
+    """ Gazetteer place names searchable by prefix, biggest places first.
+        Only names that Gazetteer.lookup() resolves back to the same place
+        are listed, so any suggestion can be compared.
+    """
+
+    def __init__(self, places, population=None, limit=10, cached_length=2):
+        """ population maps (place, state) codes to a head count; places
+            without one sort last. Results for prefixes up to
+            cached_length characters are worked out up front, since their
+            ranges are too long to rank per request.
+        """
+
+        population = population or {}
+        self.limit = limit
+        self.cached_length = cached_length
+
+        entries = []
+        for (place_code, state_code), city in places.names.items():
+            key = normalize(city)
+            if places.codes.get((key, state_code)) != place_code:
+                continue
+            entries.append((key, population.get((place_code, state_code), 0),
+                            city, state_code, place_code))
+        entries.sort()
+
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+
+        self.top = {}
+        by_prefix = {}
+        for i, entry in enumerate(entries):
+            for length in range(1, min(cached_length, len(entry[0])) + 1):
+                by_prefix.setdefault(entry[0][:length], []).append(i)
+        for prefix, indexes in by_prefix.items():
+            self.top[prefix] = self.best(indexes, limit)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def best(self, indexes, limit):
+        """ The limit most populous entries, biggest first """
+
+        return heapq.nlargest(limit, indexes, key=lambda i: self.entries[i][1])
+
+    def suggest(self, text, limit=None):
+        """ Places whose name starts with text, as dicts of city, state,
+            abbr, place and pop. 'Spring, Il' narrows the matches to
+            states whose name or abbreviation starts with 'il'.
+        """
+
+        limit = min(limit or self.limit, self.limit)
+        city, _, state = text.partition(',')
+        prefix, state = normalize(city), normalize(state)
+        if not prefix:
+            return []
+
+        if not state and prefix in self.top:
+            best = self.top[prefix][:limit]
+        else:
+            start = bisect.bisect_left(self.keys, prefix)
+            # every key starting with prefix sorts before prefix + '\uffff'
+            end = bisect.bisect_left(self.keys, prefix + '\uffff', start)
+            indexes = range(start, end)
+            if state:
+                indexes = [i for i in indexes if state_matches(self.entries[i][3], state)]
+            best = self.best(indexes, limit)
+
+        results = []
+        for i in best:
+            key, pop, city, state_code, place_code = self.entries[i]
+            state_name = STATE_NAMES[state_code]
+            results.append({'city': city, 'state': state_name, 'abbr': STATES[state_name][1],
+                            'place': place_code, 'state_code': state_code, 'pop': pop})
+        return results
+
+
+def state_matches(state_code, text):
+    """ Whether a state's name or postal abbreviation starts with text """
+
+    name = STATE_NAMES[state_code]
+    return name.lower().startswith(text) or STATES[name][1].lower() == text
+
+
+def build(xlsx_path=GEOCODES_PATH, out_path=GAZETTEER_PATH):
+    """ Convert the FIPS geocode spreadsheet into the gazetteer file.
+        Needs openpyxl, which is only used here and not at runtime.
+        Returns the number of places written.
+    """
+
+    try:
+        import openpyxl
+    except ImportError:
+        raise RuntimeError('Building the gazetteer requires openpyxl (pip install openpyxl)')
+
+    workbook = openpyxl.load_workbook(xlsx_path, read_only=True)
+    rows = []
+    for state_code, place_code, area_name, abbr in workbook.active.iter_rows(values_only=True):
+        # skip the title block and column headings
+        if not (state_code and place_code and area_name) or not place_code.isdigit():
+            continue
+        # a few names were truncated at a comma upstream, leaving a stray quote
+        rows.append((state_code, place_code, area_name.replace('"', '').strip(), abbr))
+    rows.sort()
+
+    buf = io.StringIO()
+    csv.writer(buf, delimiter='\t', lineterminator='\n',
+               quoting=csv.QUOTE_NONE).writerows(rows)
+
+    # mtime=0 keeps the file byte-identical between rebuilds
+    with open(out_path, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+        gz.write(buf.getvalue().encode('utf-8'))
+
+    return len(rows)
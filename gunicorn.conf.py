@@ -0,0 +1,21 @@
+""" gunicorn settings, read from the working directory by gunicorn 'app:create_app()' """
+
+import os
+
+# set before the app is imported, so create_app picks the production profile
+os.environ.setdefault('APP_PROFILE', 'prod')
+
+# Import the app once in the master and fork the workers from it, so they
+# boot without importing anything. Nothing connects to the database at
+# import, and app.check_pid makes each worker open its own connections.
+preload_app = True
+
+
+def when_ready(server):
+    """ With the app preloaded, read the gazetteer in the master too, so
+        the workers inherit it instead of each loading their own
+    """
+
+    if server.cfg.preload_app:
+        import app
+        app.get_places()
@@ -0,0 +1,83 @@
+""" Bulk download ACS profile data for every census place into city_stats """
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from gazetteer import STATES
+from models import City_Stats
+
+
+class IngestError(Exception):
+    """ The download was incomplete, so the existing rows were kept """
+
+
+def parse_value(value, cast):
+    """ Census value as a number, or None where the census has no data
+        (missing, or one of its negative annotation codes like -888888888)
+    """
+
+    if value is None or value == '':
+        return None
+
+    number = cast(float(value))
+    if number < 0:
+        return None
+
+    return number
+
+
+def fetch_state(client, vintage, variables, state_code, api='https://api.census.gov'):
+    """ Rows for every place in one state, in City_Stats.columns order """
+
+    res = client.get(
+        f'{api}/data/{vintage}/acs/acs5/profile?get=NAME,{",".join(variables.values())}&for=place:*&in=state:{state_code}'
+    )
+    # no places in this state for this vintage
+    if res.status_code == 204:
+        return []
+    res.raise_for_status()
+
+    header, *places = res.json()
+    index = {name: header.index(name) for name in header}
+
+    rows = []
+    for item in places:
+        rows.append((vintage,
+                     item[index['state']],
+                     item[index['place']],
+                     item[index['NAME']],
+                     parse_value(item[index[variables['pop']]], int),
+                     parse_value(item[index[variables['age']]], float),
+                     parse_value(item[index[variables['inc']]], int),
+                     parse_value(item[index[variables['home']]], int)))
+
+    return rows
+
+
+def ingest(client, vintage, variables, workers=8, echo=print, api='https://api.census.gov'):
+    """ Download every state in parallel, then replace the vintage's rows
+        in city_stats in one COPY. Nothing is written unless every state
+        downloaded with at least one place; otherwise raises IngestError.
+        Returns the number of places loaded.
+    """
+
+    rows = []
+    empty = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        downloads = {pool.submit(fetch_state, client, vintage, variables, code, api): name
+                     for name, (code, abbr) in STATES.items()}
+
+        for done, future in enumerate(as_completed(downloads), 1):
+            state_rows = future.result()
+            rows += state_rows
+            if not state_rows:
+                empty.append(downloads[future])
+            echo(f'  [{done}/{len(downloads)}] {downloads[future]}: {len(state_rows)} places')
+
+    # every state has places, so an empty one means the census didn't answer properly
+    if empty:
+        raise IngestError(f'No places for {len(empty)} of {len(STATES)} states '
+                          f'({", ".join(sorted(empty)[:5])}{", ..." if len(empty) > 5 else ""}); '
+                          f'kept the existing {vintage} rows')
+
+    City_Stats.replace_vintage(vintage, rows)
+    return len(rows)
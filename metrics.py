@@ -0,0 +1,197 @@
+""" Request timing breakdowns and Prometheus-format metrics """
+
+import bisect
+import contextvars
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds. Covers a cached page (a few ms) up to an upstream timeout.
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Characters a Server-Timing metric name (an HTTP token) can't have
+NOT_TOKEN = re.compile(r"[^!#$%&'*+.^_`|~0-9A-Za-z-]")
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value:g}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_values, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {counts[-1]:g}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Collected:
+    """ Values read from elsewhere when metrics are rendered.
+        collect() returns {label values: value}.
+    """
+
+    def __init__(self, name, help, collect, labels=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = labels
+        self.type = type
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for label_values, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value:g}')
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimings:
+    """ Where one request's time went: seconds and call count per kind
+        of work. Work done in parallel is added up, so the parts can
+        sum to more than the request took.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = defaultdict(lambda: [0.0, 0])
+        # name -> what it is, like an upstream's host, for Server-Timing's desc
+        self.descriptions = {}
+        # SQL statement text -> times run, to spot the same query in a loop
+        self.statements = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, desc=None):
+        with self.lock:
+            span = self.spans[name]
+            span[0] += seconds
+            span[1] += 1
+            if desc:
+                self.descriptions[name] = desc
+
+    def count(self, name):
+        with self.lock:
+            return self.spans[name][1] if name in self.spans else 0
+
+    def query(self, statement):
+        with self.lock:
+            self.statements[statement] += 1
+
+    def repeated(self, times):
+        """ Statements run at least `times` times, most repeated first """
+
+        with self.lock:
+            return sorted(((statement, count) for statement, count in self.statements.items()
+                           if count >= times), key=lambda item: -item[1])
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """ Server-Timing header value, durations in ms. Names are made
+            into tokens; anything else about a span goes in its desc.
+        """
+
+        parts = []
+        with self.lock:
+            for name, (seconds, count) in self.spans.items():
+                desc = f'{self.descriptions[name]} {count}x' if name in self.descriptions else f'{count}x'
+                parts.append(f'{NOT_TOKEN.sub("-", name)};dur={1000 * seconds:.1f};desc="{desc}"')
+        parts.append(f'total;dur={1000 * self.elapsed():.1f}')
+        return ', '.join(parts)
+
+
+# The RequestTimings for the request being handled, if any
+current = contextvars.ContextVar('request_timings', default=None)
+
+def record(name, seconds, desc=None):
+    """ Charge seconds to name on the current request, if there is one """
+
+    timings = current.get()
+    if timings is not None:
+        timings.add(name, seconds, desc)
+
+
+def record_query(statement):
+    """ Count a SQL statement against the current request, if there is one """
+
+    timings = current.get()
+    if timings is not None:
+        timings.query(statement)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ ThreadPoolExecutor whose tasks run in the submitter's context,
+        so work done on the pool is charged to the request that asked
+        for it
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
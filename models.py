@@ -1,10 +1,18 @@
 """ SQLAlchemy models for reloc_asst """
 
-from flask_bcrypt import Bcrypt
+import csv
+import io
+import threading
+import zlib
+from contextlib import contextmanager
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from passwords import PasswordHasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
+passwords = PasswordHasher()
 
 def connect_db(app):
     """ Connect db to Flask app """
@@ -50,6 +58,24 @@ class User(db.Model):
         nullable=False
     )
 
+    # Home city display data, saved when the city is set
+    # so pages showing it don't have to ask the census again
+    city_name = db.Column(
+        db.Text
+    )
+
+    state_name = db.Column(
+        db.Text
+    )
+
+    abbr = db.Column(
+        db.Text
+    )
+
+    city_stats = db.Column(
+        db.JSON
+    )
+
     favorites = db.relationship('User_Favorites', cascade="all,delete", backref='users')
 
     def __repr__(self):
@@ -60,7 +86,7 @@ class User(db.Model):
     def register(cls, username, password, email, city, state):
         """ Create account for user, add to db """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -82,13 +108,27 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """ Whether password is this user's. A password hashed at an old
+            cost factor is rehashed at the current one; call
+            db.session.commit() afterwards to save it.
+        """
+
+        if not passwords.check(self.password, password):
+            return False
+
+        if passwords.needs_rehash(self.password):
+            self.set_password(password)
+        return True
+
+    def set_password(self, password):
+        self.password = passwords.hash(password)
+
 class User_Favorites(db.Model):
     """ Map users to cities they have favorited """
 
@@ -119,5 +159,404 @@ class User_Favorites(db.Model):
         db.Text
     )
 
+    # Display data saved with the favorite, like User's home city
+    city_name = db.Column(
+        db.Text
+    )
+
+    state_name = db.Column(
+        db.Text
+    )
+
+    city_stats = db.Column(
+        db.JSON
+    )
+
+    # one row per user and city, and the index every favorites lookup uses
+    __table_args__ = (
+        db.Index('ix_favorites_user_place', 'user_id', 'state_id', 'city_id', unique=True),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, city_id, state_id, **details):
+        """ Remove the favorite if it exists, otherwise add it, in one
+            statement. Returns True if the city is now a favorite.
+            Call db.session.commit() afterwards.
+        """
+
+        stmt = db.text("""
+            WITH deleted AS (
+                DELETE FROM favorites
+                WHERE user_id = :user_id AND state_id = :state_id AND city_id = :city_id
+                RETURNING id
+            )
+            INSERT INTO favorites (user_id, city_id, state_id, abbr, city_name, state_name, city_stats)
+            SELECT :user_id, :city_id, :state_id, :abbr, :city_name, :state_name, :city_stats
+            WHERE NOT EXISTS (SELECT 1 FROM deleted)
+            ON CONFLICT (user_id, state_id, city_id) DO NOTHING
+            RETURNING id
+        """).bindparams(db.bindparam('city_stats', type_=db.JSON))
+
+        params = dict({'abbr':None, 'city_name':None, 'state_name':None, 'city_stats':None},
+                      **details)
+        added = db.session.execute(stmt, dict(params, user_id=user_id,
+                                              city_id=city_id, state_id=state_id)).first()
+        return added is not None
+
+    @classmethod
+    def set_details(cls, user_id, city_id, state_id, **details):
+        """ Store names and stats (the columns toggle() takes) on a favorite """
+
+        cls.query.filter_by(user_id=user_id, state_id=state_id, city_id=city_id) \
+                 .update(details, synchronize_session=False)
+
+    @classmethod
+    def is_favorite(cls, user_id, city_id, state_id):
+        """ Whether the user has favorited a city, as one indexed EXISTS query """
+
+        query = db.session.query(cls.id).filter(cls.user_id == user_id,
+                                                cls.state_id == state_id,
+                                                cls.city_id == city_id)
+        return db.session.query(query.exists()).scalar()
+
+# Columns added after the first deploy. create_all() won't add columns
+# to tables that already exist, so add_missing_columns() does.
+ADDED_COLUMNS = {
+    'users': {'city_name':'TEXT', 'state_name':'TEXT', 'abbr':'TEXT', 'city_stats':'JSON'},
+    'favorites': {'city_name':'TEXT', 'state_name':'TEXT', 'city_stats':'JSON'},
+}
+
+def add_missing_columns():
+    """ Bring tables created by an older version up to date """
+
+    inspector = db.inspect(db.engine)
+
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        for name, type in columns.items():
+            if name not in existing:
+                db.session.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {name} {type}'))
+
+    db.session.commit()
+
+def add_missing_indexes():
+    """ Add the favorites unique index to older databases, first
+        dropping any duplicate favorites it would reject
+    """
+
+    db.session.execute(db.text("""
+        DELETE FROM favorites f USING favorites dup
+        WHERE f.user_id = dup.user_id AND f.state_id = dup.state_id
+          AND f.city_id = dup.city_id AND f.id > dup.id
+    """))
+    db.session.execute(db.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_favorites_user_place ON favorites (user_id, state_id, city_id)'))
+    db.session.commit()
+
+def upgrade_db():
+    """ Bring a database created by an older version up to date: create
+        tables added since (create_all() skips ones that exist), then
+        their new columns and indexes
+    """
+
+    db.create_all()
+    add_missing_columns()
+    add_missing_indexes()
+
+
+# The connection a thread took a cache lock on, while it holds it
+cache_locks = threading.local()
+
+
+class Cache_Entry:
+    """ Shared load/save for the persistent cache tables.
+        Subclasses list their key columns, in key order, in key_columns.
+
+        These run on their own connection, outside the request's session,
+        so caching never commits (or rolls back) anything else. Inside
+        locked() they use the lock's connection, so a fill holds one
+        pooled connection rather than one per statement.
+    """
+
+    key_columns = ()
+
+    @staticmethod
+    @contextmanager
+    def connection():
+        """ The connection locked() holds on this thread, else a new
+            transaction that commits on exit
+        """
+
+        conn = getattr(cache_locks, 'conn', None)
+        if conn is not None:
+            yield conn
+        else:
+            with db.engine.begin() as conn:
+                yield conn
+
+    # null for a negative ("not found") entry
+    data = db.Column(
+        db.JSON
+    )
+
+    expires = db.Column(
+        db.DateTime,
+        nullable=False
+    )
+
+    @classmethod
+    def key_filter(cls, key):
+        return db.and_(*(getattr(cls, column) == value
+                         for column, value in zip(cls.key_columns, key)))
+
+    @classmethod
+    def load(cls, key):
+        """ Get (data, expires) for a key """
+
+        query = db.select([cls.data, cls.expires]).where(cls.key_filter(key))
+
+        with cls.connection() as conn:
+            return conn.execute(query).first()
+
+    @classmethod
+    def load_many(cls, keys):
+        """ {key: (data, expires)} for several keys in one query, leaving out ones not stored """
+
+        columns = [getattr(cls, column) for column in cls.key_columns]
+        query = db.select(columns + [cls.data, cls.expires]) \
+                  .where(db.tuple_(*columns).in_([tuple(key) for key in keys]))
+
+        with cls.connection() as conn:
+            return {tuple(row[:-2]): (row.data, row.expires) for row in conn.execute(query)}
+
+    @classmethod
+    def save(cls, key, data, expires):
+        """ Insert or replace the cached data for a key """
+
+        cls.save_many([(key, data, expires)])
+
+    @classmethod
+    def save_many(cls, entries):
+        """ Insert or replace (key, data, expires) entries in one statement """
+
+        stmt = insert(cls.__table__).values([dict(zip(cls.key_columns, key), data=data, expires=expires)
+                                             for key, data, expires in entries])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(cls.key_columns),
+            set_={'data': stmt.excluded.data, 'expires': stmt.excluded.expires})
+
+        with cls.connection() as conn:
+            conn.execute(stmt)
+
+    @classmethod
+    @contextmanager
+    def locked(cls, key):
+        """ Hold a Postgres advisory lock on key, so only one worker
+            at a time fetches it from upstream. Loads and saves on this
+            thread run in the lock's transaction until it's released, so
+            a save becomes visible as the lock is let go. Gives True if
+            another worker held the lock first.
+        """
+
+        lock_id = zlib.crc32(repr((cls.__tablename__,) + tuple(key)).encode())
+
+        with cls.connection() as conn:
+            waited = not conn.execute(db.select([db.func.pg_try_advisory_xact_lock(lock_id)])).scalar()
+            if waited:
+                conn.execute(db.select([db.func.pg_advisory_xact_lock(lock_id)]))
+
+            if getattr(cache_locks, 'conn', None) is conn:
+                # nested: released with the outer lock's transaction
+                yield waited
+                return
+
+            cache_locks.conn = conn
+            try:
+                yield waited
+            finally:
+                cache_locks.conn = None
+
+
+class Census_Cache(Cache_Entry, db.Model):
+    """ Persistent tier of the census data cache, shared by all workers """
+
+    __tablename__ = 'census_cache'
+
+    key_columns = ('vintage', 'variables', 'place', 'state')
+
+    vintage = db.Column(
+        db.String(4),
+        primary_key=True
+    )
+
+    variables = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    place = db.Column(
+        db.String(5),
+        primary_key=True
+    )
+
+    state = db.Column(
+        db.String(2),
+        primary_key=True
+    )
+
+
+class Weather_Cache(Cache_Entry, db.Model):
+    """ Recent OpenWeather results, shared by all workers """
+
+    __tablename__ = 'weather_cache'
+
+    key_columns = ('city', 'state')
+
+    # lowercased city name
+    city = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    # state abbreviation
+    state = db.Column(
+        db.String(2),
+        primary_key=True
+    )
+
+
+class Comparison(Cache_Entry, db.Model):
+    """ Two cities' names and census data, as shown on a comparison
+        permalink and its advice page
+    """
+
+    __tablename__ = 'comparisons'
+
+    key_columns = ('curr_state', 'curr_place', 'dest_state', 'dest_place')
+
+    curr_state = db.Column(
+        db.String(2),
+        primary_key=True
+    )
+
+    curr_place = db.Column(
+        db.String(5),
+        primary_key=True
+    )
+
+    dest_state = db.Column(
+        db.String(2),
+        primary_key=True
+    )
+
+    dest_place = db.Column(
+        db.String(5),
+        primary_key=True
+    )
+
+
+class City_Stats(db.Model):
+    """ ACS profile data for every census place, loaded by flask ingest-acs.
+        Null values are ones the census has no data for.
+    """
+
+    __tablename__ = 'city_stats'
+
+    columns = ('vintage', 'state', 'place', 'name', 'pop', 'age', 'inc', 'home')
+
+    vintage = db.Column(
+        db.String(4),
+        primary_key=True
+    )
+
+    state = db.Column(
+        db.String(2),
+        primary_key=True
+    )
+
+    place = db.Column(
+        db.String(5),
+        primary_key=True
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    pop = db.Column(
+        db.Integer
+    )
+
+    age = db.Column(
+        db.Float
+    )
+
+    inc = db.Column(
+        db.Integer
+    )
+
+    home = db.Column(
+        db.Integer
+    )
+
+    __table_args__ = (
+        db.Index('ix_city_stats_vintage_name', 'vintage', 'name'),
+    )
+
+    @classmethod
+    def has_vintage(cls, vintage):
+        """ Whether any places are loaded for vintage """
+
+        query = db.select([cls.place]).where(cls.vintage == vintage).limit(1)
+
+        with db.engine.connect() as conn:
+            return conn.execute(query).first() is not None
+
+    @classmethod
+    def lookup(cls, vintage, place, state):
+        """ The row for one place, or None. Uses its own connection so it's
+            safe to call from the upstream threads.
+        """
+
+        query = db.select([cls.pop, cls.age, cls.inc, cls.home]).where(
+            (cls.vintage == vintage) & (cls.state == state) & (cls.place == place))
+
+        with db.engine.connect() as conn:
+            return conn.execute(query).first()
+
+    @classmethod
+    def lookup_many(cls, vintage, codes):
+        """ Rows for several (place, state) pairs in one query, as a dict
+            keyed by the pair. Places not in the table are left out.
+        """
+
+        query = db.select([cls.place, cls.state, cls.pop, cls.age, cls.inc, cls.home]).where(
+            (cls.vintage == vintage) & db.tuple_(cls.place, cls.state).in_(list(codes)))
+
+        with db.engine.connect() as conn:
+            return {(row.place, row.state): row for row in conn.execute(query)}
+
+    @classmethod
+    def replace_vintage(cls, vintage, rows):
+        """ Swap in a new set of rows for a vintage in one transaction,
+            loading them with COPY. rows are tuples in cls.columns order.
+            Refuses to replace a vintage with nothing.
+        """
 
-        
+        if not rows:
+            raise ValueError(f'No rows to replace the {vintage} city_stats with')
+
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+
+        conn = db.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {cls.__tablename__} WHERE vintage = %s', (vintage,))
+                cursor.copy_expert(
+                    f'COPY {cls.__tablename__} ({", ".join(cls.columns)}) FROM STDIN WITH CSV', buf)
+            conn.commit()
+        finally:
+            conn.close()
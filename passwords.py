@@ -0,0 +1,86 @@
+""" bcrypt password hashing, run in a small process pool so a burst of
+    logins can't hold the web worker's CPU
+"""
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_password(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def hash_rounds(hashed):
+    """ The cost factor a bcrypt hash was made with ('$2b$12$...' -> 12) """
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """ Hashes and checks passwords in up to `workers` processes, or
+        inline when workers is 0. Callers block until their result is
+        ready; beyond `workers` at once they queue for a free process.
+
+        Configured from BCRYPT_LOG_ROUNDS and PASSWORD_WORKERS by init_app().
+    """
+
+    def __init__(self, rounds=12, workers=2):
+        self.rounds = rounds
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        # called with (operation, seconds) after every hash or check
+        self.observer = None
+
+    def init_app(self, app):
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.get('PASSWORD_WORKERS', self.workers)
+
+    def run(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return self.call(fn, *args)
+        finally:
+            if self.observer:
+                self.observer(fn.__name__, time.perf_counter() - start)
+
+    def call(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        # started on first use, so each web worker gets its own
+        # and a preloading master doesn't fork one it can't share
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+
+        return self.pool.submit(fn, *args).result()
+
+    def hash(self, password):
+        """ New hash of password at the current cost factor """
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self.run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self.run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """ Whether hashed was made with a different cost factor """
+
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
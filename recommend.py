@@ -0,0 +1,80 @@
+""" Rank every census place as a destination for one origin city """
+
+import numpy as np
+
+from gazetteer import display_name
+from models import db, City_Stats
+
+
+class StatsMatrix:
+    """ One vintage of city_stats held as NumPy columns, so a whole
+        nation of destinations can be scored with array operations
+    """
+
+    def __init__(self, rows):
+        """ rows are (state, place, name, pop, inc, home) tuples """
+
+        columns = list(zip(*rows)) or [()] * 6
+        # codes are fixed-width bytes, as in the mapped file (see statstore)
+        self.state = np.array(columns[0], dtype='S2')
+        self.place = np.array(columns[1], dtype='S5')
+        self.names = list(columns[2])
+        # census no-data values (NULL) become NaN and drop out of rankings
+        self.pop = np.array(columns[3], dtype=float)
+        self.inc = np.array(columns[4], dtype=float)
+        self.home = np.array(columns[5], dtype=float)
+
+    def __len__(self):
+        return len(self.place)
+
+    def name(self, i):
+        """ The census name of place i, like 'Tampa city, Florida' """
+
+        return self.names[i]
+
+    @classmethod
+    def load(cls, vintage):
+        query = db.select([City_Stats.state, City_Stats.place, City_Stats.name,
+                           City_Stats.pop, City_Stats.inc, City_Stats.home]) \
+                  .where(City_Stats.vintage == vintage)
+
+        with db.engine.connect() as conn:
+            return cls([tuple(row) for row in conn.execute(query)])
+
+    def rank(self, inc, home, limit=10, min_pop=0, exclude=None):
+        """ The limit places where an origin's income/home-value trade-off
+            improves the most, best first.
+
+            Buying-power gain is income ratio / home-value ratio, the same
+            two ratios analyze() compares: above 1 means income grows
+            faster than home prices. exclude is a (place, state) to skip,
+            normally the origin itself.
+        """
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inc_ratio = np.round(self.inc / inc, 2)
+            home_ratio = np.round(self.home / home, 2)
+            gain = inc_ratio / home_ratio
+
+        eligible = np.isfinite(gain) & (self.pop >= min_pop)
+        if exclude:
+            eligible &= ~((self.place == exclude[0].encode()) & (self.state == exclude[1].encode()))
+
+        candidates = np.flatnonzero(eligible)
+        if len(candidates) > limit:
+            # only the top `limit` need a full sort
+            top = np.argpartition(-gain[candidates], limit - 1)[:limit]
+            candidates = candidates[top]
+        best = candidates[np.argsort(-gain[candidates], kind='stable')]
+
+        return [{'place': self.place[i].decode(),
+                 'state': self.state[i].decode(),
+                 'city': display_name(self.name(i).rsplit(', ', 1)[0]),
+                 'state_name': self.name(i).rsplit(', ', 1)[-1],
+                 'pop': int(self.pop[i]),
+                 'inc': int(self.inc[i]),
+                 'home': int(self.home[i]),
+                 'inc_ratio': float(inc_ratio[i]),
+                 'home_ratio': float(home_ratio[i]),
+                 'gain': round(float(gain[i]), 3)}
+                for i in best]
@@ -1,9 +1,10 @@
 """ Seed database with sample data """
 
-from app import db
+from app import db, create_app
 from models import User
 
 
+create_app()
 db.session.close()
 db.drop_all()
 db.create_all()
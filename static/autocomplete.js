@@ -1,69 +1,58 @@
-/* 
+/*
 *  Add autocomplete to city inputs on home page
 */
 
-mapboxgl.accessToken = 'pk.eyJ1IjoibGd3aW5uIiwiYSI6ImNreDljMWNuNjJlb2oyb211N2NieDh0MHYifQ.Gwv6bcmeKcZx2lqNHOUbdw';
-
-let currCity = '';
-let currState = '';
-let destCity = '';
-let destState = '';
-
-const currGeocoder = new MapboxGeocoder({
-            accessToken: mapboxgl.accessToken,
-            countries:'US',
-            types: 'place',
-            fuzzyMatch:false
-});
-
-const destGeocoder = new MapboxGeocoder({
-    accessToken: mapboxgl.accessToken,
-    countries:'US',
-    types: 'place',
-    fuzzyMatch:false
-});
-
-// add geocoder tool to div
-currGeocoder.addTo('#curr-city-div'); 
-let currInputElement = document.getElementsByTagName('input')[0];
-currInputElement.placeholder = 'Current City';
-
-destGeocoder.addTo('#dest-city-div')
-let destInputElement = document.getElementsByTagName('input')[1];
-destInputElement.placeholder = 'Destination City';
-
-
-// Get the geocoder results container.
-const currResults = document.getElementById('curr-result'); // the <pre> element
-const destResults = document.getElementById('dest-result');
-
-// Assign result to variables.
-currGeocoder.on('result', (evt) => {
-    let currCity = evt.result.text;
-    let currState = evt.result.context[1]["text"];
-    let currAbbr = evt.result.context[1]["short_code"];
-    document.getElementById('curr-city').value = currCity;
-    document.getElementById('curr-state').value = currState;
-    document.getElementById('curr-abbr').value = currAbbr;
-
-});
-
-destGeocoder.on('result', (evt) => {
-    let destCity = evt.result.text;
-    let destState = evt.result.context[1]["text"];
-    let destAbbr = evt.result.context[1]["short_code"];
-    document.getElementById('dest-city').value = destCity;
-    document.getElementById('dest-state').value = destState;
-    document.getElementById('dest-abbr').value = destAbbr;
-});
-
-
-// Clear results container when search is cleared.
-currGeocoder.on('clear', () => {
-results.innerText = '';
-});
-
-destGeocoder.on('clear', () => {
-    results.innerText = '';
+// Suggestions come from /api/places/suggest, which only lists names the
+// census lookup can find, so a picked city can always be compared.
+
+function addPlaceInput(divId, prefix, placeholder) {
+    const input = document.createElement('input');
+    input.type = 'text';
+    input.className = 'form-control';
+    input.placeholder = placeholder;
+    input.autocomplete = 'off';
+    input.setAttribute('list', `${prefix}-options`);
+
+    const options = document.createElement('datalist');
+    options.id = `${prefix}-options`;
+
+    const div = document.getElementById(divId);
+    div.appendChild(input);
+    div.appendChild(options);
+
+    let suggestions = [];
+    let timer = null;
+    // numbers each request, so a slow response can't replace a newer one
+    let latest = 0;
+
+    input.addEventListener('input', () => {
+        clearTimeout(timer);
+        choose(input.value);
+        timer = setTimeout(async () => {
+            const request = ++latest;
+            const res = await axios.get('/api/places/suggest', {params: {q: input.value}});
+            if (request !== latest) return;
+
+            suggestions = res.data.places;
+            options.innerHTML = '';
+            for (let place of suggestions) {
+                const option = document.createElement('option');
+                option.value = `${place.city}, ${place.abbr}`;
+                options.appendChild(option);
+            }
+            // the text may only match now that its suggestions are here
+            choose(input.value);
+        }, 100);
     });
-    
+
+    // Fill the hidden form fields once the text matches a suggestion.
+    function choose(text) {
+        const place = suggestions.find(place => `${place.city}, ${place.abbr}` === text);
+        document.getElementById(`${prefix}-city`).value = place ? place.city : '';
+        document.getElementById(`${prefix}-state`).value = place ? place.state : '';
+        document.getElementById(`${prefix}-abbr`).value = place ? `US-${place.abbr}` : '';
+    }
+}
+
+addPlaceInput('curr-city-div', 'curr', 'Current City');
+addPlaceInput('dest-city-div', 'dest', 'Destination City');
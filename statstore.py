@@ -0,0 +1,152 @@
+""" city_stats in one memory-mapped file, so every gunicorn worker reads
+    the same pages instead of loading its own copy of the table
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from models import db, City_Stats
+from recommend import StatsMatrix
+
+STATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'data', 'city_stats.bin')
+
+MAGIC = b'RLCS'
+VERSION = 1
+# magic, version, vintage, padding, places, bytes of names
+HEADER = struct.Struct('<4sI4s4xQQ')
+
+# numeric columns, in file order, with their position in City_Stats.columns.
+# NaN is the census' no data; pop, inc and home are whole numbers.
+NUMBERS = (('pop', 4), ('age', 5), ('inc', 6), ('home', 7))
+INTEGERS = {'pop', 'inc', 'home'}
+
+
+def write(path, vintage, rows):
+    """ Write rows, in City_Stats.columns order, to path. The file is
+        replaced in one rename, so workers that mapped the old one keep
+        reading it until they restart. Each call writes its own temporary
+        file, so concurrent writers can't mix their rows. Returns the
+        number of places.
+
+        Layout, after the header: pop, age, inc and home as float64, the
+        int64 start of each name (plus one past the last), state codes as
+        2 bytes, place codes as 5, then the UTF-8 names end to end. Rows
+        are sorted by state then place, for lookup().
+    """
+
+    rows = sorted(rows, key=lambda row: (row[1], row[2]))
+    names = [row[3].encode() for row in rows]
+    offsets = np.zeros(len(rows) + 1, dtype='<i8')
+    np.cumsum([len(name) for name in names], out=offsets[1:])
+
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.city_stats.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, vintage.encode(), len(rows), int(offsets[-1])))
+            for key, column in NUMBERS:
+                f.write(np.array([np.nan if row[column] is None else row[column] for row in rows],
+                                 dtype='<f8').tobytes())
+            f.write(offsets.tobytes())
+            f.write(np.array([row[1] for row in rows], dtype='S2').tobytes())
+            f.write(np.array([row[2] for row in rows], dtype='S5').tobytes())
+            f.write(b''.join(names))
+        # mkstemp makes the file private to its owner; workers only need to read it
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+    return len(rows)
+
+
+def build(path, vintage):
+    """ Write one vintage of the city_stats table to path, unless it has
+        no rows. Returns the number of places.
+    """
+
+    query = db.select([getattr(City_Stats, column) for column in City_Stats.columns]) \
+              .where(City_Stats.vintage == vintage)
+
+    with db.engine.connect() as conn:
+        rows = [tuple(row) for row in conn.execute(query)]
+
+    if not rows:
+        return 0
+    return write(path, vintage, rows)
+
+
+class StatsStore(StatsMatrix):
+    """ A StatsMatrix whose columns are read-only views of a file written
+        by write(). Nothing is copied into the process: the OS shares the
+        mapped pages between every worker that opens the same file.
+    """
+
+    def __init__(self, mapped):
+        magic, version, vintage, count, names_size = HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a city stats file, or an older format')
+        self.vintage = vintage.decode()
+
+        offset = HEADER.size
+        def column(dtype, length=count):
+            nonlocal offset
+            array = np.frombuffer(mapped, dtype=dtype, count=length, offset=offset)
+            offset += array.nbytes
+            return array
+
+        for key, _ in NUMBERS:
+            setattr(self, key, column('<f8'))
+        self.offsets = column('<i8', count + 1)
+        self.state = column('S2')
+        self.place = column('S5')
+        self.names_start = offset
+        self.mapped = mapped
+
+        if offset + names_size != len(mapped):
+            raise ValueError('City stats file is truncated')
+
+    @classmethod
+    def open(cls, path, vintage):
+        """ Map path read-only. Raises OSError if it can't be read and
+            ValueError if it isn't a stats file for vintage.
+        """
+
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        store = cls(mapped)
+        if store.vintage != vintage:
+            raise ValueError(f'City stats file is for {store.vintage}, not {vintage}')
+        return store
+
+    def name(self, i):
+        start = self.names_start + int(self.offsets[i])
+        return self.mapped[start:self.names_start + int(self.offsets[i + 1])].decode()
+
+    def lookup(self, place, state):
+        """ pop, age, inc and home for one place, with None where the
+            census has no data, or None if the place isn't in the file
+        """
+
+        if len(place) != 5 or len(state) != 2:
+            return None
+        place, state = place.encode(), state.encode()
+
+        # rows are sorted by state, then by place within a state
+        start = np.searchsorted(self.state, state, 'left')
+        end = np.searchsorted(self.state, state, 'right')
+        i = start + np.searchsorted(self.place[start:end], place)
+        if i == end or self.place[i] != place:
+            return None
+
+        row = {}
+        for key, _ in NUMBERS:
+            value = getattr(self, key)[i]
+            row[key] = None if np.isnan(value) else int(value) if key in INTEGERS else float(value)
+        return row
@@ -0,0 +1,11 @@
+""" The app the test modules share, built for the test profile before
+    any of them touches the database
+"""
+
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
+
+from app import create_app
+
+app = create_app('test')
@@ -0,0 +1,263 @@
+""" Cache tests """
+
+# to run:
+#    python3 -m unittest tests/test_cache.py
+
+import os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from sqlalchemy import event
+
+from models import db, Census_Cache, Weather_Cache
+
+# Specify test database
+os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
+
+from tests import app
+from cache import LRUCache, TieredCache, SingleFlight, MISSING
+
+# Create tables
+db.drop_all()
+db.create_all()
+
+KEY = ('2019', 'DP05_0001E', '71000', '12')
+
+class LRUCacheTestCase(TestCase):
+    """ Test in-memory tier """
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_expires(self):
+        cache = LRUCache()
+        cache.set('a', 1, 0.01)
+        time.sleep(0.02)
+
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_grace_keeps_stale_entries(self):
+        cache = LRUCache(grace=60)
+        cache.set('a', 1, 0.01)
+        time.sleep(0.02)
+
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(cache.get_stale('a')[0], 1)
+        self.assertEqual(cache.expirations, 0)
+
+class SingleFlightTestCase(TestCase):
+    """ Test request coalescing """
+
+    def test_concurrent_calls_share_result(self):
+        flights = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def slow_fetch():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.run('key', slow_fetch)))
+        leader.start()
+        started.wait()
+        results.append(flights.run('key', slow_fetch))
+        leader.join()
+
+        self.assertEqual(results, ['result', 'result'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.coalesced, 1)
+
+class TieredCacheTestCase(TestCase):
+    """ Test memory + Postgres tiers """
+
+    def setUp(self):
+        Census_Cache.query.delete()
+        Weather_Cache.query.delete()
+        db.session.commit()
+
+    def test_fetch_once(self):
+        """ A second lookup is served from memory """
+        cache = TieredCache(LRUCache(), store=Census_Cache)
+        calls = []
+        fetch = lambda: calls.append(1) or {'pop':'100'}
+
+        self.assertEqual(cache.get_or_fetch(KEY, fetch), {'pop':'100'})
+        self.assertEqual(cache.get_or_fetch(KEY, fetch), {'pop':'100'})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_persistent_tier(self):
+        """ A new worker (empty memory tier) reads what another worker stored """
+        TieredCache(LRUCache(), store=Census_Cache).set(KEY, {'pop':'100'})
+
+        cache = TieredCache(LRUCache(), store=Census_Cache)
+        self.assertEqual(cache.get(KEY), {'pop':'100'})
+        self.assertEqual(cache.stats()['store_hits'], 1)
+
+    def test_negative_caching(self):
+        """ 'Not found' is cached, and with the shorter ttl """
+        cache = TieredCache(LRUCache(), store=Census_Cache, ttl=3600, negative_ttl=0.01)
+        cache.set(KEY, None)
+
+        self.assertIsNone(cache.get(KEY))
+        self.assertEqual(cache.stats()['negative_hits'], 1)
+
+        time.sleep(0.02)
+        self.assertIs(cache.get(KEY), MISSING)
+
+    def test_weather_store(self):
+        """ Weather entries are shared through the weather_cache table """
+        TieredCache(LRUCache(), store=Weather_Cache).set(('austin', 'TX'), {'icon':'01d', 'temp':80})
+
+        cache = TieredCache(LRUCache(), store=Weather_Cache)
+        self.assertEqual(cache.get_or_fetch(('austin', 'TX'), lambda: self.fail('fetched')),
+                         {'icon':'01d', 'temp':80})
+
+    def test_stale_while_revalidate(self):
+        """ An expired entry is answered at once and refreshed behind it """
+        cache = TieredCache(LRUCache(), ttl=0.01, stale_ttl=60)
+        cache.set(KEY, {'pop':'100'})
+        time.sleep(0.02)
+
+        refreshed = threading.Event()
+        def fetch():
+            refreshed.wait(1)
+            return {'pop':'200'}
+
+        cache.refresh_pool = ThreadPoolExecutor(max_workers=1)
+        self.assertEqual(cache.get_or_fetch(KEY, fetch), {'pop':'100'})
+        refreshed.set()
+        cache.refresh_pool.shutdown(wait=True)
+
+        self.assertEqual(cache.get(KEY), {'pop':'200'})
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_stale_during_outage(self):
+        """ A failed refresh keeps serving the last good value from the store """
+        TieredCache(LRUCache(), store=Census_Cache, ttl=0.01).set(KEY, {'pop':'100'})
+        time.sleep(0.02)
+
+        def fetch():
+            raise ConnectionError('census is down')
+
+        # a new worker, with nothing in memory
+        cache = TieredCache(LRUCache(), store=Census_Cache, ttl=0.01, stale_ttl=60)
+        for _ in range(2):
+            self.assertEqual(cache.get_or_fetch(KEY, fetch), {'pop':'100'})
+
+        self.assertEqual(cache.stats()['refresh_errors'], 2)
+
+    def test_too_stale(self):
+        """ Past stale_ttl, a miss is fetched as usual """
+        cache = TieredCache(LRUCache(), ttl=0.01, stale_ttl=0.01)
+        cache.set(KEY, {'pop':'100'})
+        time.sleep(0.03)
+
+        self.assertEqual(cache.get_or_fetch(KEY, lambda: {'pop':'200'}), {'pop':'200'})
+        self.assertEqual(cache.stats()['stale_hits'], 0)
+
+    def test_many(self):
+        """ Batch reads and writes go to the store in one statement each """
+        other = KEY[:2] + ('45000', '12')
+        TieredCache(LRUCache(), store=Census_Cache).set_many({KEY: {'pop':'100'}, other: None})
+
+        cache = TieredCache(LRUCache(), store=Census_Cache)
+        missing = KEY[:2] + ('99999', '12')
+        self.assertEqual(cache.get_many([KEY, other, missing]), {KEY: {'pop':'100'}, other: None})
+        self.assertEqual(cache.stats()['store_hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.get_many([KEY]), {KEY: {'pop':'100'}})
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_fill_holds_one_connection(self):
+        """ Filling under the lock reads and writes on the lock's connection """
+        cache = TieredCache(LRUCache(), store=Census_Cache)
+        before = db.engine.pool.checkedout()
+        peak = []
+        def checkout(*args):
+            peak.append(db.engine.pool.checkedout())
+        event.listen(db.engine, 'checkout', checkout)
+        try:
+            self.assertEqual(cache.fill(KEY, lambda: {'pop':'100'}), {'pop':'100'})
+        finally:
+            event.remove(db.engine, 'checkout', checkout)
+
+        self.assertEqual(max(peak), before + 1)
+        self.assertEqual(db.engine.pool.checkedout(), before)
+        # saved once the lock was released
+        self.assertEqual(TieredCache(LRUCache(), store=Census_Cache).get(KEY), {'pop':'100'})
+
+    def test_fill_rereads_after_waiting(self):
+        """ A fill reads the store again only if another worker held the lock """
+        statements = []
+        def execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', execute)
+        try:
+            cache = TieredCache(LRUCache(), store=Census_Cache)
+            self.assertEqual(cache.fill(KEY, lambda: {'pop':'100'}), {'pop':'100'})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', execute)
+        self.assertFalse([statement for statement in statements if statement.startswith('SELECT census_cache')])
+
+        filling = threading.Event()
+        done = threading.Event()
+        def other_worker():
+            with Census_Cache.locked(KEY):
+                TieredCache(LRUCache(), store=Census_Cache).set(KEY, {'pop':'200'})
+                filling.set()
+                done.wait(5)
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        filling.wait(5)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            cache = TieredCache(LRUCache(), store=Census_Cache)
+            filled = pool.submit(cache.fill, KEY, lambda: self.fail('fetched'))
+            time.sleep(0.1)
+            done.set()
+            self.assertEqual(filled.result(5), {'pop':'200'})
+        thread.join()
+
+    def test_counts_across_threads(self):
+        """ Counters don't lose increments made from several threads at once """
+        cache = TieredCache(LRUCache())
+        def count():
+            for _ in range(20000):
+                cache.count('hits')
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache.stats()['hits'], 80000)
+
+    def test_missing_store_table(self):
+        """ A store whose table was never created still caches in memory, and is logged once """
+        Census_Cache.__table__.drop(db.engine)
+        try:
+            cache = TieredCache(LRUCache(), store=Census_Cache)
+            with self.assertLogs('cache', 'ERROR') as logs:
+                self.assertEqual(cache.get_or_fetch(KEY, lambda: {'pop':'100'}), {'pop':'100'})
+                self.assertEqual(cache.get(KEY), {'pop':'100'})
+        finally:
+            Census_Cache.__table__.create(db.engine)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('census_cache', logs.output[0])
+        self.assertGreater(cache.stats()['store_errors'], 1)
@@ -1,27 +1,57 @@
 """ City View tests """
 
 # to run:
-#    FLASK_ENV=production python3 -m unittest tests/test_city_routes.py
+#    python3 -m unittest tests/test_city_routes.py
 
-import os
-from unittest import TestCase
+import os, time
+from unittest import TestCase, mock
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.http import http_date
 
-from models import db, connect_db, User, User_Favorites
+from models import db, connect_db, User, User_Favorites, Census_Cache, Weather_Cache, Comparison
 
 # Specify test database
 os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
 
-from app import app, CURR_USER_KEY
+import app as app_module
+from app import CURR_USER_KEY, upstream_pool, wait_for, comparison_cache, census_cache, QueryBudgetExceeded
+from tests import app
+from benchmarks import standin
 
 # Create tables
 db.drop_all()
 db.create_all()
 
-app.config['WTF_CSRF_ENABLED'] = False
+COMPARISON = {'curr':{"name":'Tampa',
+                      "abbr": 'FL',
+                      "census":{"pop":'99999',
+                                "age":'99999',
+                                "inc":'100000',
+                                "home":'100000',
+                                "state":'99',
+                                "place":'99999'}},
+              'dest':{"name":'Miami',
+                      "abbr": 'FL',
+                      "census":{"pop":'77777',
+                                "age":'77777',
+                                "inc":'125000',
+                                "home":'175000',
+                                "state":'77',
+                                "place":'77777'}}}
 
 class CityViewTestCase(TestCase):
     """ Test views for cities """
 
+    @classmethod
+    def setUpClass(cls):
+        """ Answer census and weather requests from the recorded payloads """
+        server = standin.serve(0, standin.Behavior())
+        cls.addClassCleanup(server.shutdown)
+        for name in ('CENSUS_API', 'WEATHER_API'):
+            patch = mock.patch.object(app_module, name, f'http://127.0.0.1:{server.server_port}')
+            patch.start()
+            cls.addClassCleanup(patch.stop)
+
     def setUp(self):
         """ Create test client, add sample data """
         User.query.delete()
@@ -32,6 +62,7 @@ class CityViewTestCase(TestCase):
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
+        comparison_cache.memory.clear()
         return res
 
     def test_compare_cities(self):
@@ -40,10 +71,10 @@ class CityViewTestCase(TestCase):
 
             response = self.client.post('/cities/compare',
                                         data={'curr-city':'Tampa',
-                                              'curr-state':'12',
+                                              'curr-state':'Florida',
                                               'curr-abbr':'US-FL',
                                               'dest-city':'Miami',
-                                              'dest-state':'12'
+                                              'dest-state':'Florida'
                                             }, follow_redirects=True
                                         )
 
@@ -53,38 +84,238 @@ class CityViewTestCase(TestCase):
             self.assertIn('Population', str(response.data))
             self.assertIn('img src="http://openweathermap.org/img/', str(response.data))
 
+    def test_upstream_server_timing(self):
+        """ Census calls are timed as 'census', with the host in desc """
+        census_cache.memory.clear()
+        comparison_cache.memory.clear()
+        Census_Cache.query.delete()
+        Comparison.query.filter_by(curr_place='53000', dest_place='35000').delete()
+        db.session.commit()
+
+        # the stand-in's host, with the real census host's settings
+        host = app_module.CENSUS_API.split('//')[1]
+        census = next(upstream for upstream in app_module.api_client.upstreams.values()
+                      if upstream.name == 'census')
+        with mock.patch.dict(app_module.api_client.upstreams, {host: census}):
+            response = self.client.get('/cities/compare/12-53000/12-35000')
+            b''.join(response.response)
+
+        self.assertRegex(response.headers['Server-Timing'], f'(^|, )census;dur=[0-9.]+;desc="{census.host} 1x"')
+        self.assertNotIn(':', response.headers['Server-Timing'].replace(f'"{census.host} 1x"', ''))
+
+    def test_compare_cities_redirects(self):
+        """ Posting a comparison redirects to its permalink """
+        response = self.client.post('/cities/compare',
+                                    data={'curr-city':'Tampa',
+                                          'curr-state':'Florida',
+                                          'dest-city':'Miami',
+                                          'dest-state':'Florida'})
+
+        self.assertEqual(response.status_code, 303)
+        self.assertTrue(response.location.endswith('/cities/compare/12-71000/12-45000'))
+
+    def test_show_comparison(self):
+        """ A permalink shows the stored comparison """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+
+        response = self.client.get('/cities/compare/99-99999/77-77777')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Tampa', str(response.data))
+        self.assertIn('Miami', str(response.data))
+        self.assertIn('/cities/advice/99-99999/77-77777', str(response.data))
+
+    def test_stream_comparison(self):
+        """ The page is streamed, weather filled in after the census cards """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+
+        response = self.client.get('/cities/compare/99-99999/77-77777')
+        chunks = [chunk.decode() for chunk in response.response]
+
+        self.assertGreater(len(chunks), 1)
+        self.assertIn('Population', chunks[0])
+        self.assertNotIn('slot-curr-weather', chunks[0])
+        self.assertIn('<template id="slot-curr-weather">', ''.join(chunks))
+        self.assertIn('<template id="slot-dest-weather">', ''.join(chunks))
+
+    def test_stream_comparison_etag(self):
+        """ A streamed first view carries an ETag, and revalidating it skips the weather """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+
+        response = self.client.get('/cities/compare/99-99999/77-77777')
+        b''.join(response.response)
+        self.assertIn('ETag', response.headers)
+        counts = dict(app_module.weather_cache.counts)
+
+        response = self.client.get('/cities/compare/99-99999/77-77777',
+                                   headers={'If-None-Match':response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(app_module.weather_cache.counts, counts)
+
+    def test_stream_comparison_queries(self):
+        """ Queries made while the page streams count against its budget """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+        for city in ('Tampa', 'Miami'):
+            app_module.weather_cache.set(app_module.weather_key(city, 'FL'), app_module.NO_WEATHER)
+        app_module.weather_cache.memory.clear()
+        def forget_weather():
+            Weather_Cache.query.delete()
+            db.session.commit()
+        self.addCleanup(forget_weather)
+
+        view = app.view_functions['views.show_comparison']
+        budget = view.query_budget
+        view.query_budget = (1, None)
+        try:
+            response = self.client.get('/cities/compare/99-99999/77-77777')
+            with self.assertRaises(QueryBudgetExceeded) as raised:
+                response.get_data()
+        finally:
+            view.query_budget = budget
+
+        self.assertIn('2 queries (budget 1)', str(raised.exception))
+
+    def test_show_comparison_unstreamed(self):
+        """ With streaming off, weather is rendered in place """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+        app.config['STREAM_PAGES'] = False
+        try:
+            response = self.client.get('/cities/compare/99-99999/77-77777')
+        finally:
+            app.config['STREAM_PAGES'] = True
+
+        self.assertIn('img src="http://openweathermap.org/img/', str(response.data))
+        self.assertNotIn('fillSlot', str(response.data))
+
+    def test_show_comparison_bad_id(self):
+        """ Malformed place ids are not found """
+        response = self.client.get('/cities/compare/florida/77-77777')
+
+        self.assertEqual(response.status_code, 404)
+
     def test_get_advice(self):
         """ Shows advice for comparison with accurate calculations """
-        with self.client as c:
-            with c.session_transaction() as sess:
-                sess['curr_data'] = {"name":'Tampa',
-                            "abbr": 'FL',
-                            "census":{"id":'99999',
-                                    "pop":'99999', 
-                                    "age":'99999',
-                                    "inc":'100000', 
-                                    "home":'100000',
-                                    "state":'99',
-                                    "place":'99999'}, 
-                            "weather":{'icon':'zzz', 'temp':999}
-                            }
-                sess['dest_data'] = {"name":'Miami',
-                            "abbr": 'FL',
-                            "census":{"id":'77777',
-                                    "pop":'77777', 
-                                    "age":'77777',
-                                    "inc":'125000', 
-                                    "home":'175000',
-                                    "state":'77',
-                                    "place":'77777'}, 
-                            "weather":{'icon':'yyy', 'temp':777}
-                            }
-            response = self.client.get('/cities/advice') 
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
 
-            self.assertEqual(response.status_code, 200)
-            self.assertIn('There are lots of things to consider', str(response.data))
-            self.assertIn('Tampa', str(response.data))
-            self.assertIn('Miami', str(response.data))
-            self.assertIn('Average incomes are', str(response.data))
-            self.assertIn('25%', str(response.data))
-            self.assertIn('75%', str(response.data))
+        response = self.client.get('/cities/advice/99-99999/77-77777')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('There are lots of things to consider', str(response.data))
+        self.assertIn('Tampa', str(response.data))
+        self.assertIn('Miami', str(response.data))
+        self.assertIn('Average incomes are', str(response.data))
+        self.assertIn('25%', str(response.data))
+        self.assertIn('75%', str(response.data))
+
+    def test_get_advice_not_modified(self):
+        """ Revalidating advice answers 304 without looking anything up """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+
+        response = self.client.get('/cities/advice/99-99999/77-77777')
+        self.assertIn('public', response.headers['Cache-Control'])
+        counts = dict(comparison_cache.counts)
+
+        response = self.client.get('/cities/advice/99-99999/77-77777',
+                                   headers={'If-None-Match':response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(comparison_cache.counts, counts)
+
+    def test_get_advice_modified_since(self):
+        """ Last-Modified moves with a deploy, not only with the census data """
+        comparison_cache.set(('99', '99999', '77', '77777'), COMPARISON)
+
+        response = self.client.get('/cities/advice/99-99999/77-77777')
+        self.assertEqual(response.last_modified, max(app_module.CENSUS_RELEASED, app_module.CODE_MODIFIED))
+
+        before_deploy = self.client.get('/cities/advice/99-99999/77-77777',
+                                        headers={'If-Modified-Since':http_date(app_module.CENSUS_RELEASED)})
+        unchanged = self.client.get('/cities/advice/99-99999/77-77777',
+                                    headers={'If-Modified-Since':response.headers['Last-Modified']})
+
+        self.assertEqual(before_deploy.status_code, 200)
+        self.assertEqual(unchanged.status_code, 304)
+
+    def test_compare_many(self):
+        """ Several destinations in one state take one census request """
+        server = standin.serve(0, standin.Behavior())
+        census_cache.memory.clear()
+        Census_Cache.query.delete()
+        db.session.commit()
+
+        census_requests = []
+        replay = standin.census_response
+        def census_response(path, query):
+            census_requests.append(path)
+            return replay(path, query)
+
+        try:
+            with mock.patch.object(app_module, 'CENSUS_API', f'http://127.0.0.1:{server.server_port}'), \
+                 mock.patch.object(standin, 'census_response', census_response):
+                response = self.client.get('/cities/compare-many',
+                                           query_string=[('origin', '12-71000'), ('dest', 'Miami, Florida'),
+                                                         ('dest', '12-53000'), ('dest', '12-35000'), ('dest', '')])
+        finally:
+            server.shutdown()
+            census_cache.memory.clear()
+
+        html = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(census_requests, ['/data/2019/acs/acs5/profile'])
+        for city in ('Tampa, FL', 'Miami, FL', 'Orlando, FL', 'Jacksonville, FL'):
+            self.assertIn(city, html)
+        self.assertIn('/cities/compare/12-71000/12-53000', html)
+        self.assertIn('$180,200', html)
+
+    def test_compare_many_too_many(self):
+        """ More than MAX_DESTINATIONS destinations goes back to the form """
+        query = [('origin', '12-71000')] + [('dest', '12-45000')] * (app_module.MAX_DESTINATIONS + 1)
+
+        response = self.client.get('/cities/compare-many', query_string=query)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/cities/compare-many'))
+
+    def test_suggest_places(self):
+        """ Suggestions carry the place id the comparison pages take """
+        response = self.client.get('/api/places/suggest', query_string={'q':'tampa, fl'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['places'][0]['id'], '12-71000')
+        self.assertEqual(response.json['places'][0]['city'], 'Tampa')
+        self.assertIn('public', response.headers['Cache-Control'])
+
+    def test_suggest_without_city_stats(self):
+        """ Suggestions work unranked until city_stats is loaded, then get ranked """
+        from recommend import StatsMatrix
+        app_module.place_index = None
+        self.addCleanup(setattr, app_module, 'place_index', None)
+
+        with mock.patch.object(app_module, 'get_stats_matrix',
+                               side_effect=SQLAlchemyError('relation "city_stats" does not exist')):
+            with self.assertLogs(app_module.log, 'WARNING'):
+                response = self.client.get('/api/places/suggest', query_string={'q':'tampa, fl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['places'][0]['id'], '12-71000')
+        self.assertFalse(app_module.place_index_ranked)
+
+        # once the unranked index is old enough, the next request ranks it
+        app_module.place_index_built -= app_module.UNRANKED_INDEX_TTL
+        matrix = StatsMatrix([('12', '71000', 'Tampa city, Florida', 384959, 55462, 234000)])
+        with mock.patch.object(app_module, 'get_stats_matrix', return_value=matrix):
+            response = self.client.get('/api/places/suggest', query_string={'q':'tampa, fl'})
+        self.assertEqual(response.json['places'][0]['pop'], 384959)
+        self.assertTrue(app_module.place_index_ranked)
+
+    def test_wait_for_slow_upstream(self):
+        """ A call still running at the deadline gives the default """
+        future = upstream_pool.submit(time.sleep, 0.5)
+
+        self.assertEqual(wait_for(future, 'default', time.monotonic() + 0.01), 'default')
+
+    def test_wait_for_failed_upstream(self):
+        """ A call that raises gives the default """
+        future = upstream_pool.submit(int, 'not a number')
+
+        self.assertEqual(wait_for(future, 'default', time.monotonic() + 1), 'default')
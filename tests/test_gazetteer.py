@@ -0,0 +1,85 @@
+""" Gazetteer tests """
+
+# to run:
+#    python3 -m unittest tests/test_gazetteer.py
+
+from unittest import TestCase
+
+from gazetteer import Gazetteer, PrefixIndex, place_keys
+
+class GazetteerTestCase(TestCase):
+    """ Test local census code lookups """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.places = Gazetteer.load()
+
+    def test_lookup(self):
+        """ Finds codes for a city and state name """
+        self.assertEqual(self.places.lookup('Tampa', 'Florida'), {'place':'71000', 'state':'12'})
+
+    def test_lookup_normalizes_name(self):
+        """ Case and extra whitespace don't matter """
+        self.assertEqual(self.places.lookup('  tampa ', 'Florida'), {'place':'71000', 'state':'12'})
+
+    def test_new_york_city_alias(self):
+        """ Geocoder's 'New York City' maps to census 'New York city' """
+        self.assertEqual(self.places.lookup('New York City', 'New York'),
+                         self.places.lookup('New York', 'New York'))
+        self.assertEqual(self.places.lookup('New York City', 'New York')['place'], '51000')
+
+    def test_multi_word_suffix(self):
+        """ Consolidated governments and (balance) areas are found by city name """
+        self.assertEqual(self.places.lookup('Indianapolis', 'Indiana')['place'], '36003')
+        self.assertEqual(self.places.lookup('Nashville', 'Tennessee')['place'], '52006')
+
+    def test_not_found(self):
+        """ Unknown city or state returns False """
+        self.assertFalse(self.places.lookup('Gotham', 'Florida'))
+        self.assertFalse(self.places.lookup('Tampa', 'Floridia'))
+
+    def test_name(self):
+        """ Reverse lookup gives display names without the census description """
+        self.assertEqual(self.places.name('36003', '18'), {'city':'Indianapolis', 'state':'Indiana', 'abbr':'IN'})
+        self.assertIsNone(self.places.name('99999', '01'))
+
+    def test_place_keys(self):
+        """ Alternate names in parentheses are indexed too """
+        keys = place_keys('El Paso de Robles (Paso Robles) city')
+        self.assertEqual(keys[0], 'el paso de robles (paso robles)')
+        self.assertIn('paso robles', keys)
+        self.assertIn('el paso de robles', keys)
+
+
+class PrefixIndexTestCase(TestCase):
+    """ Test place name suggestions """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.places = Gazetteer.load()
+        cls.index = PrefixIndex(cls.places, {('71000', '12'):387916, ('71150', '12'):25000,
+                                             ('70000', '20'):400})
+
+    def test_ranked_by_population(self):
+        """ Bigger places come first, for cached and scanned prefixes alike """
+        for prefix, expected in (('t', 'Tarpon Springs, FL'), ('ta', 'Tarpon Springs, FL'),
+                                 ('tam', 'Tampa, KS')):
+            suggestions = self.index.suggest(prefix, 2)
+            self.assertEqual([f"{place['city']}, {place['abbr']}" for place in suggestions],
+                             ['Tampa, FL', expected])
+
+    def test_state_filter(self):
+        """ Text after a comma narrows by state name or abbreviation """
+        for text in ('Tampa, ks', 'tampa, Kan'):
+            self.assertEqual([place['state'] for place in self.index.suggest(text)], ['Kansas'])
+
+    def test_suggestions_resolve(self):
+        """ Every suggested name looks up to the suggested place """
+        for prefix in ('san', 'spring', 'new', 'n'):
+            for place in self.index.suggest(prefix):
+                self.assertEqual(self.places.lookup(place['city'], place['state'])['place'], place['place'])
+
+    def test_no_match(self):
+        """ Unknown and empty prefixes suggest nothing """
+        self.assertEqual(self.index.suggest('zzzz'), [])
+        self.assertEqual(self.index.suggest('  '), [])
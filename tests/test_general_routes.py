@@ -1,24 +1,24 @@
 """ General View tests """
 
 # to run:
-#    FLASK_ENV=production python3 -m unittest tests/test_general_routes.py
+#    python3 -m unittest tests/test_general_routes.py
 
-import os
-from unittest import TestCase
+import os, subprocess, sys
+from unittest import TestCase, mock
+from sqlalchemy import event
 
 from models import db, connect_db, User, User_Favorites
 
 # Specify test database
 os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
 
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY, user_cache, QueryBudgetExceeded
+from tests import app
 
 # Create tables
 db.drop_all()
 db.create_all()
 
-app.config['WTF_CSRF_ENABLED'] = False
-
 class GeneralViewTestCase(TestCase):
     """ Test views for home, login, register """
 
@@ -52,8 +52,21 @@ class GeneralViewTestCase(TestCase):
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
+        user_cache.clear()
         return res
 
+    def count_queries(self, fn):
+        """ Run fn, returning the SQL statements it executed """
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return statements
+
     def test_no_session_show_home_page(self):
         """ Home page with no user logged in """
 
@@ -129,4 +142,182 @@ class GeneralViewTestCase(TestCase):
 
             self.assertEqual(response.status_code, 200)
             self.assertIn('Log in', str(response.data))
-            self.assertIn('Let Relocation Assistant get you the information you need.', str(response.data))
\ No newline at end of file
+            self.assertIn('Let Relocation Assistant get you the information you need.', str(response.data))
+
+    def test_static_skips_user_query(self):
+        """ Static files don't load the logged in user """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            statements = self.count_queries(lambda: self.client.get('/static/stylesheet.css'))
+
+        self.assertEqual(statements, [])
+
+    def test_user_identity_cache(self):
+        """ A second page view reuses the cached user row """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            self.client.get('/')
+            statements = self.count_queries(lambda: self.client.get('/'))
+            response = self.client.get('/')
+
+        self.assertFalse([sql for sql in statements if 'FROM users' in sql])
+        self.assertIn('testuser1', str(response.data))
+
+    def test_versioned_static_urls(self):
+        """ Pages link static files by content hash, which are cached for good """
+        with self.client as c:
+            response = self.client.get('/')
+            self.assertIn('/static/stylesheet.css?v=', str(response.data))
+            self.assertIn('no-cache', response.headers['Cache-Control'])
+
+            url = str(response.data).split('/static/stylesheet.css?v=')[1].split('"')[0]
+            response = self.client.get(f'/static/stylesheet.css?v={url}')
+
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+
+    def test_outdated_static_version(self):
+        """ A ?v= that isn't the file's hash is only cached briefly """
+        response = self.client.get('/static/stylesheet.css?v=0123456789ab')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=300', response.headers['Cache-Control'])
+
+    def test_logged_in_pages_private(self):
+        """ Pages shown to a logged in user are never shared """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            response = self.client.get('/')
+
+        self.assertIn('private', response.headers['Cache-Control'])
+
+    def test_server_timing(self):
+        """ Responses say how long their db work took """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            response = self.client.get(f'/users/{self.user1.id}')
+
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertIn('render;dur=', response.headers['Server-Timing'])
+        self.assertIn('total;dur=', response.headers['Server-Timing'])
+
+    def test_metrics(self):
+        """ /metrics aggregates timings in the Prometheus format """
+        self.client.get('/')
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('reloc_request_seconds_count{endpoint="views.show_homepage",method="GET"}', str(response.data))
+        self.assertIn('reloc_template_render_seconds_bucket{template="home.html",le="+Inf"}', str(response.data))
+        self.assertIn('reloc_upstream_circuit_open{host="api.census.gov"} 0', str(response.data))
+        self.assertIn('reloc_cache_events_total{cache="census",event="stale_hits"}', str(response.data))
+
+    def test_query_budget(self):
+        """ The user page stays within its declared budget of 3 queries """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            statements = self.count_queries(lambda: self.client.get(f'/users/{self.user1.id}'))
+
+        self.assertLessEqual(len(statements), 3)
+
+    def test_query_budget_exceeded(self):
+        """ Going over budget fails under QUERY_BUDGET_STRICT and is logged otherwise """
+        view = app.view_functions['views.show_user_info']
+        view.query_budget = (0, None)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1.id
+
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(f'/users/{self.user1.id}')
+
+                app.config['QUERY_BUDGET_STRICT'] = False
+                with self.assertLogs(app.logger, 'WARNING') as logs:
+                    response = self.client.get(f'/users/{self.user1.id}')
+        finally:
+            view.query_budget = (3, None)
+            app.config['QUERY_BUDGET_STRICT'] = True
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'GET /users/{self.user1.id}', logs.output[0])
+
+    def test_repeated_query(self):
+        """ The same statement run over and over is reported as a likely N+1 """
+        view = app.view_functions['views.show_homepage']
+        def homepage():
+            for _ in range(3):
+                User.query.filter(User.id == self.user1.id).all()
+            return 'ok'
+
+        app.view_functions['views.show_homepage'] = homepage
+        try:
+            with self.assertRaises(QueryBudgetExceeded) as raised:
+                self.client.get('/')
+        finally:
+            app.view_functions['views.show_homepage'] = view
+
+        self.assertIn('3x SELECT', str(raised.exception))
+
+
+class StartupTestCase(TestCase):
+    """ Test profiles and what the app loads at startup """
+
+    def test_test_profile(self):
+        self.assertEqual(app.config['PROFILE'], 'test')
+        self.assertTrue(app.config['QUERY_BUDGET_STRICT'])
+        self.assertNotIn('flask_debugtoolbar', sys.modules)
+
+        with self.assertRaises(ValueError):
+            create_app('staging')
+
+    def test_separate_apps(self):
+        """ Each create_app call builds its own app with the same routes """
+        # connect_db points db at the newest app; the tests keep using theirs
+        self.addCleanup(setattr, db, 'app', app)
+        prod = create_app('prod')
+
+        self.assertIsNot(prod, app)
+        self.assertEqual(prod.config['PROFILE'], 'prod')
+        self.assertFalse(prod.config['QUERY_BUDGET_STRICT'])
+        self.assertEqual(app.config['PROFILE'], 'test')
+        self.assertEqual(prod.test_client().get('/health').data, b'ok')
+        self.assertEqual(sorted(prod.view_functions), sorted(app.view_functions))
+
+    def test_prod_import(self):
+        """ Production doesn't import the toolbar or NumPy, or read the gazetteer, at startup """
+        script = ('import sys, app; web = app.create_app(); '
+                  'print(web.config["PROFILE"], "flask_debugtoolbar" in sys.modules, '
+                  '"numpy" in sys.modules, app.places is None)')
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                                env=dict(os.environ, APP_PROFILE='prod'),
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+
+        self.assertEqual(output.split(), ['prod', 'False', 'False', 'True'])
+
+    def test_connection_after_fork(self):
+        """ A worker forked with pooled connections opens its own, leaving the parent's open """
+        with db.engine.connect() as conn:
+            parent = conn.connection.dbapi_connection
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            with db.engine.connect() as conn:
+                child = conn.connection.dbapi_connection
+                conn.execute(db.text('SELECT 1'))
+
+        self.assertIsNot(child, parent)
+        self.assertFalse(parent.closed)
+        parent.close()
+        # the connection the "child" opened is the one left in the pool
+        db.engine.dispose()
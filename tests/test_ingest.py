@@ -0,0 +1,156 @@
+""" ACS ingestion and city_stats tests """
+
+# to run:
+#    python3 -m unittest tests/test_ingest.py
+
+import os, tempfile
+from unittest import TestCase, mock
+
+from models import db, City_Stats, upgrade_db
+
+# Specify test database
+os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
+
+import app as app_module
+from app import get_census_data, census_cache, CENSUS_VARS
+from tests import app
+from statstore import build
+from ingest import IngestError, fetch_state, ingest, parse_value
+
+# Create tables
+db.drop_all()
+db.create_all()
+
+class RecordedResponse:
+    """ Stands in for a census response recorded from the live API """
+
+    status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return [['NAME', 'DP05_0001E', 'DP05_0018E', 'DP03_0062E', 'DP04_0089E', 'state', 'place'],
+                ['Tampa city, Florida', '384959', '35.8', '55462', '234000', '12', '71000'],
+                ['Nowhere CDP, Florida', '12', '-666666666', '-888888888', '-888888888', '12', '99999']]
+
+class RecordedClient:
+    def get(self, url):
+        return RecordedResponse()
+
+class NoContentResponse(RecordedResponse):
+    """ What the census sends for a state it has no places for """
+
+    status_code = 204
+
+class PartialClient:
+    """ Answers every state but Florida """
+
+    def get(self, url):
+        return NoContentResponse() if url.endswith('state:12') else RecordedResponse()
+
+class IngestTestCase(TestCase):
+    """ Test parsing and loading of ACS rows """
+
+    def setUp(self):
+        # lookups read the app's config
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        City_Stats.query.delete()
+        db.session.commit()
+        census_cache.memory.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        app.config['CITY_STATS_PATH'] = os.path.join(self.dir.name, 'city_stats.bin')
+        app_module.stats_matrix = None
+        app_module.city_stats_loaded = None
+
+    def tearDown(self):
+        app_module.stats_matrix = None
+        app_module.city_stats_loaded = None
+        self.dir.cleanup()
+
+    def test_parse_value(self):
+        self.assertEqual(parse_value('55462', int), 55462)
+        self.assertEqual(parse_value('35.8', float), 35.8)
+        self.assertIsNone(parse_value('-888888888', int))
+        self.assertIsNone(parse_value(None, int))
+
+    def test_fetch_state(self):
+        rows = fetch_state(RecordedClient(), '2019', CENSUS_VARS, '12')
+
+        self.assertEqual(rows[0], ('2019', '12', '71000', 'Tampa city, Florida', 384959, 35.8, 55462, 234000))
+        self.assertEqual(rows[1][5:], (None, None, None))
+
+    def test_incomplete_download(self):
+        """ A state with no places keeps the vintage already loaded """
+        City_Stats.replace_vintage('2019', fetch_state(RecordedClient(), '2019', CENSUS_VARS, '12'))
+
+        with self.assertRaises(IngestError) as raised:
+            ingest(PartialClient(), '2019', CENSUS_VARS, workers=4, echo=lambda line: None)
+
+        self.assertIn('Florida', str(raised.exception))
+        self.assertEqual(City_Stats.query.filter_by(vintage='2019').count(), 2)
+
+        with self.assertRaises(ValueError):
+            City_Stats.replace_vintage('2019', [])
+
+    def test_upgrade_creates_table(self):
+        """ Databases from before city_stats get the table from flask upgrade-db """
+        City_Stats.__table__.drop(db.engine)
+        self.assertNotIn('city_stats', db.inspect(db.engine).get_table_names())
+
+        upgrade_db()
+        self.assertIn('city_stats', db.inspect(db.engine).get_table_names())
+
+    def test_get_census_data_from_table(self):
+        """ Loaded rows are served without calling the census """
+        City_Stats.replace_vintage('2019', fetch_state(RecordedClient(), '2019', CENSUS_VARS, '12'))
+
+        self.assertEqual(get_census_data('71000', '12'),
+                         {'pop':'384959', 'age':'35.8', 'inc':'55462', 'home':'234000',
+                          'state':'12', 'place':'71000'})
+        self.assertEqual(get_census_data('99999', '12')['inc'], 'no data available')
+
+    def test_table_rows_kept_in_memory(self):
+        """ A place read from the table is looked up once per worker """
+        City_Stats.replace_vintage('2019', fetch_state(RecordedClient(), '2019', CENSUS_VARS, '12'))
+        first = get_census_data('71000', '12')
+
+        with mock.patch.object(City_Stats, 'lookup', side_effect=AssertionError('queried')):
+            self.assertEqual(get_census_data('71000', '12'), first)
+
+    def test_missing_table_checked_once(self):
+        """ Without city_stats, lookups go to the census after one failed query, logged once """
+        City_Stats.__table__.drop(db.engine)
+        self.addCleanup(City_Stats.__table__.create, db.engine)
+
+        with mock.patch.object(app_module, 'fetch_census_data', return_value=None) as fetch, \
+             self.assertLogs(app_module.log, 'WARNING') as logs:
+            for place in ('90001', '90002', '90003'):
+                self.assertFalse(get_census_data(place, '12'))
+
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIs(app_module.city_stats_loaded, False)
+
+    def test_empty_table_checked_once(self):
+        """ An empty city_stats costs one query per worker, not one per lookup """
+        with mock.patch.object(app_module, 'fetch_census_data', return_value=None):
+            get_census_data('71000', '12')
+            with mock.patch.object(City_Stats, 'has_vintage', side_effect=AssertionError('checked')), \
+                 mock.patch.object(City_Stats, 'lookup', side_effect=AssertionError('queried')):
+                get_census_data('45000', '12')
+
+    def test_get_census_data_from_file(self):
+        """ Once the file is written, lookups read it instead of the table """
+        City_Stats.replace_vintage('2019', fetch_state(RecordedClient(), '2019', CENSUS_VARS, '12'))
+        from_table = get_census_data('71000', '12')
+
+        self.assertEqual(build(app.config['CITY_STATS_PATH'], '2019'), 2)
+        City_Stats.query.delete()
+        db.session.commit()
+        census_cache.memory.clear()
+
+        self.assertEqual(get_census_data('71000', '12'), from_table)
+        self.assertEqual(get_census_data('99999', '12')['inc'], 'no data available')
@@ -0,0 +1,71 @@
+""" Metrics tests """
+
+# to run:
+#    python3 -m unittest tests/test_metrics.py
+
+from unittest import TestCase
+
+import metrics
+
+
+class HistogramTestCase(TestCase):
+    """ Test histogram buckets and text output """
+
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('latency_seconds', 'Latency.', labels=('route',), buckets=(.1, 1))
+        for value in (.05, .1, .5, 5):
+            histogram.observe(value, '/')
+
+        lines = histogram.render()
+
+        self.assertIn('latency_seconds_bucket{route="/",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="/",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{route="/"} 4', lines)
+        self.assertIn('latency_seconds_sum{route="/"} 5.65', lines)
+
+    def test_collected(self):
+        gauge = metrics.Collected('circuit_open', 'Open circuits.', lambda: {('census',): 1},
+                                  labels=('host',))
+
+        self.assertIn('# TYPE circuit_open gauge', gauge.render())
+        self.assertIn('circuit_open{host="census"} 1', gauge.render())
+
+    def test_label_escaping(self):
+        counter = metrics.Counter('hits_total', 'Hits.', labels=('name',))
+        counter.inc('say "hi"')
+
+        self.assertIn('hits_total{name="say \\"hi\\""} 1', counter.render())
+
+
+class RequestTimingsTestCase(TestCase):
+    """ Test per-request timing attribution """
+
+    def test_pool_work_is_charged_to_the_request(self):
+        pool = metrics.ContextThreadPoolExecutor(max_workers=1)
+        timings = metrics.RequestTimings()
+        token = metrics.current.set(timings)
+        try:
+            pool.submit(metrics.record, 'api', 0.25).result()
+        finally:
+            metrics.current.reset(token)
+            pool.shutdown()
+
+        self.assertIn('api;dur=250.0;desc="1x"', timings.server_timing())
+
+    def test_server_timing_names(self):
+        """ Names are sent as tokens, descriptions in desc """
+        timings = metrics.RequestTimings()
+        timings.add('census', 0.25, 'api.census.gov')
+        timings.add('census', 0.25, 'api.census.gov')
+        timings.add('127.0.0.1:8801', 0.1)
+
+        header = timings.server_timing()
+        self.assertIn('census;dur=500.0;desc="api.census.gov 2x"', header)
+        self.assertIn('127.0.0.1-8801;dur=100.0;desc="1x"', header)
+
+    def test_no_request(self):
+        """ Outside a request, recording does nothing """
+        metrics.record('api', 1)
+
+        self.assertIsNone(metrics.current.get())
@@ -0,0 +1,90 @@
+""" Destination ranking tests """
+
+# to run:
+#    python3 -m unittest tests/test_recommend.py
+
+import os, tempfile
+from unittest import TestCase
+
+from models import db, City_Stats, Census_Cache
+
+# Specify test database
+os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
+
+import app as app_module
+from tests import app
+from recommend import StatsMatrix
+from statstore import StatsStore
+
+# Create tables
+db.drop_all()
+db.create_all()
+
+ROWS = [
+    ('12', '71000', 'Tampa city, Florida', 384959, 55462, 234000),
+    ('12', '45000', 'Miami city, Florida', 454279, 44268, 317500),
+    ('48', '05000', 'Austin city, Texas', 950807, 71576, 326400),
+    ('39', '18000', 'Cleveland city, Ohio', 383331, 30907, 71000),
+    ('39', '99999', 'Tiny village, Ohio', 120, 90000, 50000),
+    ('39', '99998', 'Nodata village, Ohio', 8000, None, 50000),
+]
+
+class StatsMatrixTestCase(TestCase):
+    """ Test vectorized ranking """
+
+    def test_rank(self):
+        """ Best gain first, origin, small and no-data places left out """
+        matrix = StatsMatrix(ROWS)
+        ranked = matrix.rank(55462, 234000, limit=2, min_pop=1000, exclude=('71000', '12'))
+
+        self.assertEqual([dest['city'] for dest in ranked], ['Cleveland', 'Austin'])
+        self.assertEqual(ranked[0]['inc_ratio'], 0.56)
+        self.assertEqual(ranked[0]['home_ratio'], 0.3)
+        self.assertEqual(ranked[0]['state_name'], 'Ohio')
+
+    def test_empty(self):
+        self.assertEqual(StatsMatrix([]).rank(1, 1), [])
+
+class RecommendViewTestCase(TestCase):
+    """ Test /cities/recommend """
+
+    def setUp(self):
+        City_Stats.query.delete()
+        db.session.commit()
+        self.dir = tempfile.TemporaryDirectory()
+        app.config['CITY_STATS_PATH'] = os.path.join(self.dir.name, 'city_stats.bin')
+        app_module.stats_matrix = None
+        app_module.city_stats_loaded = None
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app_module.stats_matrix = None
+        app_module.city_stats_loaded = None
+        self.dir.cleanup()
+        app_module.census_cache.memory.clear()
+        Census_Cache.query.delete()
+        db.session.commit()
+
+    def test_recommend(self):
+        City_Stats.replace_vintage('2019', [('2019', state, place, name, pop, 35.0, inc, home)
+                                            for state, place, name, pop, inc, home in ROWS])
+
+        response = self.client.get('/cities/recommend?city=Tampa&state=Florida&limit=3')
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['destinations'][0]['city'], 'Cleveland')
+        self.assertEqual(len(data['destinations']), 3)
+        self.assertIn('msg', data['destinations'][0]['advice'])
+        # written from the table on first use, and mapped from then on
+        self.assertTrue(os.path.exists(app.config['CITY_STATS_PATH']))
+        self.assertIsInstance(app_module.stats_matrix, StatsStore)
+
+    def test_not_loaded(self):
+        """ 503 until flask ingest-acs has run """
+        app_module.census_cache.set(('2019', ','.join(app_module.CENSUS_VARS.values()), '71000', '12'),
+                                    {'pop':'1', 'age':'1', 'inc':'50000', 'home':'200000',
+                                     'state':'12', 'place':'71000'})
+
+        response = self.client.get('/cities/recommend?city=Tampa&state=Florida')
+        self.assertEqual(response.status_code, 503)
@@ -0,0 +1,55 @@
+""" Census/OpenWeather stand-in server tests """
+
+# to run:
+#    python3 -m unittest tests/test_standin.py
+
+from unittest import TestCase
+
+import requests
+
+from benchmarks.standin import Behavior, serve
+
+
+class StandInTestCase(TestCase):
+    """ Test the stand-in replays fixtures and injects failures """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.behavior = Behavior()
+        cls.server = serve(0, cls.behavior)
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.behavior.error_rate = 0
+
+    def test_census_profile(self):
+        res = requests.get(f'{self.url}/data/2019/acs/acs5/profile?get=NAME,DP05_0001E&for=place:71000&in=state:12')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()[1][0], 'Tampa city, Florida')
+
+    def test_unknown_place(self):
+        res = requests.get(f'{self.url}/data/2019/acs/acs5/profile?get=NAME&for=place:99999&in=state:12')
+
+        self.assertEqual(res.status_code, 204)
+
+    def test_place_names(self):
+        res = requests.get(f'{self.url}/data/2019/acs/acs5/subject?get=NAME&for=place:45000,71000&in=state:12')
+
+        self.assertEqual([row[0] for row in res.json()[1:]], ['Miami city, Florida', 'Tampa city, Florida'])
+
+    def test_weather(self):
+        res = requests.get(f'{self.url}/data/2.5/weather?q=Miami,FL,US&units=imperial&appid=x')
+
+        self.assertEqual(res.json()['name'], 'Miami')
+        self.assertIn('temp', res.json()['main'])
+
+    def test_injected_errors(self):
+        self.behavior.error_rate = 1
+        res = requests.get(f'{self.url}/data/2.5/weather?q=Miami,FL,US')
+
+        self.assertEqual(res.status_code, 503)
@@ -0,0 +1,81 @@
+""" Memory-mapped city_stats file tests """
+
+# to run:
+#    python3 -m unittest tests/test_statstore.py
+
+import os, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from recommend import StatsMatrix
+from statstore import StatsStore, write
+
+ROWS = [
+    ('2019', '48', '05000', 'Austin city, Texas', 950807, 33.9, 71576, 326400),
+    ('2019', '12', '71000', 'Tampa city, Florida', 384959, 35.8, 55462, 234000),
+    ('2019', '12', '45000', 'Miami city, Florida', 454279, 40.1, 44268, 317500),
+    ('2019', '39', '18000', 'Cleveland city, Ohio', 383331, 36.3, 30907, 71000),
+    ('2019', '72', '76770', 'San Juan zona urbana, Puerto Rico', 318441, None, None, 123100),
+]
+
+class StatsStoreTestCase(TestCase):
+    """ Test writing, mapping and reading the city_stats file """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'city_stats.bin')
+        self.assertEqual(write(self.path, '2019', ROWS), 5)
+        self.store = StatsStore.open(self.path, '2019')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_lookup(self):
+        """ Rows come back as written, no data as None """
+        self.assertEqual(self.store.lookup('71000', '12'),
+                         {'pop':384959, 'age':35.8, 'inc':55462, 'home':234000})
+        self.assertEqual(self.store.lookup('76770', '72'),
+                         {'pop':318441, 'age':None, 'inc':None, 'home':123100})
+        self.assertIsNone(self.store.lookup('71000', '48'))
+        self.assertIsNone(self.store.lookup('99999', '12'))
+        self.assertIsNone(self.store.lookup('7100', '12'))
+
+    def test_names(self):
+        """ Names are sorted with their rows, multi-byte text included """
+        self.assertEqual([self.store.name(i) for i in range(len(self.store))],
+                         ['Miami city, Florida', 'Tampa city, Florida', 'Cleveland city, Ohio',
+                          'Austin city, Texas', 'San Juan zona urbana, Puerto Rico'])
+
+    def test_zero_copy(self):
+        """ Columns are read-only views of the mapping, not copies """
+        for column in (self.store.pop, self.store.inc, self.store.state, self.store.place):
+            self.assertFalse(column.flags.owndata)
+            self.assertFalse(column.flags.writeable)
+
+    def test_rank_matches_matrix(self):
+        """ Ranking the mapped file gives what ranking the rows in memory does """
+        matrix = StatsMatrix([(state, place, name, pop, inc, home)
+                              for _, state, place, name, pop, age, inc, home in ROWS])
+
+        self.assertEqual(self.store.rank(55462, 234000, exclude=('71000', '12')),
+                         matrix.rank(55462, 234000, exclude=('71000', '12')))
+
+    def test_wrong_vintage(self):
+        with self.assertRaises(ValueError):
+            StatsStore.open(self.path, '2020')
+
+    def test_replace(self):
+        """ Rewriting the file leaves an open mapping on the old contents """
+        write(self.path, '2019', ROWS[:1])
+
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(len(StatsStore.open(self.path, '2019')), 1)
+
+    def test_concurrent_writes(self):
+        """ Threads writing at once each replace the file whole, leaving no temporaries """
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            counts = list(pool.map(lambda n: write(self.path, '2019', ROWS[:n]), [1, 2, 3, 4, 5] * 4))
+
+        self.assertEqual(counts, [1, 2, 3, 4, 5] * 4)
+        self.assertIn(len(StatsStore.open(self.path, '2019')), range(1, 6))
+        self.assertEqual(os.listdir(self.dir.name), ['city_stats.bin'])
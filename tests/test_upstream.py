@@ -0,0 +1,100 @@
+""" Upstream client tests """
+
+# to run:
+#    python3 -m unittest tests/test_upstream.py
+
+import threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+from upstream import Upstream, UpstreamClient, CircuitOpenError
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """ Fails the first `failures` requests with a 503, then answers 200 """
+
+    protocol_version = "HTTP/1.1"
+    failures = 0
+
+    def do_GET(self):
+        if FlakyHandler.failures:
+            FlakyHandler.failures -= 1
+            self.send_response(503)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+class UpstreamClientTestCase(TestCase):
+    """ Test retries and stats against a local server """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/data'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.client = UpstreamClient([Upstream('127.0.0.1', timeout=1, retries=2, backoff=0.001)])
+
+    def test_retries_server_errors(self):
+        FlakyHandler.failures = 2
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, 200)
+        stats = self.client.stats()['upstreams']['127.0.0.1']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['errors'], 0)
+
+    def test_gives_up_after_retries(self):
+        FlakyHandler.failures = 5
+        res = self.client.get(self.url)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(self.client.stats()['upstreams']['127.0.0.1']['errors'], 1)
+        FlakyHandler.failures = 0
+
+    def test_reuses_connections(self):
+        for _ in range(3):
+            self.client.get(self.url)
+
+        pool = self.client.stats()['pools']['http://127.0.0.1']
+        self.assertEqual(pool['requests'], 3)
+        self.assertEqual(pool['connections_opened'], 1)
+
+    def test_circuit_opens(self):
+        """ Repeated failures fail fast until a trial call succeeds """
+        upstream = Upstream('127.0.0.1', timeout=1, retries=0, failure_threshold=2, reset_timeout=0.05)
+        client = UpstreamClient([upstream])
+        FlakyHandler.failures = 2
+        for _ in range(2):
+            self.assertEqual(client.get(self.url).status_code, 503)
+
+        self.assertEqual(upstream.circuit(), 'open')
+        with self.assertRaises(CircuitOpenError):
+            client.get(self.url)
+        self.assertEqual(client.stats()['upstreams']['127.0.0.1']['rejected'], 1)
+
+        time.sleep(0.06)
+        self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(upstream.circuit(), 'closed')
+
+    def test_failed_trial_reopens(self):
+        upstream = Upstream('127.0.0.1', failure_threshold=1, reset_timeout=0.05)
+        upstream.record(0.1, 0, True)
+        time.sleep(0.06)
+
+        self.assertTrue(upstream.allow())
+        self.assertFalse(upstream.allow())
+        self.assertEqual(upstream.circuit(), 'half_open')
+        upstream.record(0.1, 0, True)
+        self.assertEqual(upstream.circuit(), 'open')
+        self.assertFalse(upstream.allow())
@@ -12,7 +12,7 @@ from models import db, User, User_Favorites
 # Specify test database
 os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
 
-from app import app
+from tests import app
 
 # Create tables
 db.drop_all()
@@ -73,7 +73,24 @@ class User_FavoritesModelTestCase(TestCase):
         self.assertEqual(len(self.user1.favorites), 1)
         self.assertEqual(len(self.user2.favorites), 0)
 
-        
+    #===== TOGGLE =====================
+    #==================================
+    def test_toggle(self):
+        """ Toggling adds the favorite, toggling again removes it """
+        self.assertTrue(User_Favorites.toggle(self.user1.id, '00484', '01', city_name='Addison'))
+        db.session.commit()
+
+        self.assertTrue(User_Favorites.is_favorite(self.user1.id, '00484', '01'))
+        self.assertEqual(self.user1.favorites[0].city_name, 'Addison')
+
+        self.assertFalse(User_Favorites.toggle(self.user1.id, '00484', '01'))
+        db.session.commit()
 
+        self.assertFalse(User_Favorites.is_favorite(self.user1.id, '00484', '01'))
 
+    def test_unique_favorite(self):
+        """ The same city can't be favorited twice by one user """
+        db.session.add(User_Favorites(user_id=self.user1.id, city_id='00484', state_id='01'))
+        db.session.add(User_Favorites(user_id=self.user1.id, city_id='00484', state_id='01'))
 
+        with self.assertRaises(exc.IntegrityError): db.session.commit()
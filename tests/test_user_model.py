@@ -7,18 +7,18 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, User_Favorites
+from models import db, passwords, User, User_Favorites
+from passwords import hash_rounds
 
 # Specify test database
 os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
 
-from app import app
+from tests import app
 
 # Create tables
 db.drop_all()
 db.create_all()
 
-
 class UserModelTestCase(TestCase):
     """ Test User model """
 
@@ -141,3 +141,17 @@ class UserModelTestCase(TestCase):
     def test_bad_password_authenticate(self):
         """ testuser1 signed up in setup function """
         self.assertFalse(User.authenticate('testuser1', 'bad_pw'))
+
+    def test_rehash_on_login(self):
+        """ A password hashed at an old cost factor is upgraded on login """
+        rounds = passwords.rounds
+        passwords.rounds = 4
+        try:
+            user = User.authenticate('testuser1','testpw1')
+            db.session.commit()
+
+            self.assertEqual(hash_rounds(user.password), 4)
+            self.assertFalse(passwords.needs_rehash(user.password))
+            self.assertIsInstance(User.authenticate('testuser1','testpw1'), User)
+        finally:
+            passwords.rounds = rounds
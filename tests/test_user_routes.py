@@ -1,17 +1,22 @@
 """ User View tests """
 
 # to run:
-#    FLASK_ENV=production python3 -m unittest tests/test_user_routes.py
+#    python3 -m unittest tests/test_user_routes.py
 
 import os, requests
-from unittest import TestCase
+from unittest import TestCase, mock
+from concurrent.futures import ThreadPoolExecutor
 
 from models import db, connect_db, User, User_Favorites
 
 # Specify test database
 os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
 
-from app import app, CURR_USER_KEY
+import app as app_module
+from app import CURR_USER_KEY, user_cache, places_cache
+from tests import app
+from upstream import CircuitOpenError
+from benchmarks import standin
 
 # Create tables
 db.drop_all()
@@ -19,15 +24,24 @@ db.create_all()
 
 db.session.commit()
 
-app.config['WTF_CSRF_ENABLED'] = False
-
 class UserViewTestCase(TestCase):
     """ Test views for users """
 
+    @classmethod
+    def setUpClass(cls):
+        """ Answer census and weather requests from the recorded payloads """
+        server = standin.serve(0, standin.Behavior())
+        cls.addClassCleanup(server.shutdown)
+        for name in ('CENSUS_API', 'WEATHER_API'):
+            patch = mock.patch.object(app_module, name, f'http://127.0.0.1:{server.server_port}')
+            patch.start()
+            cls.addClassCleanup(patch.stop)
+
     def setUp(self):
         """ Create test client, add sample data """
         User.query.delete()
         User_Favorites.query.delete()
+        places_cache.memory.clear()
 
         self.client = app.test_client()
 
@@ -63,6 +77,7 @@ class UserViewTestCase(TestCase):
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
+        user_cache.clear()
         return res
 
     def no_session_tests(self, res, msg, pg_heading):
@@ -88,7 +103,7 @@ class UserViewTestCase(TestCase):
                 sess[CURR_USER_KEY] = self.user1.id
 
             city_data = requests.get(
-                f'https://api.census.gov/data/2019/acs/acs5/subject?get=NAME&for=place:{self.user1.user_city}&in=state:{self.user1.user_state}'
+                f'{app_module.CENSUS_API}/data/2019/acs/acs5/subject?get=NAME&for=place:{self.user1.user_city}&in=state:{self.user1.user_state}'
             ).json()
 
             city = city_data[1][0].rsplit(',',1)[0].rsplit(' ',1)[0]
@@ -99,6 +114,45 @@ class UserViewTestCase(TestCase):
             self.assertIn(f'Username: {self.user1.username}', str(response.data))
             self.assertIn(f'{city}', str(response.data))
 
+    def test_show_user_favorites(self):
+        """ Shows home city and favorite names from the local gazetteer """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            response = self.client.get(f'/users/{self.user1.id}')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Home City: Wayzata, Minnesota', str(response.data))
+            self.assertIn('Abbeville, Alabama', str(response.data))
+
+    def test_show_user_stored_names(self):
+        """ Uses the city names stored with favorites """
+        self.favorite1.city_name = 'Stored City'
+        self.favorite1.state_name = 'Stored State'
+        self.favorite1.city_stats = {'pop':'100', 'age':'30', 'inc':'50000', 'home':'150000'}
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            response = self.client.get(f'/users/{self.user1.id}')
+
+            self.assertIn('Stored City, Stored State', str(response.data))
+            self.assertIn('Income: $50,000', str(response.data))
+
+    def test_backfill_cities(self):
+        """ Backfill command stores names on existing users and favorites """
+        fav_id = self.favorite1.id
+        user_id = self.user1.id
+
+        result = app.test_cli_runner().invoke(args=['backfill-cities'])
+
+        self.assertIn('Done', result.output)
+        self.assertEqual(User_Favorites.query.get(fav_id).city_name, 'Abbeville')
+        self.assertEqual(User.query.get(user_id).abbr, 'MN')
+
     def test_no_session_edit_user(self):
         """ Display warning, redirect to login screen """
         with self.client as c:
@@ -136,6 +190,29 @@ class UserViewTestCase(TestCase):
         self.assertIn(f'{self.user1.username}',str(response.data))
         self.assertIn('changed@test.com', str(response.data))
 
+    def test_edit_checks_current_password(self):
+        """ A password changed since the user was cached is checked against the db """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+            self.client.get(f'/users/{self.user1.id}/edit')
+            self.assertNotIn('password', user_cache.get(self.user1.id))
+
+            # changed by another worker, so this worker's cache still has the user
+            user = User.query.get(self.user1.id)
+            user.set_password('newpw1')
+            db.session.commit()
+
+            response = self.client.post(f'/users/{self.user1.id}/edit',
+                                        data={'old_pw':'testpw1', 'email':'old@test.com'},
+                                        follow_redirects=True)
+            self.assertIn('Username/password incorrect', str(response.data))
+
+            response = self.client.post(f'/users/{self.user1.id}/edit',
+                                        data={'old_pw':'newpw1', 'email':'new@test.com'},
+                                        follow_redirects=True)
+            self.assertIn('new@test.com', str(response.data))
+
     def test_toggle_fav_city(self):
         """ Remove favorite from favorites table """
         with self.client as c:
@@ -148,6 +225,67 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("fas fa-heart", str(response.data))
             self.assertNotIn(self.favorite1.id, [fav.id for fav in User_Favorites.query.all()])
 
+    def test_unfavorite_skips_lookups(self):
+        """ Removing a favorite looks nothing up """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            with mock.patch.object(app_module, 'city_details', side_effect=AssertionError('looked up')):
+                response = self.client.post('/users/favs/add/00124/01')
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(User_Favorites.query.filter_by(city_id='00124').count(), 0)
+
+    def test_favorite_during_outage(self):
+        """ A new favorite is saved without names when the census is down """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            with mock.patch.object(app_module, 'fetch_place_names', side_effect=requests.ConnectionError), \
+                 mock.patch.object(app_module, 'get_census_data', return_value=False):
+                response = self.client.post('/users/favs/add/99999/01')
+
+        self.assertEqual(response.status_code, 204)
+        favorite = User_Favorites.query.filter_by(user_id=self.user1.id, city_id='99999').one()
+        self.assertIsNone(favorite.city_name)
+
+    def test_register_during_outage(self):
+        """ A city the gazetteer doesn't list can't be looked up while the census is down """
+        form = {'username':'testuser3', 'password':'testpw3', 'email':'test3@test.com',
+                'user-city':'Nowhereville', 'user-state':'Florida'}
+
+        with mock.patch.object(app_module, 'fetch_census_codes', side_effect=CircuitOpenError('down')):
+            response = self.client.post('/register', data=form)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('The US Census service is not responding right now.', str(response.data))
+        self.assertEqual(User.query.filter_by(username='testuser3').count(), 0)
+
+    def test_register_with_stale_codes(self):
+        """ Codes looked up before an outage are still served during it """
+        form = {'username':'testuser3', 'password':'testpw3', 'email':'test3@test.com',
+                'user-city':'Nowhereville', 'user-state':'Florida'}
+        # expired a second ago, so it's only served as stale
+        places_cache.memory.set(('codes', 'Nowhereville', 'Florida'), {'place':'99999', 'state':'12'}, -1)
+
+        errors = places_cache.stats()['refresh_errors']
+        # the stale answer starts a refresh; it runs on this pool, so it
+        # can be finished while fetch_census_codes is still patched
+        pool = ThreadPoolExecutor(max_workers=1)
+
+        with mock.patch.object(app_module, 'fetch_census_codes', side_effect=requests.ConnectionError), \
+             mock.patch.object(app_module, 'city_details', return_value={}), \
+             mock.patch.object(places_cache, 'refresh_pool', pool):
+            response = self.client.post('/register', data=form)
+            pool.shutdown(wait=True)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(places_cache.stats()['refresh_errors'], errors + 1)
+        user = User.query.filter_by(username='testuser3').one()
+        self.assertEqual((user.user_city, user.user_state), ('99999', '12'))
+
     def test_no_session_delete_user(self):
         """ Display warning, redirect to login screen """
         with self.client as c:
@@ -0,0 +1,138 @@
+""" Cache warming tests """
+
+# to run:
+#    python3 -m unittest tests/test_warm.py
+
+import os, time
+from unittest import TestCase, mock
+
+from models import db, User, User_Favorites, Census_Cache
+
+# Specify test database
+os.environ['DATABASE_URL'] = "postgresql:///relocation-asst-test"
+
+import app as app_module
+from app import census_cache, weather_cache
+from tests import app
+from warm import RateLimit, saved_places, warm
+
+# Create tables
+db.drop_all()
+db.create_all()
+
+class WarmTestCase(TestCase):
+    """ Test finding and prefetching users' places """
+
+    def setUp(self):
+        # lookups read the app's config
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        User_Favorites.query.delete()
+        User.query.delete()
+
+        tampa = User(username='tampa', password='x', email='tampa@example.com',
+                     user_city='71000', user_state='12', city_name='Tampa', abbr='FL')
+        miami = User(username='miami', password='x', email='miami@example.com',
+                     user_city='45000', user_state='12')
+        db.session.add_all([tampa, miami])
+        db.session.flush()
+        db.session.add_all([User_Favorites(user_id=tampa.id, city_id='45000', state_id='12',
+                                           city_name='Miami', abbr='FL'),
+                            User_Favorites(user_id=miami.id, city_id='05000', state_id='48')])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        census_cache.memory.clear()
+        weather_cache.memory.clear()
+
+    def test_saved_places(self):
+        """ Homes and favorites are deduped, most saved first, with any stored name """
+        self.assertEqual(saved_places(),
+                         [('45000', '12', 'Miami', 'FL'),
+                          ('71000', '12', 'Tampa', 'FL'),
+                          ('05000', '48', None, None)])
+        self.assertEqual(len(saved_places(limit=1)), 1)
+
+    def test_rate_limit(self):
+        """ Calls are spaced 1/rate apart """
+        limit = RateLimit(50)
+        start = time.monotonic()
+        for _ in range(5):
+            limit.wait()
+
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 50)
+
+    def test_warm(self):
+        """ One census call per state and one weather call per place, failures counted """
+        census_calls = []
+        weather_calls = []
+
+        def warm_census(codes, throttle):
+            throttle()
+            census_calls.append(sorted(codes))
+            return len(codes)
+
+        def warm_weather(place, state, city, abbr, throttle):
+            if state == '48':
+                raise ConnectionError('weather is down')
+            throttle()
+            weather_calls.append(city)
+            return 1
+
+        report = warm(saved_places(), warm_census, warm_weather, rate=0, echo=lambda line: None)
+
+        self.assertEqual(census_calls, [[('45000', '12'), ('71000', '12')], [('05000', '48')]])
+        self.assertEqual(weather_calls, ['Miami', 'Tampa'])
+        self.assertEqual({key: report[key] for key in ('places', 'census_fetched', 'weather_fetched',
+                                                        'failed', 'upstream_calls')},
+                         {'places': 3, 'census_fetched': 3, 'weather_fetched': 2,
+                          'failed': 1, 'upstream_calls': 4})
+
+    def test_warm_skips_cached(self):
+        """ Places already cached cost no upstream calls """
+        Census_Cache.query.delete()
+        db.session.commit()
+        census_cache.set(app_module.census_key('71000', '12'), {'pop':'1', 'age':'1', 'inc':'1', 'home':'1',
+                                                                 'state':'12', 'place':'71000'})
+        weather_cache.set(app_module.weather_key('Tampa', 'FL'), {'icon':'01d', 'temp':80})
+
+        def throttle():
+            self.fail('went upstream for a cached place')
+
+        self.assertEqual(app_module.warm_census([('71000', '12')], throttle), 0)
+        self.assertEqual(app_module.warm_weather('71000', '12', 'Tampa', 'FL', throttle), 0)
+
+    def test_warm_refreshes_stale(self):
+        """ Expired entries are fetched through the throttle, not refreshed in the background """
+        Census_Cache.query.delete()
+        db.session.commit()
+        tampa = {'pop':'1', 'age':'1', 'inc':'1', 'home':'1', 'state':'12', 'place':'71000'}
+        # expired a second ago, so they'd otherwise be served stale
+        census_cache.memory.set(app_module.census_key('71000', '12'), tampa, -1)
+        weather_cache.memory.set(app_module.weather_key('Tampa', 'FL'), {'icon':'01d', 'temp':80}, -1)
+        calls = []
+
+        # other tests may leave Tampa in city_stats, which never goes upstream
+        with mock.patch.object(app_module, 'local_census_data_many', return_value={}), \
+             mock.patch.object(app_module, 'fetch_census_data_many', return_value={'71000': dict(tampa, pop='2')}), \
+             mock.patch.object(app_module, 'fetch_weather', return_value={'icon':'02d', 'temp':81}), \
+             mock.patch.object(census_cache, 'refresh', side_effect=AssertionError('refreshed')), \
+             mock.patch.object(weather_cache, 'refresh', side_effect=AssertionError('refreshed')):
+            self.assertEqual(app_module.warm_census([('71000', '12')], lambda: calls.append('census')), 1)
+            self.assertEqual(app_module.warm_weather('71000', '12', 'Tampa', 'FL', lambda: calls.append('weather')), 1)
+
+        self.assertEqual(calls, ['census', 'weather'])
+        self.assertEqual(census_cache.get(app_module.census_key('71000', '12'))['pop'], '2')
+        self.assertEqual(weather_cache.get(app_module.weather_key('Tampa', 'FL'))['temp'], 81)
+
+    def test_warm_failure_not_counted(self):
+        """ A failed fetch raises for warm() to count, rather than counting as fetched """
+        Census_Cache.query.delete()
+        db.session.commit()
+
+        with mock.patch.object(app_module, 'local_census_data_many', return_value={}), \
+             mock.patch.object(app_module, 'fetch_census_data_many', side_effect=ConnectionError('down')):
+            with self.assertRaises(ConnectionError):
+                app_module.warm_census([('71000', '12')], lambda: None)
@@ -0,0 +1,183 @@
+""" Shared HTTP client for the external APIs """
+
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses worth retrying: rate limiting and server-side errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """ Raised instead of calling a host that has been failing """
+
+
+class BadPayload(requests.RequestException):
+    """ A response body that isn't the shape the API documents """
+
+
+class Upstream:
+    """ Settings, running stats and circuit breaker for one external host.
+
+        After failure_threshold failed calls in a row the circuit opens and
+        calls fail fast with CircuitOpenError. reset_timeout seconds later
+        one trial call is let through: success closes the circuit, failure
+        opens it again.
+
+        name labels the host's calls in per-request timings, which
+        can't use a host:port.
+    """
+
+    def __init__(self, host, timeout=(3.05, 10), retries=2, backoff=0.25,
+                 failure_threshold=5, reset_timeout=30, name=None):
+        self.host = host
+        self.name = name or host
+        # (connect, read) seconds, as requests takes them
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self.consecutive_failures = 0
+        # time.monotonic() the circuit opened, None while closed
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self):
+        """ Whether a call may go ahead, counting it as rejected if not """
+
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial_running and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def circuit(self):
+        """ 'closed', 'open', or 'half_open' while a trial call is running """
+
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half_open' if self.trial_running else 'open'
+
+    def record(self, seconds, retried, failed):
+        with self.lock:
+            self.requests += 1
+            self.retried += retried
+            self.errors += failed
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+
+            if not failed:
+                self.consecutive_failures = 0
+                self.opened_at = None
+            else:
+                self.consecutive_failures += 1
+                if self.trial_running or self.consecutive_failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'retried': self.retried,
+                    'errors': self.errors,
+                    'rejected': self.rejected,
+                    'circuit': 'closed' if self.opened_at is None else
+                               'half_open' if self.trial_running else 'open',
+                    'avg_ms': round(1000 * self.latency_total / self.requests, 1) if self.requests else None,
+                    'max_ms': round(1000 * self.latency_max, 1)}
+
+
+class UpstreamClient:
+    """ One requests.Session, with keep-alive connection pools per host,
+        shared by every API call in the worker.
+        GETs are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, upstreams, pool_size=10):
+        self.upstreams = {upstream.host: upstream for upstream in upstreams}
+        self.default = Upstream('other')
+        # called with (upstream, seconds) after every get()
+        self.observer = None
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=len(self.upstreams) + 1, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def upstream_for(self, url):
+        """ The Upstream for url's host:port, or failing that its host """
+
+        parts = urlsplit(url)
+        return self.upstreams.get(parts.netloc) or self.upstreams.get(parts.hostname, self.default)
+
+    def get(self, url, **kwargs):
+        """ GET url with the host's timeout and retry policy.
+            Returns the last response, or raises the last connection error,
+            or CircuitOpenError without trying if the host is failing.
+        """
+
+        upstream = self.upstream_for(url)
+        if not upstream.allow():
+            raise CircuitOpenError(f'{upstream.host} is failing; not calling it for now')
+
+        kwargs.setdefault('timeout', upstream.timeout)
+        start = time.perf_counter()
+        attempt = 0
+
+        while True:
+            try:
+                res = self.session.get(url, **kwargs)
+                if res.status_code not in RETRY_STATUSES or attempt >= upstream.retries:
+                    self.record(upstream, start, attempt, res.status_code >= 500)
+                    return res
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= upstream.retries:
+                    self.record(upstream, start, attempt, True)
+                    raise
+            except requests.RequestException:
+                self.record(upstream, start, attempt, True)
+                raise
+
+            # full jitter keeps retries from several workers from lining up
+            time.sleep(random.uniform(0, upstream.backoff * 2 ** attempt))
+            attempt += 1
+
+    def record(self, upstream, start, retried, failed):
+        seconds = time.perf_counter() - start
+        upstream.record(seconds, retried, failed)
+        if self.observer:
+            self.observer(upstream, seconds)
+
+    def stats(self):
+        """ Per-host request/latency counters and connection pool usage """
+
+        pools = {}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[key]
+            pools[f'{key.key_scheme}://{key.key_host}'] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+
+        upstreams = {host: upstream.stats() for host, upstream in self.upstreams.items()}
+        upstreams['other'] = self.default.stats()
+
+        return {'upstreams': upstreams, 'pools': pools}
@@ -0,0 +1,115 @@
+""" Prefetch census and weather data for users' home cities and favorites,
+    so the first comparison after a restart or an expiry is a cache hit
+"""
+
+import threading
+import time
+from collections import defaultdict
+
+from gazetteer import STATE_NAMES
+from models import db, User, User_Favorites
+
+
+class RateLimit:
+    """ Spaces callers at least 1/rate seconds apart; no limit if rate is 0 """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+        time.sleep(start - now)
+
+
+def saved_places(limit=None):
+    """ Distinct (place, state, city name, state abbr) for every user's
+        home city and favorite, most saved first. Names are None for rows
+        saved before names were stored.
+    """
+
+    homes = db.select([User.user_city.label('place'), User.user_state.label('state'),
+                       User.city_name.label('city'), User.abbr.label('abbr')])
+    favorites = db.select([User_Favorites.city_id, User_Favorites.state_id,
+                           User_Favorites.city_name, User_Favorites.abbr])
+    saved = db.union_all(homes, favorites).subquery()
+
+    query = db.select([saved.c.place, saved.c.state, db.func.max(saved.c.city),
+                       db.func.max(saved.c.abbr)]) \
+              .group_by(saved.c.place, saved.c.state) \
+              .order_by(db.func.count().desc(), saved.c.state, saved.c.place) \
+              .limit(limit)
+
+    with db.engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(query)]
+
+
+def warm(places, warm_census, warm_weather, rate=2.0, echo=print):
+    """ Fill the caches for places, from saved_places(), one state at a
+        time, making at most `rate` upstream calls a second.
+
+        warm_census(codes, throttle) caches census data for (place, state)
+        pairs in one state; warm_weather(place, state, city, abbr, throttle)
+        caches one city's weather. Each calls throttle() before going
+        upstream and returns how many entries it fetched. Returns the
+        run's counts.
+    """
+
+    limit = RateLimit(rate)
+    report = {'places': len(places), 'census_fetched': 0, 'weather_fetched': 0,
+              'failed': 0, 'upstream_calls': 0}
+
+    def throttle():
+        limit.wait()
+        report['upstream_calls'] += 1
+
+    by_state = defaultdict(list)
+    for place in places:
+        by_state[place[1]].append(place)
+
+    start = time.monotonic()
+    for done, (state, state_places) in enumerate(sorted(by_state.items()), 1):
+        try:
+            report['census_fetched'] += warm_census([place[:2] for place in state_places], throttle)
+        except Exception as err:
+            report['failed'] += 1
+            echo(f'  census for {STATE_NAMES.get(state, state)} failed: {err!r}')
+
+        for place, state, city, abbr in state_places:
+            try:
+                report['weather_fetched'] += warm_weather(place, state, city, abbr, throttle)
+            except Exception as err:
+                report['failed'] += 1
+                echo(f'  weather for {city}, {abbr} failed: {err!r}')
+
+        echo(f'  [{done}/{len(by_state)}] {STATE_NAMES.get(state, state)}: {len(state_places)} places, '
+             f'{report["upstream_calls"]} upstream calls so far')
+
+    report['seconds'] = round(time.monotonic() - start, 2)
+    return report
+
+
+class Scheduler:
+    """ Runs fn every `interval` seconds on a daemon thread """
+
+    def __init__(self, fn, interval):
+        self.fn = fn
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name='cache-warmer', daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            self.fn()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()